@@ -1,13 +1,95 @@
 # -*- coding: utf-8 -*-
 import argparse
+import json
 import os
 import sys
 import logging
-from rcp_core import run_rcp_process
+
+# rcp_core is imported lazily: when a local rcp_agent is running the job is
+# handed off over its Unix socket and this process exits without loading it.
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+def _config_path():
+    return os.environ.get('RCP_CONFIG') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+
+def _read_ini():
+    """Reads config.ini with configparser only, for the settings needed before rcp_core is loaded."""
+    import configparser
+    config = configparser.ConfigParser()
+    config.read(_config_path())
+    return config
+
+def _ini_path(path):
+    return os.path.join(os.path.dirname(os.path.abspath(_config_path())), os.path.expanduser(path))
+
+def agent_socket_path():
+    """Returns the rcp_agent Unix socket path from RCP_AGENT_SOCKET or config.ini, or None if disabled."""
+    path = os.environ.get('RCP_AGENT_SOCKET')
+    if path is None:
+        path = _read_ini().get('rcp_agent', 'unix_socket', fallback='rcp_agent.sock')
+    path = path.strip()
+    if not path:
+        return None
+    return _ini_path(path)
+
+def spool_job(kind, payload):
+    """
+    Durably appends a job to the spool directory for rcp_agent or `rcp.py drain`.
+    Returns the spooled file name, or None if the spool could not be written.
+    """
+    from rcp_spool import Spool
+    path = _read_ini().get('spool', 'path', fallback='spool').strip() or 'spool'
+    try:
+        return Spool(_ini_path(path)).append(kind, payload)
+    except OSError as e:
+        logging.error(f"Could not write to the spool {path}: {e}")
+        return None
+
+def forward_to_agent(endpoint, payload, timeout=5):
+    """
+    Hands a request to a running rcp_agent over its Unix socket.
+    Returns the decoded answer, or None when no agent is reachable. If the agent
+    stops answering after the request was sent, it may be running the job, so
+    {'status': 'sent'} is returned and the caller must not process it locally.
+    """
+    socket_path = agent_socket_path()
+    if not socket_path or not os.path.exists(socket_path):
+        return None
+
+    import http.client
+    import socket
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(socket_path)
+
+    conn = UnixHTTPConnection('localhost', timeout=timeout)
+    try:
+        conn.connect()
+    except OSError as e:
+        conn.close()
+        logging.info(f"rcp_agent not reachable on {socket_path} ({e}), processing locally.")
+        return None
+    try:
+        body = json.dumps(payload).encode('utf-8')
+        conn.request('POST', endpoint, body=body, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        answer = json.loads(response.read().decode('utf-8'))
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        logging.warning(f"rcp_agent did not answer on {socket_path} ({e}) after the request was sent.")
+        return {'status': 'sent', 'message': str(e)}
+    finally:
+        conn.close()
+
+    if response.status >= 500:
+        logging.warning(f"rcp_agent answered {response.status}: {answer}, processing locally.")
+        return None
+    return answer
+
 def main():
     """
     This script is a command-line wrapper for the core RCP logic.
@@ -15,15 +97,31 @@ def main():
     and then calls the main processing function from rcp_core.
     """
     logging.info(f"--- rcp.py wrapper script started ---")
+
+    if sys.argv[1:2] == ['reconcile']:
+        run_reconcile(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['drain']:
+        run_drain(sys.argv[2:])
+        return
     
     parser = argparse.ArgumentParser(description="RCP Wrapper - A command-line interface for the Remote Torrent Copy process.")
     parser.add_argument("tor_path", nargs='?', default=None, help="The local file path of the torrent content.")
     parser.add_argument("--torhash", "-t", help="The HASH of the torrent.")
     parser.add_argument("--torname", "-n", help="The name of the torrent.")
     parser.add_argument("--dl_uuid", "-u", help="The UUID of the download task (optional).")
+    parser.add_argument("--batch", "-b", metavar="FILE", help="Process every item of a JSONL file ({tor_path, torhash, dl_uuid, torname} per line).")
+    parser.add_argument("--prefetch", action="store_true", help="Only resolve and cache the media info (for qBittorrent's \"on torrent added\" hook); link nothing.")
+    parser.add_argument("--local", action="store_true", help="Always process in this process instead of handing off to a running rcp_agent.")
+    parser.add_argument("--plan-only", action="store_true", help="Print the links that would be created and exit without touching the library.")
+    parser.add_argument("--spool", action="store_true", help="Only append the job to the spool directory and exit; rcp_agent or `rcp.py drain` runs it.")
     
     args = parser.parse_args()
 
+    if args.batch:
+        run_batch(args.batch)
+        return
+
     # Prioritize command-line arguments
     tor_path = args.tor_path
     torhash = args.torhash
@@ -46,17 +144,166 @@ def main():
         parser.print_help()
         sys.exit(1)
 
+    if args.plan_only:
+        run_plan_only(tor_path, torhash, dl_uuid, torname)
+        return
+
+    kind = 'prefetch' if args.prefetch else 'process'
+    payload = {
+        'tor_path': tor_path,
+        'torhash': torhash,
+        'dl_uuid': dl_uuid,
+        'torname': torname,
+    }
+    spool_mode = 'off' if args.local else ('always' if args.spool else _read_ini().get('spool', 'mode', fallback='off').strip())
+    if spool_mode == 'always':
+        name = spool_job(kind, payload)
+        if name is not None:
+            logging.info(f"Spooled as {name}.")
+            return
+
+    if not args.local:
+        answer = forward_to_agent(f'/rcp/{kind}', payload)
+        if answer is None and spool_mode == 'fallback':
+            name = spool_job(kind, payload)
+            if name is not None:
+                logging.info(f"rcp_agent not available, spooled as {name}.")
+                return
+        if answer is not None:
+            if answer.get('status') == 'accepted':
+                logging.info(f"Handed off to rcp_agent as job {answer.get('job_id')}.")
+                return
+            if answer.get('status') == 'sent':
+                logging.warning("rcp_agent may still be running the job, not processing it locally.")
+                return
+            logging.error(f"rcp_agent rejected the request: {answer}")
+            sys.exit(1)
+
+    if args.prefetch:
+        run_prefetch(tor_path, torhash, dl_uuid, torname)
+        return
+
+    from rcp_core import run_rcp_process, collect_stage_timings, format_stage_timings
     try:
-        run_rcp_process(
-            tor_path=tor_path,
-            torhash=torhash,
-            dl_uuid=dl_uuid,
-            torname=torname
-        )
+        with collect_stage_timings() as timings:
+            run_rcp_process(
+                tor_path=tor_path,
+                torhash=torhash,
+                dl_uuid=dl_uuid,
+                torname=torname
+            )
+        logging.info(f"Stage timings: {format_stage_timings(timings)}")
         logging.info("--- rcp.py wrapper script finished successfully. ---")
     except Exception as e:
         logging.error(f"An error occurred during the RCP process: {e}", exc_info=True)
         sys.exit(1)
 
+def run_prefetch(tor_path, torhash, dl_uuid, torname):
+    """Warms the media info cache in this process."""
+    from rcp_core import run_rcp_prefetch
+    try:
+        result = run_rcp_prefetch(tor_path=tor_path, torhash=torhash, dl_uuid=dl_uuid, torname=torname)
+    except Exception as e:
+        logging.error(f"An error occurred during the RCP prefetch: {e}", exc_info=True)
+        sys.exit(1)
+    logging.info(f"--- rcp.py prefetch finished: {result} ---")
+
+def run_plan_only(tor_path, torhash, dl_uuid, torname):
+    """Prints the link plan of a torrent (one `src -> dst` per line) without creating anything."""
+    from rcp_core import run_rcp_plan
+    try:
+        plan = run_rcp_plan(tor_path=tor_path, torhash=torhash, dl_uuid=dl_uuid, torname=torname)
+    except Exception as e:
+        logging.error(f"An error occurred while planning: {e}", exc_info=True)
+        sys.exit(1)
+    media_info = plan['media_info']
+    print(f"# {media_info.get('tmdb_cat')}: {media_info.get('emby_dir')}")
+    for src, dst in plan['links']:
+        print(f"{src} -> {dst}")
+    logging.info(f"--- rcp.py plan: {len(plan['links'])} link(s) in {len(plan['dirs'])} folder(s), nothing was changed. ---")
+
+def run_reconcile(argv):
+    """`rcp.py reconcile`: checks the library against the link manifest and repairs it."""
+    parser = argparse.ArgumentParser(prog="rcp.py reconcile", description="Find and repair missing, stale and orphaned library links.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be repaired.")
+    parser.add_argument("--local", action="store_true", help="Always run in this process instead of handing off to a running rcp_agent.")
+    args = parser.parse_args(argv)
+
+    if not args.local:
+        answer = forward_to_agent('/rcp/reconcile', {'dry_run': args.dry_run})
+        if answer is not None:
+            if answer.get('status') == 'accepted':
+                logging.info(f"Handed off to rcp_agent as job {answer.get('job_id')}, see {answer.get('status_url')}.")
+                return
+            if answer.get('status') == 'sent':
+                logging.warning("rcp_agent may still be running the reconcile, not running it locally.")
+                return
+            logging.error(f"rcp_agent rejected the request: {answer}")
+            sys.exit(1)
+
+    from rcp_core import load_config, collect_stage_timings, format_stage_timings
+    from rcp_reconcile import reconcile
+    try:
+        with collect_stage_timings() as timings:
+            summary = reconcile(load_config(), dry_run=args.dry_run)
+    except Exception as e:
+        logging.error(f"An error occurred during the RCP reconcile: {e}", exc_info=True)
+        sys.exit(1)
+
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    logging.info(f"Stage timings: {format_stage_timings(timings)}")
+    if summary['failed']:
+        sys.exit(1)
+
+def run_drain(argv):
+    """`rcp.py drain`: runs the jobs waiting in the spool directory."""
+    parser = argparse.ArgumentParser(prog="rcp.py drain", description="Run spooled jobs that are due.")
+    parser.add_argument("--limit", type=int, default=None, help="Handle at most this many jobs.")
+    args = parser.parse_args(argv)
+
+    from rcp_core import load_config
+    from rcp_spool import drain
+    try:
+        summary = drain(load_config(), limit=args.limit)
+    except Exception as e:
+        logging.error(f"An error occurred while draining the spool: {e}", exc_info=True)
+        sys.exit(1)
+    print(json.dumps(summary))
+    if summary['failed']:
+        sys.exit(1)
+
+def run_batch(batch_file):
+    """Processes all items listed in a JSONL file in one batch."""
+    items = []
+    try:
+        with open(batch_file, encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    items.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    logging.error(f"Invalid JSON on line {line_no} of {batch_file}: {e}")
+                    sys.exit(1)
+    except OSError as e:
+        logging.error(f"Could not read batch file {batch_file}: {e}")
+        sys.exit(1)
+
+    from rcp_core import run_rcp_batch, collect_stage_timings, format_stage_timings
+    try:
+        with collect_stage_timings() as timings:
+            results = run_rcp_batch(items)
+    except Exception as e:
+        logging.error(f"An error occurred during the RCP batch: {e}", exc_info=True)
+        sys.exit(1)
+
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+    logging.info(f"Stage timings: {format_stage_timings(timings)}")
+    if any(r['status'] != 'success' for r in results):
+        sys.exit(1)
+    logging.info("--- rcp.py batch finished successfully. ---")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
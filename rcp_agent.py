@@ -1,17 +1,45 @@
 # -*- coding: utf-8 -*-
+import argparse
 import http.server
 import socketserver
 import json
 import logging
-from rcp_core import run_rcp_process, load_config, delete_links, execute_hardlinking, translate_path_to_agent_path
+import os
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+from rcp_core import run_rcp_process, run_rcp_batch, run_rcp_prefetch, resume_plan, load_config, delete_links, translate_path_to_agent_path, translate_path_to_app_path, get_media_cache, get_link_manifest, stage_timer, collect_stage_timings, collect_progress
+from rcp_metrics import REGISTRY, REQUESTS, QUEUE_DEPTH, SPOOL_PENDING
+from rcp_relink import relink_incremental
+from rcp_reconcile import reconcile
+from rcp_spool import get_spool, drain
+from rcp_trash import get_trash
+from rcp_journal import get_plan_journal
+from rcp_watch import get_watcher
+from rcp_pathmap import compile_mapping
+from rcp_jobs import JobQueue, JOB_SUCCEEDED, current_job
+from rcp_iosched import DeviceScheduler, parse_device_limits, job_devices, estimate_priority, PRIORITY_NORMAL, PRIORITY_LARGE
 
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+NDJSON = 'application/x-ndjson'
+# Seconds without progress after which a streaming client gets a heartbeat event
+STREAM_HEARTBEAT = 10
+
 class RcpRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        if not isinstance(self.client_address, tuple):
+            return 'unix'
+        return super().address_string()
+
     def _check_ip_whitelist(self):
         """Checks if the client IP is in the whitelist. Returns True if allowed, False otherwise."""
+        if not isinstance(self.client_address, tuple):
+            # Local Unix socket: access is governed by the socket file's permissions
+            return True
         whitelist = self.server.whitelist
         client_ip = self.client_address[0]
         
@@ -22,11 +50,48 @@ class RcpRequestHandler(http.server.SimpleHTTPRequestHandler):
         return True
 
     def do_GET(self):
-        """Explicitly forbid GET requests to prevent directory listing."""
+        """Serves job status queries; any other GET is forbidden to prevent directory listing."""
         if not self._check_ip_whitelist():
             return
+        url = urlsplit(self.path)
+        if url.path.startswith('/rcp/jobs/'):
+            self.handle_job_status(url.path[len('/rcp/jobs/'):])
+            return
+        if url.path == '/metrics':
+            self._send_text(200, REGISTRY.render(), 'text/plain; version=0.0.4; charset=utf-8')
+            return
+        if url.path == '/rcp/links':
+            self.handle_links(parse_qs(url.query))
+            return
         self._send_response(405, {'status': 'error', 'message': 'Method Not Allowed'})
 
+    def handle_job_status(self, job_id):
+        """Reports status, timings and errors of a queued job."""
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            self._send_response(404, {'status': 'error', 'message': f'Job not found: {job_id}'})
+            return
+        self._send_response(200, job.to_dict())
+
+    def handle_links(self, query):
+        """Lists the library links recorded in the manifest for a torhash or below a rel_path."""
+        torhash = query.get('torhash', [None])[0]
+        rel_path = query.get('rel_path', [None])[0]
+        if not torhash and not rel_path:
+            self._send_response(400, {'status': 'error', 'message': 'Missing torhash or rel_path for /rcp/links'})
+            return
+        config = load_config()
+        manifest = get_link_manifest(config)
+        if manifest is None:
+            self._send_response(404, {'status': 'error', 'message': 'Link manifest is disabled'})
+            return
+        if torhash:
+            records = manifest.links_for_torhash(torhash)
+        else:
+            records = manifest.links_under(os.path.join(config['root_path'], rel_path))
+        links = [{'torhash': h, 'src': src, 'dev': dev, 'ino': ino, 'dst': dst} for h, src, dev, ino, dst in records]
+        self._send_response(200, {'status': 'success', 'count': len(links), 'links': links})
+
     def do_POST(self):
         """Handles POST requests for RCP operations after checking IP whitelist."""
         if not self._check_ip_whitelist():
@@ -40,9 +105,17 @@ class RcpRequestHandler(http.server.SimpleHTTPRequestHandler):
 
                 logging.info(f"Received request on {self.path} with payload: {payload}")
 
+                if self.path in self.OBJECT_ENDPOINTS and not isinstance(payload, dict):
+                    self._send_response(400, {'status': 'error', 'message': f'Payload for {self.path} must be a JSON object.'})
+                    return
+
                 # Route to different handlers based on path
                 if self.path == '/rcp/process':
                     self.handle_process(payload)
+                elif self.path == '/rcp/process_batch':
+                    self.handle_process_batch(payload)
+                elif self.path == '/rcp/prefetch':
+                    self.handle_prefetch(payload)
                 elif self.path == '/rcp/relink':
                     # Placeholder for future implementation
                     self.handle_relink(payload)
@@ -51,6 +124,8 @@ class RcpRequestHandler(http.server.SimpleHTTPRequestHandler):
                     self.handle_modify(payload)
                 elif self.path == '/rcp/delete_files':
                     self.handle_delete_files(payload)
+                elif self.path == '/rcp/reconcile':
+                    self.handle_reconcile(payload)
                 else:
                     self._send_response(404, {'status': 'error', 'message': 'Endpoint not found'})
 
@@ -62,6 +137,9 @@ class RcpRequestHandler(http.server.SimpleHTTPRequestHandler):
         else:
             self._send_response(404, {'status': 'error', 'message': 'Not Found'})
 
+    # Endpoints whose payload must be a JSON object; process_batch also takes a bare list
+    OBJECT_ENDPOINTS = ('/rcp/process', '/rcp/prefetch', '/rcp/relink', '/rcp/modify', '/rcp/delete_files')
+
     def handle_process(self, payload):
         """Handles the original processing request."""
         tor_path = payload.get('tor_path')
@@ -73,92 +151,408 @@ class RcpRequestHandler(http.server.SimpleHTTPRequestHandler):
             self._send_response(400, {'status': 'error', 'message': 'Missing tor_path or torhash for /rcp/process'})
             return
 
-        run_rcp_process(
-            tor_path=tor_path,
-            torhash=torhash,
-            dl_uuid=dl_uuid,
-            torname=torname
-        )
-        self._send_response(200, {'status': 'success', 'message': 'Process completed successfully.'})
+        def job():
+            stats = run_rcp_process(
+                tor_path=tor_path,
+                torhash=torhash,
+                dl_uuid=dl_uuid,
+                torname=torname
+            )
+            return {'message': 'Process completed successfully.', 'links': stats}
+
+        self._submit_job('process', payload, job, key=('process', torhash), io_paths=[tor_path])
+
+    def handle_prefetch(self, payload):
+        """Handles warming the media info cache for a torrent that was just added."""
+        tor_path = payload.get('tor_path')
+        torhash = payload.get('torhash')
+
+        if not tor_path or not torhash:
+            self._send_response(400, {'status': 'error', 'message': 'Missing tor_path or torhash for /rcp/prefetch'})
+            return
+
+        def job():
+            result = run_rcp_prefetch(
+                tor_path=tor_path,
+                torhash=torhash,
+                dl_uuid=payload.get('dl_uuid'),
+                torname=payload.get('torname')
+            )
+            result['message'] = 'Prefetch completed.'
+            return result
+
+        # Only talks to torll, so it takes no device slots
+        self._submit_job('prefetch', payload, job, key=('prefetch', torhash))
+
+    def handle_process_batch(self, payload):
+        """Handles processing a list of torrents in one job."""
+        items = payload.get('items') if isinstance(payload, dict) else payload
+        if not isinstance(items, list) or not items:
+            self._send_response(400, {'status': 'error', 'message': 'Missing items list for /rcp/process_batch'})
+            return
+        if not all(isinstance(item, dict) for item in items):
+            self._send_response(400, {'status': 'error', 'message': 'Every item for /rcp/process_batch must be a JSON object'})
+            return
+
+        def job():
+            results = run_rcp_batch(items)
+            failed = sum(1 for r in results if r['status'] != 'success')
+            return {'succeeded': len(results) - failed, 'failed': failed, 'results': results}
+
+        self._submit_job('process_batch', items, job,
+                         io_paths=[item.get('tor_path') for item in items])
 
     def handle_relink(self, payload):
         """Handles relinking an existing media item."""
         logging.info("Handling /rcp/relink")
-        self._handle_relink_request(payload)
+        self._handle_relink_request('relink', payload)
 
     def handle_modify(self, payload):
         """Handles modifying a media item (delete old + create new)."""
         logging.info("Handling /rcp/modify")
-        self._handle_relink_request(payload)
+        self._handle_relink_request('modify', payload)
 
     def handle_delete_files(self, payload):
         """
         Handles deleting hardlinked files/folders on the agent.
+        Either rel_path or torhash (delete every link recorded for the torrent) is required.
         """
         logging.info("Handling /rcp/delete_files")
         rel_path = payload.get('rel_path')
+        torhash = payload.get('torhash')
 
-        if not rel_path:
-            self._send_response(400, {'status': 'error', 'message': 'Missing rel_path for /rcp/delete_files'})
+        if not rel_path and not torhash:
+            self._send_response(400, {'status': 'error', 'message': 'Missing rel_path or torhash for /rcp/delete_files'})
             return
 
-        config = load_config()
-        try:
-            delete_links(config, rel_path)
-            self._send_response(200, {'status': 'success', 'message': f'Successfully deleted {rel_path}'})
-        except Exception as e:
-            logging.error(f"Error deleting files for {rel_path}: {e}", exc_info=True)
-            self._send_response(500, {'status': 'error', 'message': str(e)})
+        def job():
+            config = load_config()
+            result = delete_links(config, rel_path, torhash=None if rel_path else torhash)
+            result['message'] = f'Successfully deleted {rel_path or torhash}'
+            return result
+
+        self._submit_job('delete_files', payload, job, key=('delete_files', rel_path or f'torhash:{torhash}'), io_paths=[])
 
-    def _handle_relink_request(self, payload):
+    def handle_reconcile(self, payload):
+        """Handles checking the library against the manifest and repairing drift."""
+        dry_run = bool(payload.get('dry_run')) if isinstance(payload, dict) else False
+
+        def job():
+            config = load_config()
+            return reconcile(config, dry_run=dry_run)
+
+        # One reconcile at a time; repeated requests attach to the running one
+        self._submit_job('reconcile', payload, job, key=('reconcile', dry_run), io_paths=[])
+
+    def _handle_relink_request(self, kind, payload):
         """Core logic for both relink and modify operations."""
         old_rel_path = payload.get('old_rel_path')
         new_media_info = payload.get('new_media_info')
         tor_path = payload.get('tor_path')
+        torhash = payload.get('torhash')
 
         if not new_media_info or not tor_path:
             self._send_response(400, {'status': 'error', 'message': 'Missing new_media_info or tor_path'})
             return
 
-        config = load_config()
+        def job():
+            config = load_config()
+
+            # Translate the path before creating new links
+            with stage_timer('translate_path_to_agent_path'):
+                translated_tor_path = translate_path_to_agent_path(tor_path, config.get('path_mapping', {}))
+            logging.info(f"Original tor_path: {tor_path}, Translated tor_path: {translated_tor_path}")
 
-        # 1. Delete old links if path is provided
-        if old_rel_path:
-            delete_links(config, old_rel_path)
+            # The supplied media info supersedes whatever torll returned before
+            cache = get_media_cache(config)
+            if cache is not None:
+                cache.invalidate(torhash=torhash, tor_path=translated_tor_path)
+                if torhash:
+                    cache.put(torhash, translated_tor_path, new_media_info)
+
+            # Diff the old links against the new plan and apply only the changes
+            if not old_rel_path:
+                logging.info("No old_rel_path provided, skipping deletion.")
+            summary = relink_incremental(config, old_rel_path, new_media_info, translated_tor_path, torhash)
+            return {'message': 'Relink process completed successfully.', 'operations': summary}
+
+        # relink and modify both rewrite the library entry at old_rel_path, so any
+        # request for the same entry joins the job already in flight for it
+        self._submit_job(kind, payload, job, key=('relink', old_rel_path), io_paths=[tor_path])
+
+    def _io_hints(self, io_paths):
+        """
+        Priority and devices for a job that reads io_paths (client-side download
+        paths) and writes under root_path. None means the job touches no known paths.
+        """
+        if io_paths is None:
+            return PRIORITY_NORMAL, ()
+        config = load_config()
+        sources = compile_mapping(config.get('path_mapping')).translate_many([p for p in io_paths if p])
+        devices = job_devices(config['root_path'], *sources)
+        policy = config.get('scheduler_priority', 'small_first')
+        if len(sources) == 1:
+            priority = estimate_priority(sources[0], policy)
+        elif sources and policy == 'small_first':
+            # A batch holds its device slots for all of its items
+            priority = PRIORITY_LARGE
         else:
-            logging.info("No old_rel_path provided, skipping deletion.")
+            priority = PRIORITY_NORMAL
+        return priority, devices
+
+    def _submit_job(self, kind, payload, func, key=None, io_paths=None):
+        """
+        Queues func on the worker pool and answers 202 with the job id.
+        A request whose key matches an in-flight job attaches to that job instead.
+        io_paths lets the scheduler order the job and bound it per device.
+        With `Accept: application/x-ndjson` the job's progress is streamed instead.
+        """
+        def timed():
+            with collect_stage_timings() as timings, collect_progress(current_job().emit):
+                result = func()
+            result['timings'] = timings
+            return result
 
-        # Translate the path before creating new links
-        translated_tor_path = translate_path_to_agent_path(tor_path, config.get('path_mapping', {}))
-        logging.info(f"Original tor_path: {tor_path}, Translated tor_path: {translated_tor_path}")
+        priority, devices = self._io_hints(io_paths)
+        job, created = self.server.jobs.submit(kind, payload, timed, key=key,
+                                               priority=priority, devices=devices)
+        accepted = {
+            'status': 'accepted',
+            'job_id': job.id,
+            'status_url': f'/rcp/jobs/{job.id}',
+            'coalesced': not created,
+        }
+        if NDJSON in self.headers.get('Accept', ''):
+            self._stream_job(job, accepted)
+            return
+        self._send_response(202, accepted)
 
-        # 2. Create new links
-        execute_hardlinking(config, new_media_info, translated_tor_path)
-        
-        self._send_response(200, {'status': 'success', 'message': 'Relink process completed successfully.'})
+    def _stream_job(self, job, accepted):
+        """
+        Answers with one JSON object per line as the job progresses: 'accepted',
+        'started', the job's progress events ('media_info', 'discovered',
+        'links', ...), a 'heartbeat' after STREAM_HEARTBEAT quiet seconds, and
+        finally 'done' with the job status, result and timings. The job keeps
+        running if the client goes away.
+        """
+        self._start_stream(200, NDJSON)
+        try:
+            self._write_event(dict({'event': 'accepted'}, **accepted))
+            sent = 0
+            while True:
+                events = job.events_after(sent, timeout=STREAM_HEARTBEAT)
+                for event in events:
+                    self._write_event(event)
+                sent += len(events)
+                if job.done and not events:
+                    break
+                if not events:
+                    self._write_event({'event': 'heartbeat', 'status': job.status})
+            self._write_event(dict({'event': 'done'}, **job.to_dict()))
+            self._end_stream()
+        except (BrokenPipeError, ConnectionResetError):
+            logging.info(f"Streaming client of job {job.id} disconnected; the job continues.")
+
+
+    KNOWN_ENDPOINTS = ('/rcp/process', '/rcp/process_batch', '/rcp/prefetch', '/rcp/relink', '/rcp/modify',
+                       '/rcp/delete_files', '/rcp/reconcile', '/rcp/links', '/metrics')
 
+    def _endpoint_label(self):
+        path = urlsplit(self.path).path
+        if path.startswith('/rcp/jobs/'):
+            return '/rcp/jobs/<id>'
+        return path if path in self.KNOWN_ENDPOINTS else 'other'
 
     def _send_response(self, status_code, content_dict):
+        self._send_text(status_code, json.dumps(content_dict), 'application/json')
+
+    def _start_stream(self, status_code, content_type):
+        """Sends the headers of a response whose body is written piecewise (chunked for HTTP/1.1 clients)."""
+        REQUESTS.inc(endpoint=self._endpoint_label(), status=status_code)
+        self._chunked = self.request_version != 'HTTP/1.0'
+        if self._chunked:
+            # Chunked transfer encoding needs an HTTP/1.1 status line
+            self.protocol_version = 'HTTP/1.1'
+        self.send_response(status_code)
+        self.send_header('Content-type', content_type)
+        if self._chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def _write_event(self, event):
+        data = (json.dumps(event) + '\n').encode('utf-8')
+        if self._chunked:
+            data = f"{len(data):X}\r\n".encode('ascii') + data + b'\r\n'
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def _end_stream(self):
+        if self._chunked:
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+
+    def _send_text(self, status_code, text, content_type):
+        REQUESTS.inc(endpoint=self._endpoint_label(), status=status_code)
         self.send_response(status_code)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', content_type)
         self.end_headers()
-        self.wfile.write(json.dumps(content_dict).encode('utf-8'))
+        self.wfile.write(text.encode('utf-8'))
+
+class RcpAgentServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class RcpUnixAgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def start_unix_server(socket_path, jobs):
+    """Serves the agent API on a Unix domain socket in a background thread, for local rcp.py hand-off."""
+    if os.path.exists(socket_path):
+        # Left over from an agent that did not shut down cleanly
+        os.unlink(socket_path)
+    server = RcpUnixAgentServer(socket_path, RcpRequestHandler)
+    server.whitelist = []
+    server.jobs = jobs
+    threading.Thread(target=server.serve_forever, name='rcp-unix-server', daemon=True).start()
+    logging.info(f"RCP Agent also listening on Unix socket {socket_path}")
+    return server
+
+def start_spool_drainer(config, jobs):
+    """
+    Polls the spool directory and drains due jobs through the job queue,
+    one drain job at a time.
+    """
+    spool = get_spool(config)
+    spool.recover()
+    SPOOL_PENDING.set_function(spool.pending)
+    interval = config.get('spool_poll_interval', 2.0)
+    # Drains read the spool and write the library, so they count against both devices
+    devices = job_devices(spool.path, config['root_path'])
+
+    def loop():
+        while True:
+            try:
+                if spool.has_due():
+                    job, _ = jobs.submit('spool_drain', {}, lambda: drain(load_config()),
+                                         key=('spool_drain',), devices=devices)
+                    job.wait()
+            except Exception as e:
+                logging.error(f"Spool drainer error: {e}", exc_info=True)
+            time.sleep(interval)
+
+    threading.Thread(target=loop, name='rcp-spool-drainer', daemon=True).start()
+    logging.info(f"Draining spool {spool.path} every {interval}s")
+
+def resume_journaled_plans(config, jobs):
+    """Queues the link plans that were interrupted when the agent (or rcp.py) last stopped."""
+    journal = get_plan_journal(config)
+    if journal is None:
+        return
+    for entry in journal.pending():
+        plan = entry.plan
+        torhash = plan.get('torhash')
+
+        def job(entry=entry):
+            with collect_stage_timings() as timings:
+                stats = resume_plan(load_config(), entry)
+            return {'message': 'Resumed interrupted link plan.', 'links': stats, 'timings': timings}
+
+        resumed, created = jobs.submit('resume', {'tor_path': plan.get('tor_path'), 'torhash': torhash}, job,
+                                       key=('process', torhash) if torhash else None,
+                                       devices=job_devices(config['root_path'], plan.get('tor_path')))
+        if not created:
+            # The running job for this torrent journals (and locks) the plan itself
+            entry.release()
+        logging.info(f"Resuming interrupted plan for {plan.get('tor_path')} at "
+                     f"{entry.done}/{len(entry.links)} as job {resumed.id}")
+
+def start_watcher(config, jobs):
+    """
+    Watch mode: queues a process job for every download that finishes in the
+    watched download roots, instead of waiting for qBittorrent to call rcp.py.
+    """
+    mapping = config.get('path_mapping', {})
+    policy = config.get('scheduler_priority', 'small_first')
+
+    def on_ready(path, torhash, torname):
+        # run_rcp_process expects the download path as the application sees it
+        tor_path = translate_path_to_app_path(path, mapping)
+
+        def job():
+            with collect_stage_timings() as timings, collect_progress(current_job().emit):
+                stats = run_rcp_process(tor_path=tor_path, torhash=torhash, torname=torname)
+            return {'message': 'Process completed successfully.', 'links': stats, 'timings': timings}
+
+        # Without a torhash (no marker naming one) the download is only known by its path
+        queued, created = jobs.submit('watch', {'tor_path': tor_path, 'torhash': torhash, 'torname': torname}, job,
+                                      key=('process', torhash) if torhash else ('watch', path),
+                                      priority=estimate_priority(path, policy),
+                                      devices=job_devices(config['root_path'], path))
+        # Also reports back when the request joined a job already in flight for the torrent
+        queued.add_done_callback(lambda done: watcher.finished(path, done.status == JOB_SUCCEEDED))
+        logging.info(f"Queued finished download {path} as job {queued.id}" + ("" if created else " (already in flight)"))
+
+    watcher = get_watcher(config, on_ready)
+    watcher.start()
+    return watcher
 
 def main():
+    parser = argparse.ArgumentParser(description='RCP agent')
+    parser.add_argument('--watch', action='store_true',
+                        help='Watch the download paths and process finished downloads without the qBittorrent hook')
+    args = parser.parse_args()
     try:
         config = load_config()
         port = config.get('agent_port', 6008)
         whitelist = config.get('whitelist_ips', [])
-        
-        with socketserver.TCPServer(("", port), RcpRequestHandler) as httpd:
+
+        scheduler = DeviceScheduler(
+            default_limit=config.get('scheduler_device_limit', 2),
+            limits=parse_device_limits(config.get('scheduler_device_limits', '')),
+        )
+        jobs = JobQueue(workers=config.get('agent_workers', 4), history=config.get('job_history', 1000),
+                        scheduler=scheduler, aging=config.get('scheduler_aging', 300))
+        jobs.start()
+        QUEUE_DEPTH.set_function(jobs.depth)
+        resume_journaled_plans(config, jobs)
+
+        if config.get('spool_mode', 'off') != 'off' or os.path.isdir(config['spool_path']):
+            start_spool_drainer(config, jobs)
+
+        trash = get_trash(config)
+        if trash is not None:
+            # Also empties what was left in the trash when the agent last stopped
+            trash.start()
+
+        cache = get_media_cache(config)
+        if cache is not None:
+            # Drops prefetches for torrents that never completed while the agent was down
+            cache.purge_expired()
+
+        if args.watch:
+            start_watcher(config, jobs)
+
+        unix_server = None
+        if config.get('agent_unix_socket'):
+            unix_server = start_unix_server(config['agent_unix_socket'], jobs)
+
+        with RcpAgentServer(("", port), RcpRequestHandler) as httpd:
             httpd.whitelist = whitelist
+            httpd.jobs = jobs
             if whitelist:
                 logging.info(f"RCP Agent starting on port {port}, IP whitelist enabled: {whitelist}")
             else:
                 logging.info(f"RCP Agent starting on port {port} (no IP whitelist, allowing all connections)")
             
-            logging.info("Available endpoints: POST /rcp/process, POST /rcp/relink, POST /rcp/modify, POST /rcp/delete_files")
-            httpd.serve_forever()
+            logging.info("Available endpoints: POST /rcp/process, POST /rcp/process_batch, POST /rcp/prefetch, POST /rcp/relink, POST /rcp/modify, POST /rcp/delete_files, POST /rcp/reconcile, GET /rcp/jobs/<id>, GET /rcp/links, GET /metrics")
+            try:
+                httpd.serve_forever()
+            finally:
+                if unix_server is not None:
+                    unix_server.shutdown()
+                    unix_server.server_close()
+                    os.unlink(config['agent_unix_socket'])
     except FileNotFoundError as e:
         logging.error(f"Could not start agent: {e}")
     except KeyError as e:
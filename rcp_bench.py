@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+"""
+Reproducible benchmarks for rcp.
+
+    python rcp_bench.py gen DIR                 # only generate the synthetic download trees
+    python rcp_bench.py stub --latency 0.05     # only run the stub torll server
+    python rcp_bench.py run -o results.json     # generate, start the stub and time everything
+    python rcp_bench.py classify --episodes 2000  # only the season classifier micro-benchmark
+    python rcp_bench.py pathmap --rules 500     # only the path mapping micro-benchmark
+    python rcp_bench.py compare old.json new.json
+
+`run` works in a temporary directory with its own config.ini (via RCP_CONFIG),
+so it never touches the real library.
+"""
+import argparse
+import hashlib
+import http.client
+import http.server
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# ---------------------------------------------------------------------------
+# Synthetic download trees
+# ---------------------------------------------------------------------------
+
+def _touch(path, size=0):
+    with open(path, 'wb') as f:
+        if size:
+            f.truncate(size)
+
+
+def make_movie(root, name='Bench.Movie.2020.1080p.BluRay.x264-GRP'):
+    """A single-file movie plus subtitle."""
+    folder = os.path.join(root, name)
+    os.makedirs(folder, exist_ok=True)
+    _touch(os.path.join(folder, f'{name}.mkv'), 1024)
+    _touch(os.path.join(folder, f'{name}.srt'))
+    return folder
+
+
+def make_season_pack(root, seasons=3, episodes=24, name='Bench.Show.S01-S03.1080p.WEB-DL-GRP'):
+    """A multi-season pack mixing `S01` and `Season 2` folder styles, with a Sample dir."""
+    folder = os.path.join(root, name)
+    for s in range(1, seasons + 1):
+        season_dir = os.path.join(folder, f'S{s:02d}' if s % 2 else f'Season {s}')
+        os.makedirs(season_dir, exist_ok=True)
+        for e in range(1, episodes + 1):
+            base = f'Bench.Show.S{s:02d}E{e:02d}.1080p.WEB-DL-GRP'
+            _touch(os.path.join(season_dir, f'{base}.mkv'), 1024)
+            _touch(os.path.join(season_dir, f'{base}.ass'))
+    os.makedirs(os.path.join(folder, 'Sample'), exist_ok=True)
+    _touch(os.path.join(folder, 'Sample', 'sample.mkv'))
+    return folder
+
+
+def make_bdmv(root, streams=2000, name='Bench.Disc.2019.UHD.BluRay.2160p-GRP'):
+    """A BDMV disc with thousands of STREAM/CLIPINF/PLAYLIST entries."""
+    folder = os.path.join(root, name)
+    bdmv = os.path.join(folder, 'BDMV')
+    for sub in ('STREAM', 'CLIPINF', 'PLAYLIST', 'BACKUP/CLIPINF', 'BACKUP/PLAYLIST', 'META/DL', 'JAR', 'AUXDATA'):
+        os.makedirs(os.path.join(bdmv, sub), exist_ok=True)
+    for i in range(streams):
+        _touch(os.path.join(bdmv, 'STREAM', f'{i:05d}.m2ts'), 1024)
+        _touch(os.path.join(bdmv, 'CLIPINF', f'{i:05d}.clpi'))
+        _touch(os.path.join(bdmv, 'BACKUP', 'CLIPINF', f'{i:05d}.clpi'))
+    for i in range(max(1, streams // 20)):
+        _touch(os.path.join(bdmv, 'PLAYLIST', f'{i:05d}.mpls'))
+        _touch(os.path.join(bdmv, 'BACKUP', 'PLAYLIST', f'{i:05d}.mpls'))
+    _touch(os.path.join(bdmv, 'index.bdmv'))
+    _touch(os.path.join(bdmv, 'MovieObject.bdmv'))
+    os.makedirs(os.path.join(folder, 'CERTIFICATE'), exist_ok=True)
+    _touch(os.path.join(folder, 'CERTIFICATE', 'id.bdmv'))
+    return folder
+
+
+def make_deep(root, depth=12, fanout=3, files=4, name='Bench.Deep.Collection.S01'):
+    """A deeply nested collection: `depth` levels, `fanout` dirs per level on the main branch."""
+    folder = os.path.join(root, name)
+    current = folder
+    n = 0
+    for level in range(depth):
+        for f in range(fanout):
+            side = os.path.join(current, f'Disc {level}-{f}')
+            os.makedirs(side, exist_ok=True)
+            for i in range(files):
+                n += 1
+                _touch(os.path.join(side, f'Bench.Deep.S01E{n:03d}.mkv'), 1024)
+        current = os.path.join(current, f'Level {level}')
+        os.makedirs(current, exist_ok=True)
+    return folder
+
+
+def generate_trees(root, scale=1):
+    """Creates every tree kind under root and returns {kind: path}."""
+    os.makedirs(root, exist_ok=True)
+    return {
+        'movie': make_movie(root),
+        'season_pack': make_season_pack(root, seasons=3, episodes=24 * scale),
+        'bdmv': make_bdmv(root, streams=2000 * scale),
+        'deep': make_deep(root, depth=12, fanout=3, files=4 * scale),
+    }
+
+def release_names(episodes=2000):
+    """
+    Realistic TV release paths (relative to a download folder) for the classifier
+    micro-benchmark: season folders in several naming styles, nested extras and
+    episode files whose names do or do not carry the season.
+    """
+    show = 'Bench.Show.2008.Complete.1080p.BluRay.x265.10bit-GRP'
+    styles = ['S{s:02d}', 'Season {s}', 'Bench.Show.S{s:02d}.1080p.BluRay.x265-GRP', '第{s}季']
+    names = ['Bench.Show.S{s:02d}E{e:02d}.1080p.BluRay.x265-GRP.mkv',
+             'Bench Show - {s}x{e:02d} - Episode Title.mkv',
+             '[GRP] Bench Show - {e:02d} [1080p].mkv',
+             'Bench.Show.S{s:02d}.E{e:02d}.chs.ass']
+    paths = []
+    per_season = 50
+    for i in range(episodes):
+        s, e = i // per_season + 1, i % per_season + 1
+        folder = styles[s % len(styles)].format(s=s)
+        name = names[i % len(names)].format(s=s, e=e)
+        sub = 'Disc 1' if e <= per_season // 2 else 'Disc 2'
+        paths.append(os.path.join(show, folder, sub, name))
+    return show, paths
+
+
+def _classify_per_file(paths, tor_path, season_str, extract_season):
+    """The per-file season detection process_tv used before the batch classifier."""
+    import re
+    base_dir = os.path.dirname(os.path.abspath(tor_path))
+    result = {}
+    for src_file in paths:
+        path_parts = os.path.relpath(os.path.abspath(src_file), base_dir).split(os.sep)
+        detected = None
+        for part in reversed(path_parts):
+            detected = extract_season(part)
+            if detected is not None:
+                break
+        if detected is not None:
+            result[src_file] = f"Season {detected:02d}"
+        else:
+            match = re.search(r'\d+', str(season_str))
+            result[src_file] = f"Season {int(match.group()) if match else 1:02d}"
+    return result
+
+
+def bench_classifier(repeat, episodes=2000):
+    """Micro-benchmark: per-file regex season detection vs the memoized batch classifier."""
+    import re
+    import rcp_classify
+
+    def extract_season(text):
+        match = re.search(r'S(\d{1,3})|Season[\s._]*(\d{1,3})', text, re.IGNORECASE)
+        return int(match.group(1) or match.group(2)) if match else None
+
+    root = os.path.join(tempfile.gettempdir(), 'rcp-bench-names')
+    show, rel_paths = release_names(episodes)
+    tor_path = os.path.join(root, show)
+    paths = [os.path.join(root, p) for p in rel_paths]
+
+    expected = _classify_per_file(paths, tor_path, '1', extract_season)
+    got = {p: a.season_dir for p, a in rcp_classify.classify_seasons(paths, tor_path, '1').items()}
+    if got != expected:
+        raise AssertionError("batch classifier disagrees with the per-file detection")
+
+    def cold_classify():
+        rcp_classify.season_of.cache_clear()
+        rcp_classify.episode_of.cache_clear()
+        rcp_classify.classify_seasons(paths, tor_path, '1')
+
+    return {
+        f'classify_per_file[{episodes}]': timed(
+            lambda: _classify_per_file(paths, tor_path, '1', extract_season), repeat),
+        f'classify_seasons[{episodes}]': timed(cold_classify, repeat),
+    }
+
+def _translate_linear(path, path_mapping):
+    """The previous path translation: every rule re-normalized and tried in turn, whole components only."""
+    for app_prefix, agent_prefix in path_mapping.items():
+        prefix = os.path.normpath(app_prefix)
+        normalized = os.path.normpath(path)
+        if normalized == prefix or normalized.startswith(prefix + os.sep):
+            return os.path.normpath(os.path.join(agent_prefix, os.path.relpath(normalized, prefix)))
+    return path
+
+
+def bench_path_mapping(repeat, rules=500, paths=5000):
+    """Micro-benchmark: linear scan over the mapping rules vs the compiled PathMapping trie."""
+    import rcp_pathmap
+
+    # Rules sorted longest first, like [path_mapping] used to be, with nested and sibling prefixes
+    mapping = {}
+    for i in range(rules):
+        mapping[f'/downloads/client{i % 50}/cat{i}'] = f'/mnt/pool{i % 7}/cat{i}'
+    for i in range(50):
+        mapping[f'/downloads/client{i}'] = f'/mnt/pool{i % 7}/client{i}'
+    mapping = dict(sorted(mapping.items(), key=lambda rule: len(rule[0]), reverse=True))
+    compiled = rcp_pathmap.PathMapping(mapping)
+    samples = [f'/downloads/client{i % 50}/cat{(i * 7) % (rules + 50)}/Release.{i}/file.mkv' for i in range(paths)]
+
+    expected = [_translate_linear(p, mapping) for p in samples]
+    if compiled.translate_many(samples) != expected:
+        raise AssertionError("compiled path mapping disagrees with the linear scan")
+
+    return {
+        f'path_mapping_linear[{rules}x{paths}]': timed(
+            lambda: [_translate_linear(p, mapping) for p in samples], repeat),
+        f'path_mapping_trie[{rules}x{paths}]': timed(lambda: compiled.translate_many(samples), repeat),
+        f'path_mapping_compile[{rules}]': timed(lambda: rcp_pathmap.PathMapping(mapping), repeat),
+    }
+
+# ---------------------------------------------------------------------------
+# Stub torll server
+# ---------------------------------------------------------------------------
+
+def stub_media_info(tor_path, torhash=None):
+    """Canned media_info: tv for names with season markers, movie otherwise."""
+    name = os.path.basename(os.path.normpath(tor_path or '')) or 'unknown'
+    key = hashlib.sha1((tor_path or '').encode('utf-8')).hexdigest()[:8]
+    is_tv = '.S0' in name or 'Season' in name
+    info = {
+        'tmdb_cat': 'tv' if is_tv else 'movie',
+        'tmdb_title': name.split('.')[1] if '.' in name else name,
+        'tmdb_year': 2020,
+        'emby_bracket': f'[tmdbid={int(key, 16) % 100000}]',
+        'emby_dir': f"{'TV' if is_tv else 'Movies'}/{name} ({key})",
+    }
+    if is_tv:
+        info['season'] = '1'
+    return info
+
+
+class StubTorllHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.calls += 1
+        if 'items' in payload:
+            body = [stub_media_info(i.get('tor_path'), i.get('torhash')) for i in payload['items']]
+        else:
+            body = stub_media_info(payload.get('tor_path'), payload.get('torhash'))
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_torll(port=0, latency=0.0):
+    """Starts the stub torll server in a background thread and returns it."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), StubTorllHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.calls = 0
+    threading.Thread(target=server.serve_forever, name='stub-torll', daemon=True).start()
+    return server
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+def write_bench_config(workdir, torll_port, extra=''):
+    library = os.path.join(workdir, 'library')
+    os.makedirs(library, exist_ok=True)
+    config_path = os.path.join(workdir, 'config.ini')
+    with open(config_path, 'w', encoding='utf-8') as f:
+        f.write(f"""[torll]
+url = http://127.0.0.1:{torll_port}/api/v1/torcp/info
+api_key = bench
+qbitname = bench
+batch_url = /api/v1/torcp/batch
+
+[emby]
+root_path = {library}
+
+[rcp_agent]
+port = 0
+unix_socket =
+
+[cache]
+enabled = false
+
+{extra}
+""")
+    return config_path, library
+
+
+def summarize(samples):
+    return {
+        'runs': len(samples),
+        'min': round(min(samples), 6),
+        'median': round(statistics.median(samples), 6),
+        'mean': round(statistics.mean(samples), 6),
+        'max': round(max(samples), 6),
+    }
+
+
+def timed(func, repeat, setup=None):
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _agent_roundtrip(port, payloads):
+    """POSTs every payload to /rcp/process concurrently and waits for all jobs to finish."""
+    def one(payload):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+        try:
+            conn.request('POST', '/rcp/process', body=json.dumps(payload), headers={'Content-Type': 'application/json'})
+            job_id = json.loads(conn.getresponse().read())['job_id']
+            while True:
+                conn.request('GET', f'/rcp/jobs/{job_id}')
+                status = json.loads(conn.getresponse().read())
+                if status['status'] in ('succeeded', 'failed'):
+                    return status['status']
+                time.sleep(0.01)
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=len(payloads)) as executor:
+        return list(executor.map(one, payloads))
+
+
+def run_benchmarks(args):
+    workdir = tempfile.mkdtemp(prefix='rcp-bench-')
+    stub = start_stub_torll(latency=args.latency)
+    config_path, library = write_bench_config(workdir, stub.server_address[1])
+    os.environ['RCP_CONFIG'] = config_path
+
+    import rcp_core
+    import rcp_agent
+    from rcp_jobs import JobQueue
+
+    trees = generate_trees(os.path.join(workdir, 'downloads'), scale=args.scale)
+    config = rcp_core.load_config()
+
+    def clean_library():
+        shutil.rmtree(library, ignore_errors=True)
+        os.makedirs(library)
+
+    results = {}
+    for kind, path in trees.items():
+        logging.info(f"Benchmarking {kind} ...")
+        torhash = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        media_info = stub_media_info(path, torhash)
+        results[f'run_rcp_process[{kind}]'] = timed(
+            lambda: rcp_core.run_rcp_process(path, torhash), args.repeat, clean_library)
+        results[f'execute_hardlinking[{kind}]'] = timed(
+            lambda: rcp_core.execute_hardlinking(config, media_info, path, torhash), args.repeat, clean_library)
+        results[f'plan_hardlinking[{kind}]'] = timed(
+            lambda: rcp_core.plan_hardlinking(config, media_info, path), args.repeat)
+
+    bdmv = trees['bdmv']
+    results['link_dir_recursive[bdmv]'] = timed(
+        lambda: rcp_core.link_dir_recursive(os.path.join(bdmv, 'BDMV'), os.path.join(library, 'BDMV')),
+        args.repeat, clean_library)
+
+    items = [{'tor_path': p, 'torhash': hashlib.sha1(p.encode('utf-8')).hexdigest()} for p in trees.values()]
+    results['run_rcp_batch[all]'] = timed(lambda: rcp_core.run_rcp_batch(items), args.repeat, clean_library)
+    results.update(bench_classifier(args.repeat))
+    results.update(bench_path_mapping(args.repeat))
+
+    # Agent endpoints under concurrency
+    jobs = JobQueue(workers=config['agent_workers'])
+    jobs.start()
+    class QuietHandler(rcp_agent.RcpRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    httpd = rcp_agent.RcpAgentServer(('127.0.0.1', 0), QuietHandler)
+    httpd.whitelist = []
+    httpd.jobs = jobs
+    threading.Thread(target=httpd.serve_forever, name='bench-agent', daemon=True).start()
+    try:
+        port = httpd.server_address[1]
+        payloads = [items[i % len(items)] for i in range(args.concurrency)]
+        results[f'agent_process[concurrency={args.concurrency}]'] = timed(
+            lambda: _agent_roundtrip(port, payloads), args.repeat, clean_library)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        jobs.shutdown()
+        stub.shutdown()
+
+    report = {
+        'commit': _git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {
+            'scale': args.scale, 'repeat': args.repeat, 'latency': args.latency,
+            'concurrency': args.concurrency,
+        },
+        'torll_calls': stub.calls,
+        'results': results,
+    }
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    else:
+        logging.info(f"Kept benchmark workspace at {workdir}")
+    return report
+
+
+def compare(old_path, new_path):
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    print(f"{'benchmark':<48} {'old':>10} {'new':>10} {'ratio':>8}")
+    for name, stats in new['results'].items():
+        before = old['results'].get(name)
+        if not before:
+            print(f"{name:<48} {'-':>10} {stats['median']:>10.4f} {'-':>8}")
+            continue
+        ratio = stats['median'] / before['median'] if before['median'] else float('inf')
+        print(f"{name:<48} {before['median']:>10.4f} {stats['median']:>10.4f} {ratio:>7.2f}x")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="rcp benchmark harness")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    gen = sub.add_parser('gen', help="Generate synthetic download trees")
+    gen.add_argument('dir')
+    gen.add_argument('--scale', type=int, default=1)
+
+    stub = sub.add_parser('stub', help="Run the stub torll server in the foreground")
+    stub.add_argument('--port', type=int, default=8000)
+    stub.add_argument('--latency', type=float, default=0.0, help="Seconds to wait before every answer")
+
+    run = sub.add_parser('run', help="Run all benchmarks and write JSON results")
+    run.add_argument('--output', '-o', default='bench_results.json')
+    run.add_argument('--scale', type=int, default=1)
+    run.add_argument('--repeat', type=int, default=5)
+    run.add_argument('--latency', type=float, default=0.0)
+    run.add_argument('--concurrency', type=int, default=16)
+    run.add_argument('--keep', action='store_true', help="Keep the temporary workspace")
+    run.add_argument('--quiet', action='store_true', help="Only log errors from rcp itself")
+
+    classify = sub.add_parser('classify', help="Run the season classifier micro-benchmark")
+    classify.add_argument('--episodes', type=int, default=2000)
+    classify.add_argument('--repeat', type=int, default=20)
+
+    pathmap = sub.add_parser('pathmap', help="Run the path mapping micro-benchmark")
+    pathmap.add_argument('--rules', type=int, default=500)
+    pathmap.add_argument('--paths', type=int, default=5000)
+    pathmap.add_argument('--repeat', type=int, default=20)
+
+    cmp_parser = sub.add_parser('compare', help="Compare two result files by median time")
+    cmp_parser.add_argument('old')
+    cmp_parser.add_argument('new')
+
+    args = parser.parse_args()
+    if args.command == 'gen':
+        for kind, path in generate_trees(args.dir, scale=args.scale).items():
+            print(f"{kind}: {path}")
+    elif args.command == 'stub':
+        server = start_stub_torll(args.port, args.latency)
+        logging.info(f"Stub torll listening on 127.0.0.1:{server.server_address[1]}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.command == 'run':
+        if args.quiet:
+            logging.getLogger().setLevel(logging.ERROR)
+        report = run_benchmarks(args)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        for name, stats in report['results'].items():
+            print(f"{name:<48} median {stats['median']:.4f}s  (min {stats['min']:.4f}s, {stats['runs']} runs)")
+        print(f"Results written to {args.output}")
+    elif args.command == 'classify':
+        for name, stats in bench_classifier(args.repeat, args.episodes).items():
+            print(f"{name:<48} median {stats['median']:.4f}s  (min {stats['min']:.4f}s, {stats['runs']} runs)")
+    elif args.command == 'pathmap':
+        for name, stats in bench_path_mapping(args.repeat, args.rules, args.paths).items():
+            print(f"{name:<48} median {stats['median']:.4f}s  (min {stats['min']:.4f}s, {stats['runs']} runs)")
+    elif args.command == 'compare':
+        compare(args.old, args.new)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
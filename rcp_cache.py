@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class MediaInfoCache:
+    """
+    On-disk cache of torll media info, keyed by (torhash, tor_path).
+    Entries expire after `ttl` seconds; when more than `max_entries` are stored,
+    the least recently used ones are evicted.
+
+    Entries stored by a prefetch (before the torrent has finished downloading)
+    expire after `prefetch_ttl` instead, so torrents that never complete do not
+    linger. The first regular lookup promotes them to ordinary entries.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_entries=5000, prefetch_ttl=2 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prefetch_ttl = prefetch_ttl
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS media_info ("
+                " torhash TEXT NOT NULL,"
+                " tor_path TEXT NOT NULL,"
+                " info TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL,"
+                " PRIMARY KEY (torhash, tor_path))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_media_info_accessed ON media_info (accessed_at)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(media_info)")}
+            if 'prefetched' not in columns:
+                conn.execute("ALTER TABLE media_info ADD COLUMN prefetched INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, torhash, tor_path, promote=True):
+        """
+        Returns the cached media info, or None if missing or expired.
+        A prefetched entry for torhash also matches when the download has moved
+        to a different tor_path since (e.g. out of an incomplete-downloads folder).
+        With promote, a prefetched entry becomes a regular one under tor_path.
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT tor_path, info, created_at, prefetched FROM media_info"
+                " WHERE torhash = ? AND (tor_path = ? OR prefetched = 1)"
+                " ORDER BY tor_path = ? DESC LIMIT 1",
+                (torhash, tor_path, tor_path),
+            ).fetchone()
+            if row is None:
+                return None
+            stored_path, info, created_at, prefetched = row
+            if now - created_at > (self.prefetch_ttl if prefetched else self.ttl):
+                conn.execute("DELETE FROM media_info WHERE torhash = ? AND tor_path = ?", (torhash, stored_path))
+                return None
+            if prefetched and promote:
+                conn.execute(
+                    "UPDATE media_info SET tor_path = ?, prefetched = 0, created_at = ?, accessed_at = ?"
+                    " WHERE torhash = ? AND tor_path = ?",
+                    (tor_path, now, now, torhash, stored_path),
+                )
+            else:
+                conn.execute(
+                    "UPDATE media_info SET accessed_at = ? WHERE torhash = ? AND tor_path = ?",
+                    (now, torhash, stored_path),
+                )
+        return json.loads(info)
+
+    def find_by_path(self, tor_path):
+        """
+        Returns (torhash, media_info) of a processed (not just prefetched) entry
+        for tor_path, or None. Used to redo torrents whose links went missing.
+        """
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT torhash, info, created_at FROM media_info"
+                " WHERE tor_path = ? AND prefetched = 0 ORDER BY accessed_at DESC LIMIT 1",
+                (tor_path,),
+            ).fetchone()
+        if row is None or time.time() - row[2] > self.ttl:
+            return None
+        return row[0], json.loads(row[1])
+
+    def put(self, torhash, tor_path, media_info, prefetched=False):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO media_info (torhash, tor_path, info, created_at, accessed_at, prefetched)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (torhash, tor_path, json.dumps(media_info, ensure_ascii=False), now, now, int(prefetched)),
+            )
+            self._evict(conn, now)
+
+    def purge_expired(self):
+        """Removes expired entries, including prefetches for torrents that never completed."""
+        with self._lock, self._connect() as conn:
+            self._evict(conn, time.time())
+
+    def invalidate(self, torhash=None, tor_path=None):
+        """Drops every entry matching torhash or tor_path. Returns the number removed."""
+        if not torhash and not tor_path:
+            return 0
+        with self._lock, self._connect() as conn:
+            cur = conn.execute(
+                "DELETE FROM media_info WHERE torhash = ? OR tor_path = ?",
+                (torhash or '', tor_path or ''),
+            )
+            removed = cur.rowcount
+        if removed:
+            logging.info(f"Invalidated {removed} cached media info entr(ies) for hash={torhash}, path={tor_path}")
+        return removed
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM media_info WHERE created_at < ?", (now - self.ttl,))
+        conn.execute("DELETE FROM media_info WHERE prefetched = 1 AND created_at < ?", (now - self.prefetch_ttl,))
+        count = conn.execute("SELECT COUNT(*) FROM media_info").fetchone()[0]
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM media_info WHERE rowid IN ("
+                " SELECT rowid FROM media_info ORDER BY accessed_at ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# 匹配 S01, Season 01, Season.01, S1 等
+SEASON_RE = re.compile(r'S(\d{1,3})|Season[\s._]*(\d{1,3})', re.IGNORECASE)
+# 匹配 S01E02, S01.E02, EP02, E02, 第02集 等
+EPISODE_RE = re.compile(
+    r'S\d{1,3}[\s._-]?E(\d{1,4})|(?<![A-Za-z0-9])EP?(\d{1,4})(?!\d)|第(\d{1,4})[集话話]',
+    re.IGNORECASE,
+)
+_NUMBER_RE = re.compile(r'\d+')
+
+UNKNOWN_SEASON_DIR = 'Season unknown01'
+
+SeasonAssignment = namedtuple('SeasonAssignment', ['season_dir', 'season', 'episode'])
+
+
+@lru_cache(maxsize=8192)
+def season_of(name):
+    """从单个文件名或目录名中提取季号，没有时返回 None"""
+    if not name:
+        return None
+    match = SEASON_RE.search(name)
+    if match:
+        return int(match.group(1) or match.group(2))
+    return None
+
+
+@lru_cache(maxsize=8192)
+def episode_of(name):
+    """从文件名中提取集号，没有时返回 None"""
+    if not name:
+        return None
+    match = EPISODE_RE.search(name)
+    if match:
+        return int(next(g for g in match.groups() if g is not None))
+    return None
+
+
+def fallback_season_dir(season_str):
+    """
+    API 返回的建议季号（可能是 "1"、"[1,2]" 等格式）对应的季文件夹名；
+    没有建议季号时返回 None。
+    """
+    if not season_str:
+        return None
+    try:
+        first_num_match = _NUMBER_RE.search(str(season_str))
+        season_num = int(first_num_match.group()) if first_num_match else 1
+        return f"Season {season_num:02d}"
+    except (ValueError, TypeError):
+        return str(season_str)
+
+
+class SeasonClassifier:
+    """
+    Assigns season folders to the files of one torrent.
+
+    The season is taken from the file name, or else from the nearest enclosing
+    directory (up to and including the torrent folder) whose name has one. Each
+    directory is resolved once and memoized, so a pack with thousands of episodes
+    in a handful of folders parses each folder name only once.
+    """
+
+    def __init__(self, tor_path, fallback_season=None):
+        source_abs = os.path.abspath(tor_path)
+        # 包含种子文件夹名本身在内的回溯基础
+        self.base_dir = os.path.dirname(source_abs)
+        self.fallback_dir = fallback_season_dir(fallback_season)
+        self.unknown = 0
+        self._dir_seasons = {self.base_dir: None}
+
+    def _dir_season(self, directory):
+        season = self._dir_seasons.get(directory, -1)
+        if season != -1:
+            return season
+        parent = os.path.dirname(directory)
+        if parent == directory or not directory.startswith(self.base_dir):
+            season = None
+        else:
+            season = season_of(os.path.basename(directory))
+            if season is None:
+                season = self._dir_season(parent)
+        self._dir_seasons[directory] = season
+        return season
+
+    def classify(self, path):
+        src_abs = os.path.abspath(path)
+        name = os.path.basename(src_abs)
+        season = season_of(name)
+        if season is None:
+            season = self._dir_season(os.path.dirname(src_abs))
+
+        if season is not None:
+            season_dir = f"Season {season:02d}"
+        elif self.fallback_dir is not None:
+            # 回退逻辑：使用 API 返回的建议季号
+            season_dir = self.fallback_dir
+        else:
+            self.unknown += 1
+            season_dir = UNKNOWN_SEASON_DIR
+        return SeasonAssignment(season_dir, season, episode_of(name))
+
+
+def classify_seasons(paths, tor_path, fallback_season=None):
+    """
+    Classifies a torrent's discovered files in one pass.
+    Returns {path: SeasonAssignment} in the order of paths.
+    """
+    classifier = SeasonClassifier(tor_path, fallback_season)
+    assignments = {path: classifier.classify(path) for path in paths}
+    if classifier.unknown:
+        logging.warning(f"{classifier.unknown} 个文件未识别到季特征，且API无季号返回，使用 '{UNKNOWN_SEASON_DIR}'")
+    return assignments
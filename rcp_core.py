@@ -1,26 +1,76 @@
 # -*- coding: utf-8 -*-
 import configparser
-import json
 import os
-import urllib.request
-import urllib.error
 import logging
-import re
-from collections import defaultdict
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from urllib.parse import urljoin, urlsplit
 import shutil
+from rcp_cache import MediaInfoCache
+from rcp_classify import classify_seasons, season_of
+from rcp_torll import get_torll_client
+from rcp_fsops import FsOps, parse_strategies
+from rcp_linker import LinkEngine, LinkPlanner
+from rcp_journal import PlanProgress, get_plan_journal, journal_key
+from rcp_manifest import LinkManifest
+from rcp_pathmap import PathMapping, compile_mapping
+from rcp_metrics import STAGE_SECONDS, MEDIA_INFO_CACHE
+from rcp_trash import get_trash, only_contains
 
 # This is the core logic, designed to be imported.
 
 # 从torcp.py借鉴的视频文件扩展名列表
-VIDEO_EXTS = ['.mkv', '.mp4', '.ts', '.m2ts', '.mov', '.avi', '.wmv', '.strm', '.iso', '.ass', '.srt']
+VIDEO_EXTS = frozenset(['.mkv', '.mp4', '.ts', '.m2ts', '.mov', '.avi', '.wmv', '.strm', '.iso', '.ass', '.srt'])
+# 字幕文件体积很小，不受 min_size 限制
+SUBTITLE_EXTS = frozenset(['.ass', '.srt'])
+# 默认跳过的目录（不区分大小写）
+DEFAULT_PRUNE_DIRS = ('Sample', 'Extras', '.unwanted')
+
+def _section(config, name):
+    """Returns the named section, or the (empty) DEFAULT section if it is missing."""
+    return config[name] if name in config else config[configparser.DEFAULTSECT]
+
+def get_config_path():
+    """config.ini next to this file, unless overridden by the RCP_CONFIG environment variable."""
+    return os.environ.get('RCP_CONFIG') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+
+def _config_dir():
+    return os.path.dirname(os.path.abspath(get_config_path()))
+
+def _resolve_path(path):
+    """Resolves a path from config.ini relative to the directory holding config.ini."""
+    return os.path.join(_config_dir(), os.path.expanduser(path))
+
+_config_cache = {}
+_config_lock = threading.Lock()
 
 def load_config():
-    """加载配置文件"""
-    config_path = os.path.join(os.path.dirname(__file__), 'config.ini')
-    if not os.path.exists(config_path):
+    """
+    加载配置文件。The parsed config is cached and only read again when
+    config.ini's mtime or size changes, so edits take effect without a restart.
+    """
+    config_path = get_config_path()
+    try:
+        st = os.stat(config_path)
+    except FileNotFoundError:
         logging.error(f"配置文件 {config_path} 不存在。请参考 config.ini.template 创建。")
         raise FileNotFoundError(f"Config file not found at {config_path}")
-    
+
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _config_lock:
+        cached = _config_cache.get(config_path)
+        if cached is None or cached[0] != stamp:
+            if cached is not None:
+                logging.info(f"配置文件已修改，重新加载: {config_path}")
+            cached = _config_cache[config_path] = (stamp, _read_config(config_path))
+    # Callers get their own copy of the top-level dict
+    return dict(cached[1])
+
+def _read_config(config_path):
     config = configparser.ConfigParser()
     config.read(config_path)
     
@@ -28,16 +78,23 @@ def load_config():
         torll_config = config['torll']
         emby_config = config['emby']
         
-        path_mapping = {}
-        if 'path_mapping' in config:
-            # Sort path_mapping keys by length in descending order to ensure longest prefix match
-            # This is important for paths like /downloads and /downloads/movies
-            sorted_keys = sorted(config['path_mapping'].keys(), key=len, reverse=True)
-            for key in sorted_keys:
-                path_mapping[key] = config['path_mapping'][key]
+        # Compiled once per load; the longest matching prefix wins regardless of order
+        path_mapping = PathMapping(config['path_mapping'].items() if 'path_mapping' in config else ())
         
-        
-        rcp_agent_config = config['rcp_agent'] if 'rcp_agent' in config else {}
+        rcp_agent_config = _section(config, 'rcp_agent')
+        cache_config = _section(config, 'cache')
+        batch_config = _section(config, 'batch')
+        link_config = _section(config, 'link')
+        discovery_config = _section(config, 'discovery')
+        manifest_config = _section(config, 'manifest')
+        scheduler_config = _section(config, 'scheduler')
+        reconcile_config = _section(config, 'reconcile')
+        spool_config = _section(config, 'spool')
+        trash_config = _section(config, 'trash')
+        journal_config = _section(config, 'journal')
+        watch_config = _section(config, 'watch')
+        download_paths = [p.strip() for p in reconcile_config.get('download_paths', '').split(',') if p.strip()]
+        unix_socket = rcp_agent_config.get('unix_socket', 'rcp_agent.sock').strip()
 
         return {
             'url': torll_config['url'],
@@ -45,40 +102,159 @@ def load_config():
             'root_path': emby_config['root_path'],
             'qbitname': torll_config['qbitname'],
             'path_mapping': path_mapping,
+            'batch_url': torll_config.get('batch_url', '').strip(),
+            'batch_workers': batch_config.getint('workers', 4),
+            'link_workers': link_config.getint('workers', 8),
+            'link_strategies': parse_strategies(link_config.get('strategies', 'hardlink')),
+            'copy_workers': link_config.getint('copy_workers', 2),
+            'prune_dirs': [d.strip() for d in discovery_config.get('prune_dirs', ','.join(DEFAULT_PRUNE_DIRS)).split(',') if d.strip()],
+            'min_size': discovery_config.getint('min_size', 0),
+            'manifest_enabled': manifest_config.getboolean('enabled', True),
+            'manifest_path': _resolve_path(manifest_config.get('path', 'link_manifest.db')),
+            'torll_pool_size': torll_config.getint('pool_size', 4),
+            'torll_connect_timeout': torll_config.getfloat('connect_timeout', 5.0),
+            'torll_read_timeout': torll_config.getfloat('read_timeout', 120.0),
+            'torll_max_retries': torll_config.getint('max_retries', 3),
+            'torll_backoff_base': torll_config.getfloat('backoff_base', 0.5),
+            'torll_backoff_max': torll_config.getfloat('backoff_max', 10.0),
+            'torll_breaker_threshold': torll_config.getint('breaker_threshold', 5),
+            'torll_breaker_reset': torll_config.getfloat('breaker_reset', 60.0),
             'agent_port': rcp_agent_config.getint('port', 6008),
             'whitelist_ips': [ip.strip() for ip in rcp_agent_config.get('whitelist_ips', '').split(',') if ip.strip()],
+            'agent_workers': rcp_agent_config.getint('workers', 4),
+            'job_history': rcp_agent_config.getint('job_history', 1000),
+            'agent_unix_socket': _resolve_path(unix_socket) if unix_socket else None,
+            'cache_enabled': cache_config.getboolean('enabled', True),
+            'cache_path': _resolve_path(cache_config.get('path', 'media_cache.db')),
+            'cache_ttl': cache_config.getint('ttl', 7 * 24 * 3600),
+            'cache_max_entries': cache_config.getint('max_entries', 5000),
+            'cache_prefetch_ttl': cache_config.getint('prefetch_ttl', 2 * 24 * 3600),
+            'scheduler_device_limit': scheduler_config.getint('device_limit', 2),
+            'scheduler_device_limits': scheduler_config.get('device_limits', '').strip(),
+            'scheduler_priority': scheduler_config.get('priority', 'small_first').strip(),
+            'scheduler_aging': scheduler_config.getint('aging', 300),
+            'reconcile_index_path': _resolve_path(reconcile_config.get('index_path', 'reconcile_index.db')),
+            # Without explicit download paths, the agent-side targets of the path mapping are used
+            'reconcile_download_paths': download_paths or sorted(set(path_mapping.values())),
+            'reconcile_batch_size': reconcile_config.getint('batch_size', 500),
+            'reconcile_remove_stale': reconcile_config.getboolean('remove_stale', False),
+            'spool_mode': spool_config.get('mode', 'off').strip(),
+            'spool_path': _resolve_path(spool_config.get('path', 'spool')),
+            'spool_batch_size': spool_config.getint('batch_size', 20),
+            'spool_poll_interval': spool_config.getfloat('poll_interval', 2.0),
+            'spool_max_attempts': spool_config.getint('max_attempts', 8),
+            'spool_retry_base': spool_config.getfloat('retry_base', 30.0),
+            'spool_retry_max': spool_config.getfloat('retry_max', 3600.0),
+            'trash_enabled': trash_config.getboolean('enabled', True),
+            'trash_dir_name': trash_config.get('dir_name', '.rcp-trash').strip(),
+            'trash_workers': trash_config.getint('workers', 4),
+            'trash_rate': trash_config.getint('rate', 200),
+            'trash_interval': trash_config.getfloat('interval', 30.0),
+            'journal_enabled': journal_config.getboolean('enabled', True),
+            'journal_path': _resolve_path(journal_config.get('path', 'journal')),
+            'journal_checkpoint_every': journal_config.getint('checkpoint_every', 200),
+            # Without explicit watch paths, the download paths of [reconcile] are watched
+            'watch_paths': [p.strip() for p in watch_config.get('paths', '').split(',') if p.strip()],
+            'watch_mode': watch_config.get('mode', 'auto').strip(),
+            'watch_quiet': watch_config.getfloat('quiet', 60.0),
+            'watch_marker': watch_config.get('marker', '').strip(),
+            'watch_incomplete_suffixes': tuple(s.strip() for s in watch_config.get('incomplete_suffixes', '.!qB,.part,.crdownload').split(',') if s.strip()),
+            'watch_poll_interval': watch_config.getfloat('poll_interval', 30.0),
+            'watch_index_path': _resolve_path(watch_config.get('index_path', 'watch_index.db')),
+            'watch_process_existing': watch_config.getboolean('process_existing', False),
         }
     except KeyError as e:
         logging.error(f"配置文件中缺少必要的键: {e}")
         raise KeyError(f"Missing required key in config: {e}")
 
+_timings_local = threading.local()
+
+@contextmanager
+def stage_timer(stage):
+    """Times a processing stage into the rcp_stage_seconds histogram and the current collector."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_stage(stage, time.perf_counter() - start)
+
+def _record_stage(stage, elapsed):
+    STAGE_SECONDS.observe(elapsed, stage=stage)
+    timings = getattr(_timings_local, 'timings', None)
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + elapsed
+
+@contextmanager
+def collect_stage_timings():
+    """Collects the per-stage seconds of the work done in this thread into the yielded dict."""
+    previous = getattr(_timings_local, 'timings', None)
+    timings = {}
+    _timings_local.timings = timings
+    try:
+        yield timings
+    finally:
+        _timings_local.timings = previous
+
+_progress_local = threading.local()
+
+@contextmanager
+def collect_progress(callback):
+    """Sends the progress events of the work done in this thread to callback(event, **fields)."""
+    previous = getattr(_progress_local, 'callback', None)
+    _progress_local.callback = callback
+    try:
+        yield
+    finally:
+        _progress_local.callback = previous
+
+def progress_callback():
+    """This thread's progress callback (or None), for work handed to other threads."""
+    return getattr(_progress_local, 'callback', None)
+
+def report_progress(event, **fields):
+    callback = progress_callback()
+    if callback is not None:
+        callback(event, **fields)
+
+def _timed_iter(stage, iterable):
+    """Yields from iterable, timing only the time spent producing items."""
+    elapsed = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        _record_stage(stage, elapsed)
+
+def format_stage_timings(timings):
+    return ', '.join(f"{stage}={seconds:.3f}s" for stage, seconds in timings.items())
+
 def translate_path_to_agent_path(path: str, path_mapping: dict) -> str:
     """
     Translates a path from the main application's perspective to the rcp_agent's perspective
-    using the provided path mapping rules.
-    """
-    for app_path_prefix, agent_path_prefix in path_mapping.items():
-        # Ensure that paths are treated as directories for os.path.relpath
-        # so that /a matches /a/b but not /abc
-        normalized_app_path_prefix = os.path.normpath(app_path_prefix)
-        normalized_path = os.path.normpath(path)
-
-        if normalized_path.startswith(normalized_app_path_prefix):
-            # Calculate the relative path from the app_path_prefix
-            relative_path = os.path.relpath(normalized_path, normalized_app_path_prefix)
-            # Join with the agent_path_prefix to get the translated path
-            translated_path = os.path.join(agent_path_prefix, relative_path)
-            logging.debug(f"Translated path '{path}' to '{translated_path}' using mapping '{app_path_prefix}' -> '{agent_path_prefix}'")
-            return translated_path
-    logging.debug(f"No path mapping found for path '{path}', returning original path.")
-    return path
+    using the provided path mapping rules. Prefixes match whole path components only,
+    so /downloads matches /downloads/x but not /downloads2/x.
+    """
+    translated_path = compile_mapping(path_mapping).to_agent(path)
+    logging.debug(f"Translated path '{path}' to '{translated_path}'")
+    return translated_path
+
+def translate_path_to_app_path(path: str, path_mapping: dict) -> str:
+    """
+    The inverse of translate_path_to_agent_path: translates a path seen by the
+    rcp_agent back to the main application's perspective.
+    """
+    return compile_mapping(path_mapping).to_app(path)
 
 def get_media_info(config, torhash, dl_uuid, tor_path, torname=None):
     """向torll3 API发送请求获取媒体信息"""
-    headers = {
-        'X-API-Key': config['api_key'],
-        'Content-Type': 'application/json'
-    }
     payload = {
         'qbitname': config['qbitname'],
         'torhash': torhash,
@@ -89,70 +265,243 @@ def get_media_info(config, torhash, dl_uuid, tor_path, torname=None):
     
     logging.info(f"向 {config['url']} 发送请求...")
     
-    data = json.dumps(payload).encode('utf-8')
-    req = urllib.request.Request(config['url'], data=data, headers=headers, method='POST')
-    
     try:
-        with urllib.request.urlopen(req) as response:
-            if not (200 <= response.status < 300):
-                error_msg = f"请求torll API失败，状态码: {response.status}, 内容: {response.read().decode('utf-8')}"
-                logging.error(error_msg)
-                raise ConnectionError(error_msg)
-            
-            logging.info("成功获取API响应。")
-            response_body = response.read().decode('utf-8')
-            return json.loads(response_body)
-            
-    except urllib.error.HTTPError as e:
-        error_content = e.read().decode('utf-8', 'ignore')
-        error_msg = f"请求torll API时发生HTTP错误: {e}, 内容: {error_content}"
-        logging.error(error_msg)
-        raise ConnectionError(error_msg) from e
-    except urllib.error.URLError as e:
-        error_msg = f"请求torll API时发生URL错误: {e.reason}"
-        logging.error(error_msg)
-        raise ConnectionError(error_msg) from e
+        with stage_timer('get_media_info'):
+            media_info = get_torll_client(config).post_json(payload)
+        logging.info("成功获取API响应。")
+        return media_info
+    except ConnectionError as e:
+        logging.error(str(e))
+        raise
     except Exception as e:
         logging.error(f"处理请求时发生未知错误: {e}")
         raise
 
+def get_media_info_batch(config, entries):
+    """
+    通过torll批量接口一次获取多个种子的媒体信息。
+    entries 为 (torhash, dl_uuid, tor_path, torname) 列表，返回与之一一对应的媒体信息列表。
+    """
+    payload = {
+        'qbitname': config['qbitname'],
+        'items': [
+            {'torhash': torhash, 'dl_uuid': dl_uuid, 'torname': torname, 'tor_path': tor_path}
+            for torhash, dl_uuid, tor_path, torname in entries
+        ],
+    }
+    batch_url = urljoin(config['url'], config['batch_url'])
+    logging.info(f"向 {batch_url} 发送批量请求，共 {len(entries)} 项...")
+    parts = urlsplit(batch_url)
+    with stage_timer('get_media_info'):
+        if parts[:2] == urlsplit(config['url'])[:2]:
+            # Same server as [torll] url: reuse its pooled connections
+            path = parts.path + ('?' + parts.query if parts.query else '')
+            response = get_torll_client(config).post_json(payload, path=path)
+        else:
+            response = get_torll_client(config, batch_url).post_json(payload)
+    results = response.get('items') if isinstance(response, dict) else response
+    if not isinstance(results, list) or len(results) != len(entries):
+        raise ValueError("torll批量接口返回的结果数量与请求不符。")
+    return results
+
+_media_caches = {}
+_media_caches_lock = threading.Lock()
+
+def get_media_cache(config):
+    """Returns the shared MediaInfoCache for this config, or None if caching is disabled."""
+    if not config.get('cache_enabled'):
+        return None
+    path = config['cache_path']
+    with _media_caches_lock:
+        cache = _media_caches.get(path)
+        if cache is None:
+            cache = MediaInfoCache(path, ttl=config['cache_ttl'], max_entries=config['cache_max_entries'],
+                                   prefetch_ttl=config['cache_prefetch_ttl'])
+            _media_caches[path] = cache
+        else:
+            cache.ttl = config['cache_ttl']
+            cache.max_entries = config['cache_max_entries']
+            cache.prefetch_ttl = config['cache_prefetch_ttl']
+        return cache
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def get_link_manifest(config):
+    """Returns the shared LinkManifest for this config, or None if the manifest is disabled."""
+    if not config.get('manifest_enabled'):
+        return None
+    path = config['manifest_path']
+    with _manifests_lock:
+        manifest = _manifests.get(path)
+        if manifest is None:
+            manifest = LinkManifest(path)
+            _manifests[path] = manifest
+        return manifest
+
+def resolve_media_info(config, torhash, dl_uuid, tor_path, torname=None):
+    """获取媒体信息，优先使用本地缓存，未命中时请求torll API并写入缓存"""
+    # The cache is keyed by torhash; without one torll is always asked
+    cache = get_media_cache(config) if torhash else None
+    if cache is not None:
+        try:
+            media_info = cache.get(torhash, tor_path)
+        except Exception as e:
+            logging.warning(f"读取媒体信息缓存失败: {e}")
+            media_info = None
+        if media_info is not None:
+            MEDIA_INFO_CACHE.inc(result='hit')
+            logging.info(f"媒体信息缓存命中: {torhash}")
+            return media_info
+        MEDIA_INFO_CACHE.inc(result='miss')
+
+    media_info = get_media_info(config, torhash, dl_uuid, tor_path, torname)
+
+    if cache is not None and media_info:
+        try:
+            cache.put(torhash, tor_path, media_info)
+        except Exception as e:
+            logging.warning(f"写入媒体信息缓存失败: {e}")
+    return media_info
+
+def resolve_media_info_batch(config, entries):
+    """
+    批量获取媒体信息。先查本地缓存；未命中的项在配置了 batch_url 时通过批量接口一次获取，
+    否则（或批量接口失败时）并发逐个请求。
+    返回与 entries 一一对应的列表，元素为媒体信息或获取失败时的异常对象。
+    """
+    results = [None] * len(entries)
+    cache = get_media_cache(config)
+    missing = []
+    for i, (torhash, _, tor_path, _) in enumerate(entries):
+        if cache is not None:
+            try:
+                results[i] = cache.get(torhash, tor_path)
+            except Exception as e:
+                logging.warning(f"读取媒体信息缓存失败: {e}")
+        if results[i] is None:
+            missing.append(i)
+        if cache is not None:
+            MEDIA_INFO_CACHE.inc(result='miss' if results[i] is None else 'hit')
+
+    if missing:
+        logging.info(f"批量处理: {len(entries) - len(missing)} 项命中缓存，{len(missing)} 项需请求torll。")
+
+    fetched = None
+    if missing and config.get('batch_url'):
+        try:
+            fetched = get_media_info_batch(config, [entries[i] for i in missing])
+        except Exception as e:
+            logging.warning(f"torll批量接口请求失败，改为逐个请求: {e}")
+
+    if missing and fetched is None:
+        def fetch_one(i):
+            try:
+                return get_media_info(config, *entries[i])
+            except Exception as e:
+                return e
+        with ThreadPoolExecutor(max_workers=config.get('batch_workers', 4)) as executor:
+            fetched = list(executor.map(fetch_one, missing))
+
+    for i, media_info in zip(missing, fetched or []):
+        results[i] = media_info
+        if cache is not None and media_info and not isinstance(media_info, Exception):
+            torhash, _, tor_path, _ = entries[i]
+            try:
+                cache.put(torhash, tor_path, media_info)
+            except Exception as e:
+                logging.warning(f"写入媒体信息缓存失败: {e}")
+    return results
+
+MediaFile = namedtuple('MediaFile', ['path', 'stat'])
+
+def iter_media_files(source_path, prune_dirs=DEFAULT_PRUNE_DIRS, min_size=0):
+    """
+    逐个产出源路径下的媒体文件（MediaFile: path, stat），边扫描边返回。
+    名称在 prune_dirs 中的目录（不区分大小写）整体跳过；
+    小于 min_size 字节的视频文件（字幕除外）被忽略。
+    """
+    pruned = frozenset(d.lower() for d in prune_dirs)
+    stack = [source_path]
+    while stack:
+        current = stack.pop()
+        subdirs = []
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if entry.name.lower() in pruned:
+                            logging.info(f"跳过目录: {entry.path}")
+                        else:
+                            subdirs.append(entry.path)
+                        continue
+                    ext = os.path.splitext(entry.name)[1].lower()
+                    if ext not in VIDEO_EXTS:
+                        continue
+                    st = entry.stat()
+                    if min_size and st.st_size < min_size and ext not in SUBTITLE_EXTS:
+                        logging.info(f"跳过过小的文件: {entry.path}")
+                        continue
+                    yield MediaFile(entry.path, st)
+        except OSError as e:
+            logging.error(f"读取目录失败: {current}: {e}")
+        # 逆序入栈，保证子目录按列出顺序处理
+        stack.extend(reversed(subdirs))
+
+def discover_media_files(config, source_path):
+    """按配置中的过滤规则查找媒体文件（生成器）"""
+    return _timed_iter('discovery', iter_media_files(
+        source_path,
+        prune_dirs=config.get('prune_dirs', DEFAULT_PRUNE_DIRS),
+        min_size=config.get('min_size', 0),
+    ))
+
 def find_media_files(source_path):
     """在源路径中查找媒体文件"""
-    media_files = []
-    for root, _, files in os.walk(source_path):
-        for file in files:
-            if os.path.splitext(file)[1].lower() in VIDEO_EXTS:
-                media_files.append(os.path.join(root, file))
-    return media_files
+    return [f.path for f in iter_media_files(source_path)]
 
-def create_hard_link(src, dst):
+def create_hard_link(src, dst, fs=None):
     """创建硬链接，如果目标已存在则跳过"""
     try:
-        if os.path.exists(dst):
-            logging.warning(f"目标文件已存在，跳过链接: {dst}")
-            return
-        os.link(src, dst)
-        logging.info(f"成功链接: {src} -> {dst}")
+        if (fs or FsOps()).link(src, dst):
+            logging.info(f"成功链接: {src} -> {dst}")
+        else:
+            logging.info(f"已链接，跳过: {dst}")
+    except FileExistsError:
+        logging.warning(f"目标文件已存在，跳过链接: {dst}")
     except OSError as e:
         logging.error(f"创建硬链接失败: {e}")
     except Exception as e:
         logging.error(f"发生未知错误: {e}")
 
-def link_dir_recursive(src, dst):
+def link_engine_options(config):
+    """LinkEngine keyword arguments from the [link] section."""
+    config = config or {}
+    return {
+        'workers': config.get('link_workers', 8),
+        'strategies': config.get('link_strategies', ('hardlink',)),
+        'copy_workers': config.get('copy_workers', 2),
+    }
+
+@contextmanager
+def _link_engine(config, engine=None):
+    """Yields the caller's LinkEngine, or a new one that is drained on exit."""
+    if engine is not None:
+        yield engine
+        return
+    with LinkEngine(progress=progress_callback(), **link_engine_options(config)) as engine:
+        yield engine
+
+def link_dir_recursive(src, dst, engine=None):
     """
     Recursively creates hard links for all files from src directory to dst directory,
     recreating the directory structure.
     """
-    os.makedirs(dst, exist_ok=True)
-    for item in os.listdir(src):
-        src_path = os.path.join(src, item)
-        dst_path = os.path.join(dst, item)
-        if os.path.isdir(src_path):
-            link_dir_recursive(src_path, dst_path)
-        else:
-            create_hard_link(src_path, dst_path)
+    with _link_engine(None, engine) as engine:
+        engine.link_tree(src, dst)
+    return engine.stats
 
-def generate_movie_links(target_dir, media_files, media_info):
+def generate_movie_links(target_dir, media_files, media_info, engine=None):
     """
     根据媒体信息，为电影文件（包括关联字幕）生成并创建硬链接。
     处理文件名过长和多文件冲突的问题。
@@ -161,6 +510,11 @@ def generate_movie_links(target_dir, media_files, media_info):
         logging.warning(f"未找到任何媒体文件进行链接。")
         return
 
+    with _link_engine(None, engine) as engine:
+        _generate_movie_links(target_dir, media_files, media_info, engine)
+
+def _generate_movie_links(target_dir, media_files, media_info, engine):
+
     file_groups = defaultdict(list)
     for f in media_files:
         base_name = os.path.splitext(os.path.basename(f))[0]
@@ -187,192 +541,463 @@ def generate_movie_links(target_dir, media_files, media_info):
         for src_file in files_in_group:
             _, file_ext = os.path.splitext(src_file)
             dst_file = os.path.join(target_dir, f"{final_dst_base}{file_ext}")
-            create_hard_link(src_file, dst_file)
+            engine.link(src_file, dst_file)
 
-def process_movie(config, media_info, tor_path):
+def process_movie(config, media_info, tor_path, engine=None):
     """处理电影类别"""
+    with _link_engine(config, engine) as engine:
+        _process_movie(config, media_info, tor_path, engine)
+    return engine.stats
+
+def _process_movie(config, media_info, tor_path, engine):
     emby_root = config['root_path']
     emby_dir = media_info['emby_dir']
     target_dir = os.path.join(emby_root, emby_dir)
     
     logging.info(f"创建电影目录: {target_dir}")
-    os.makedirs(target_dir, exist_ok=True)
+    engine.ensure_dir(target_dir)
     
+    fs = engine.fs
     # 检查是否为BDMV原盘结构
-    if os.path.isdir(tor_path):
+    if fs.isdir(tor_path):
         bdmv_path = os.path.join(tor_path, 'BDMV')
-        if os.path.isdir(bdmv_path):
+        if fs.isdir(bdmv_path):
             logging.info("检测到 BDMV 目录结构，将进行目录链接。")
-            link_dir_recursive(bdmv_path, os.path.join(target_dir, 'BDMV'))
+            engine.link_tree(bdmv_path, os.path.join(target_dir, 'BDMV'))
             
             # 同时链接CERTIFICATE目录（如果存在）
             certificate_path = os.path.join(tor_path, 'CERTIFICATE')
-            if os.path.isdir(certificate_path):
+            if fs.isdir(certificate_path):
                 logging.info("检测到 CERTIFICATE 目录，进行链接。")
-                link_dir_recursive(certificate_path, os.path.join(target_dir, 'CERTIFICATE'))
+                engine.link_tree(certificate_path, os.path.join(target_dir, 'CERTIFICATE'))
             return  # 原盘处理完成
 
     # 如果不是原盘，则回退到原有的文件链接逻辑
     media_files = []
-    if os.path.isfile(tor_path):
+    if fs.isfile(tor_path):
         if os.path.splitext(tor_path)[1].lower() in VIDEO_EXTS:
             media_files.append(tor_path)
-    elif os.path.isdir(tor_path):
-        media_files = find_media_files(tor_path)
+    elif fs.isdir(tor_path):
+        for f in discover_media_files(config, tor_path):
+            fs.remember(f.path, f.stat)
+            media_files.append(f.path)
 
+    report_progress('discovered', files=len(media_files))
     if not media_files:
         logging.warning(f"在 {tor_path} 中未找到媒体文件或BDMV结构。")
         return
 
-    generate_movie_links(target_dir, media_files, media_info)
+    _generate_movie_links(target_dir, media_files, media_info, engine)
 
 def extract_season(text):
     """从文本中提取季号"""
-    if not text:
-        return None
-    # 匹配 S01, Season 01, Season.01, S1 等
-    match = re.search(r'S(\d{1,3})|Season[\s._]*(\d{1,3})', text, re.IGNORECASE)
-    if match:
-        return int(match.group(1) or match.group(2))
-    return None
+    return season_of(text)
 
-def process_tv(config, media_info, tor_path):
+def process_tv(config, media_info, tor_path, engine=None):
     """处理电视剧类别"""
+    with _link_engine(config, engine) as engine:
+        _process_tv(config, media_info, tor_path, engine)
+    return engine.stats
+
+def _process_tv(config, media_info, tor_path, engine):
     emby_root = config['root_path']
     emby_dir = media_info['emby_dir']
     target_dir = os.path.join(emby_root, emby_dir)
     
     logging.info(f"创建电视剧目录: {target_dir}")
-    os.makedirs(target_dir, exist_ok=True)
+    engine.ensure_dir(target_dir)
 
     # 1. 递归查找所有媒体文件
-    if os.path.isfile(tor_path):
-        media_files = [tor_path]
+    if engine.fs.isfile(tor_path):
+        media_files = [MediaFile(tor_path, engine.fs.stat(tor_path))]
     else:
-        media_files = find_media_files(tor_path)
+        media_files = list(discover_media_files(config, tor_path))
 
+    report_progress('discovered', files=len(media_files))
     if not media_files:
         logging.warning(f"在 {tor_path} 中未找到媒体文件。")
         return
 
-    # 获取种子根目录的绝对路径，用于计算回溯深度
-    source_abs = os.path.abspath(tor_path)
-    # 包含种子文件夹名本身在内的回溯基础
-    base_dir = os.path.dirname(source_abs)
+    # 2. 一次性为所有文件确定季文件夹（每个目录只解析一次）
+    with stage_timer('classify'):
+        seasons = classify_seasons([f.path for f in media_files], tor_path, media_info.get('season'))
 
-    for src_file in media_files:
-        src_abs = os.path.abspath(src_file)
-        # 计算相对于种子父目录的路径部分
-        relative_path = os.path.relpath(src_abs, base_dir)
-        path_parts = relative_path.split(os.sep)
-        
-        detected_season = None
-        # 2. 从文件名开始向上级目录逐级识别季号
-        for part in reversed(path_parts):
-            season_num = extract_season(part)
-            if season_num is not None:
-                detected_season = season_num
-                break
-        
-        # 3. 确定最终季文件夹名
-        if detected_season is not None:
-            season_dir_name = f"Season {detected_season:02d}"
-        else:
-            # 回退逻辑：使用 API 返回的建议季号
-            season_str = media_info.get('season')
-            if not season_str:
-                logging.warning(f"文件 {os.path.basename(src_file)} 未识别到季特征，且API无季号返回，使用 'Season unknown01'")
-                season_dir_name = "Season unknown01"
-            else:
-                try:
-                    # 处理可能的 [1,2] 或 "1" 等格式
-                    first_num_match = re.search(r'\d+', str(season_str))
-                    season_num = int(first_num_match.group()) if first_num_match else 1
-                    season_dir_name = f"Season {season_num:02d}"
-                except (ValueError, TypeError):
-                    season_dir_name = str(season_str)
-        
-        season_target_dir = os.path.join(target_dir, season_dir_name)
-        os.makedirs(season_target_dir, exist_ok=True)
-        
-        dst_file = os.path.join(season_target_dir, os.path.basename(src_file))
-        create_hard_link(src_file, dst_file)
+    # 3. 按季文件夹链接
+    for media_file in media_files:
+        season_target_dir = os.path.join(target_dir, seasons[media_file.path].season_dir)
+        dst_file = os.path.join(season_target_dir, os.path.basename(media_file.path))
+        engine.link(media_file.path, dst_file, media_file.stat)
 
 def run_rcp_process(tor_path, torhash, dl_uuid=None, torname=None):
     """
     The main process logic, callable as a function.
+    torhash may be None for a download found by watch mode; torll then has to
+    identify it by torname.
+    Returns the link counts reported by execute_hardlinking.
     """
-    logging.info(f"--- rcp_core process started for hash: {torhash} ---")
+    logging.info(f"--- rcp_core process started for hash: {torhash or torname} ---")
     
-    if not tor_path or not torhash:
-        raise ValueError("错误：必须提供 tor_path 和 torhash。")
+    if not tor_path or not (torhash or torname):
+        raise ValueError("错误：必须提供 tor_path 和 torhash（或 torname）。")
 
     config = load_config()
     
     # Translate tor_path from app's perspective to agent's perspective
-    translated_tor_path = translate_path_to_agent_path(tor_path, config.get('path_mapping', {}))
+    with stage_timer('translate_path_to_agent_path'):
+        translated_tor_path = translate_path_to_agent_path(tor_path, config.get('path_mapping', {}))
     logging.info(f"Original tor_path: {tor_path}, Translated tor_path: {translated_tor_path}")
     
-    media_info = get_media_info(config, torhash, dl_uuid, translated_tor_path, torname)
+    media_info = resolve_media_info(config, torhash, dl_uuid, translated_tor_path, torname)
+    report_progress('media_info', tmdb_cat=media_info.get('tmdb_cat'), tmdb_title=media_info.get('tmdb_title'),
+                    tmdb_year=media_info.get('tmdb_year'), emby_dir=media_info.get('emby_dir'))
     
-    execute_hardlinking(config, media_info, translated_tor_path)
+    stats = execute_hardlinking(config, media_info, translated_tor_path, torhash)
         
     logging.info("--- rcp_core process finished. ---")
+    return stats
+
+def run_rcp_prefetch(tor_path, torhash, dl_uuid=None, torname=None):
+    """
+    Resolves and caches the media info of a torrent that is still downloading,
+    so that processing it on completion only has to link files.
+    The entry is kept as a prefetch (see MediaInfoCache) until it is used.
+    Returns {'cached': bool, 'already_cached': bool}.
+    """
+    logging.info(f"--- rcp_core prefetch started for hash: {torhash} ---")
+
+    if not tor_path or not torhash:
+        raise ValueError("错误：必须提供 tor_path 和 torhash。")
+
+    config = load_config()
+    cache = get_media_cache(config)
+    if cache is None:
+        logging.warning("媒体信息缓存未启用，预取无效。")
+        return {'cached': False, 'already_cached': False}
 
+    with stage_timer('translate_path_to_agent_path'):
+        translated_tor_path = translate_path_to_agent_path(tor_path, config.get('path_mapping', {}))
 
-def delete_links(config, rel_path):
+    if cache.get(torhash, translated_tor_path, promote=False) is not None:
+        logging.info(f"媒体信息已在缓存中: {torhash}")
+        return {'cached': True, 'already_cached': True}
+
+    media_info = get_media_info(config, torhash, dl_uuid, translated_tor_path, torname)
+    if not media_info or 'tmdb_cat' not in media_info:
+        # Not identified yet; processing on completion will ask torll again
+        logging.warning(f"预取的媒体信息不完整，不写入缓存: {torhash}")
+        return {'cached': False, 'already_cached': False}
+
+    cache.put(torhash, translated_tor_path, media_info, prefetched=True)
+    logging.info(f"--- rcp_core prefetch finished for hash: {torhash} ---")
+    return {'cached': True, 'already_cached': False}
+
+def run_rcp_batch(items):
+    """
+    Processes many torrents at once: config is loaded once, media info is resolved
+    for all items together, and linking runs concurrently.
+    Each item is a dict with tor_path, torhash and optional dl_uuid / torname.
+    Returns one result dict per item, in the same order.
+    """
+    logging.info(f"--- rcp_core batch started with {len(items)} item(s) ---")
+    config = load_config()
+    path_mapping = compile_mapping(config.get('path_mapping'))
+
+    results = []
+    valid = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append({'torhash': None, 'tor_path': None, 'status': 'error',
+                            'message': 'Item must be a JSON object'})
+            continue
+        tor_path = item.get('tor_path')
+        torhash = item.get('torhash')
+        results.append({'torhash': torhash, 'tor_path': tor_path})
+        if not tor_path or not torhash:
+            results[i].update(status='error', message='Missing tor_path or torhash')
+            continue
+        valid.append(i)
+
+    with stage_timer('translate_path_to_agent_path'):
+        translated = path_mapping.translate_many([items[i]['tor_path'] for i in valid])
+    entries = [(items[i]['torhash'], items[i].get('dl_uuid'), translated_tor_path, items[i].get('torname'))
+               for i, translated_tor_path in zip(valid, translated)]
+
+    media_infos = resolve_media_info_batch(config, entries) if entries else []
+
+    def link_one(entry, media_info):
+        if isinstance(media_info, Exception):
+            raise media_info
+        return execute_hardlinking(config, media_info, entry[2], entry[0])
+
+    with ThreadPoolExecutor(max_workers=config.get('batch_workers', 4)) as executor:
+        futures = [
+            (i, executor.submit(link_one, entry, media_info))
+            for i, entry, media_info in zip(valid, entries, media_infos)
+        ]
+        for i, future in futures:
+            try:
+                stats = future.result()
+                results[i].update(status='success', message='Process completed successfully.', links=stats)
+            except Exception as e:
+                logging.error(f"批量处理 {results[i]['torhash']} 失败: {e}", exc_info=True)
+                results[i].update(status='error', message=str(e))
+
+    failed = sum(1 for r in results if r['status'] != 'success')
+    logging.info(f"--- rcp_core batch finished: {len(results) - failed} succeeded, {failed} failed. ---")
+    return results
+
+
+def _prune_empty_dirs(paths, stop_at, within=None):
+    """
+    Removes the given directories and their parents while they are empty. Neither
+    stop_at nor its direct children (the category folders) are ever removed, and
+    with within only that directory and what lies below it are.
+    """
+    stop_at = os.path.normpath(stop_at)
+    within = os.path.normpath(within) if within else None
+    seen = set()
+    for d in sorted(set(paths), key=len, reverse=True):
+        d = os.path.normpath(d)
+        while d.startswith(stop_at + os.sep) and os.path.dirname(d) != stop_at and d not in seen:
+            if within and d != within and not d.startswith(within + os.sep):
+                break
+            seen.add(d)
+            try:
+                os.rmdir(d)
+            except FileNotFoundError:
+                # Already gone (e.g. moved to the trash); its parent may be empty now
+                pass
+            except OSError:
+                break
+            d = os.path.dirname(d)
+
+def _unlink_records(records):
+    """Unlinks the destinations of manifest records. Returns (removed, dsts handled)."""
+    removed = 0
+    handled = []
+    for _, _, _, _, dst in records:
+        try:
+            os.unlink(dst)
+            removed += 1
+            handled.append(dst)
+        except FileNotFoundError:
+            handled.append(dst)
+        except OSError as e:
+            logging.error(f"Failed to remove link {dst}: {e}")
+    return removed, handled
+
+def _trash_whole_dir(config, dsts, full_path=None):
+    """
+    Moves the folder holding dsts (full_path, or else their common folder) to the
+    trash in one rename when it contains nothing but those files. Returns the
+    number of files moved, or None if the folder has to be emptied file by file.
+    """
+    trash = get_trash(config)
+    if trash is None or not dsts:
+        return None
+    root_path = os.path.normpath(config['root_path'])
+    top = full_path or os.path.commonpath(dsts)
+    if os.path.normpath(top) == root_path or not os.path.isdir(top) or not only_contains(top, dsts):
+        return None
+    moved = sum(1 for dst in dsts if os.path.lexists(dst))
+    if trash.move(top) is None:
+        return None
+    return moved
+
+def delete_links(config, rel_path=None, torhash=None):
     """Safely deletes old hardlinks.
     It constructs the full path from the root_path in config and the relative path.
+    When the link manifest knows which links rcp created (by torhash, or below rel_path),
+    exactly those are unlinked; otherwise the whole rel_path is removed as before.
+    A folder that holds nothing else is moved to the trash (see rcp_trash) in one
+    rename instead, and emptied later by the reaper.
+    Returns a dict with the number of entries removed and the mode used.
     """
-    if not rel_path:
+    with stage_timer('delete_links'):
+        return _delete_links(config, rel_path, torhash)
+
+def _delete_links(config, rel_path=None, torhash=None):
+    """Performs the deletion; see delete_links."""
+    if not rel_path and not torhash:
         logging.warning("No relative path provided for deletion, skipping.")
-        return
+        return {'removed': 0, 'mode': 'none'}
 
     root_path = config.get('root_path')
     if not root_path:
         raise ValueError("root_path is not configured in config.ini")
 
-    full_path = os.path.join(root_path, rel_path)
-    
+    full_path = os.path.join(root_path, rel_path) if rel_path else None
+
+    manifest = get_link_manifest(config)
+    if manifest is not None:
+        records = manifest.links_for_torhash(torhash) if torhash else manifest.links_under(full_path)
+        if records:
+            dsts = [r[4] for r in records]
+            removed = _trash_whole_dir(config, dsts, full_path)
+            if removed is not None:
+                handled = dsts
+            else:
+                removed, handled = _unlink_records(records)
+            manifest.forget(handled)
+            _prune_empty_dirs([os.path.dirname(r[4]) for r in records] + ([full_path] if full_path else []), root_path, full_path)
+            trash = get_trash(config)
+            if trash is not None:
+                trash.reap_unattended()
+            logging.info(f"Removed {removed} link(s) recorded in manifest for {torhash or full_path}")
+            return {'removed': removed, 'mode': 'manifest'}
+        if not full_path:
+            logging.warning(f"No links recorded in manifest for hash {torhash}, nothing to delete.")
+            return {'removed': 0, 'mode': 'manifest'}
+        logging.info(f"No manifest records under {full_path}, falling back to removing the whole path.")
+
     if not os.path.exists(full_path):
         logging.warning(f"Old path does not exist, skipping deletion: {full_path}")
-        return
+        return {'removed': 0, 'mode': 'tree'}
 
+    removed = 0
+    trash = get_trash(config)
     try:
-        if os.path.isdir(full_path):
+        if trash is not None and trash.move(full_path) is not None:
+            removed = 1
+            trash.reap_unattended()
+        elif os.path.isdir(full_path):
             logging.info(f"Removing old directory: {full_path}")
             shutil.rmtree(full_path)
+            removed = 1
         elif os.path.isfile(full_path):
             logging.info(f"Removing old file: {full_path}")
             os.remove(full_path)
+            removed = 1
         else:
             logging.warning(f"Old path is not a file or directory, cannot delete: {full_path}")
     except Exception as e:
         logging.error(f"Failed to delete old path {full_path}: {e}", exc_info=True)
         # We don't re-raise, as failing to delete old links might not be a critical error
+    if manifest is not None:
+        manifest.forget_under(full_path)
+    return {'removed': removed, 'mode': 'tree'}
 
-def execute_hardlinking(config, media_info, tor_path):
-    """
-    Executes the hardlinking process using provided media_info.
-    """
+def _resolve_tor_full_path(media_info, tor_path, fs=None):
+    """校验媒体信息并确定最终处理路径"""
     if not media_info or 'tmdb_cat' not in media_info:
         raise ValueError("获取的媒体信息无效或不完整。")
-        
-    tmdb_cat = media_info['tmdb_cat']
+    if media_info['tmdb_cat'] not in ('movie', 'tv'):
+        raise ValueError(f"不支持的媒体类别: {media_info['tmdb_cat']}")
 
     # The original downloaded content path might be a file or a directory
     # For movies, it could be a single file. For TV shows, it's often a directory.
     # The `torpath` from media_info might specify a sub-path within the download directory.
     tor_full_path = tor_path 
-    if os.path.isdir(tor_path) and media_info.get('torpath') and not tor_path.endswith(media_info['torpath']):
+    is_dir = fs.isdir(tor_path) if fs is not None else os.path.isdir(tor_path)
+    if is_dir and media_info.get('torpath') and not tor_path.endswith(media_info['torpath']):
         tor_full_path = os.path.join(tor_path, media_info['torpath'])
     
     logging.info(f"最终处理路径: {tor_full_path}")
+    return tor_full_path
 
-    if tmdb_cat == 'movie':
-        process_movie(config, media_info, tor_full_path)
-    elif tmdb_cat == 'tv':
-        process_tv(config, media_info, tor_full_path)
+def _dispatch(config, media_info, tor_full_path, engine):
+    if media_info['tmdb_cat'] == 'movie':
+        process_movie(config, media_info, tor_full_path, engine)
     else:
-        raise ValueError(f"不支持的媒体类别: {tmdb_cat}")
+        process_tv(config, media_info, tor_full_path, engine)
+
+def plan_hardlinking(config, media_info, tor_path):
+    """
+    Computes the links execute_hardlinking would create, without touching the filesystem.
+    Returns a list of (src, dst) pairs.
+    """
+    fs = FsOps()
+    tor_full_path = _resolve_tor_full_path(media_info, tor_path, fs)
+    planner = LinkPlanner(fs)
+    _dispatch(config, media_info, tor_full_path, planner)
+    return planner.links
 
+def execute_hardlinking(config, media_info, tor_path, torhash=None):
+    """
+    Executes the hardlinking process using provided media_info.
+    The link plan is computed first and written to the plan journal, then
+    carried out with periodic checkpoints (see rcp_journal), so an interrupted
+    job can be resumed with resume_plan. An unfinished plan with the same
+    links is continued from its checkpoint. Plans with no more links than
+    [journal] checkpoint_every are not journaled.
+    Created links are recorded in the link manifest under torhash.
+    Returns a dict with the number of links created, already linked, skipped
+    and failed, plus the filesystem syscalls the job issued ('syscalls').
+    """
+    fs = FsOps()
+    tor_full_path = _resolve_tor_full_path(media_info, tor_path, fs)
+
+    with stage_timer(f"process_{media_info['tmdb_cat']}"):
+        planner = LinkPlanner(fs, progress=progress_callback())
+        _dispatch(config, media_info, tor_full_path, planner)
+        entry = None
+        journal = get_plan_journal(config)
+        # A plan shorter than one checkpoint would only ever restart from zero
+        if journal is not None and len(planner.links) > config['journal_checkpoint_every']:
+            entry = journal.begin(journal_key(torhash, tor_path), {
+                'torhash': torhash,
+                'tor_path': tor_path,
+                'media_info': media_info,
+                'dirs': planner.dirs,
+                'links': planner.links,
+            })
+        return _run_plan(config, planner.dirs, planner.links, torhash, fs, entry, planner.stats.failed)
+
+def resume_plan(config, entry):
+    """Carries out the rest of an interrupted journaled plan. Returns the link stats."""
+    plan = entry.plan
+    logging.info(f"继续执行未完成的链接计划: {plan.get('tor_path')} ({entry.done}/{len(entry.links)})")
+    with stage_timer(f"process_{(plan.get('media_info') or {}).get('tmdb_cat', 'resume')}"):
+        return _run_plan(config, entry.dirs, entry.links, plan.get('torhash'), entry=entry)
+
+def _run_plan(config, dirs, links, torhash, fs=None, entry=None, failed=0):
+    """
+    Creates dirs and links (from links[entry.done] on when resuming a journal
+    entry), recording finished links in the manifest at every checkpoint.
+    """
+    fs = fs or FsOps()
+    manifest = get_link_manifest(config)
+    try:
+        with LinkEngine(track=manifest is not None, fs=fs, progress=progress_callback(),
+                        **link_engine_options(config)) as engine:
+            def record():
+                if manifest is not None:
+                    manifest.record(torhash, engine.take_created())
+
+            progress = None
+            if entry is not None:
+                progress = PlanProgress(entry, config['journal_checkpoint_every'], record)
+            for d in dirs:
+                engine.ensure_dir(d)
+            for i in range(entry.done if entry is not None else 0, len(links)):
+                src, dst = links[i]
+                engine.link(src, dst, done=partial(progress.mark, i) if progress is not None else None)
+
+        record()
+    except BaseException:
+        if entry is not None:
+            # Left in the journal, to be resumed by the next agent start
+            entry.release()
+        raise
+    if entry is not None:
+        entry.finish()
+
+    # Folders that could not be read while planning
+    engine.stats.failed += failed
+    stats = engine.stats.to_dict()
+    stats['syscalls'] = fs.to_dict()
+    logging.info(f"链接完成: {engine.stats}, syscalls: {stats['syscalls']}")
+    return stats
+
+def run_rcp_plan(tor_path, torhash, dl_uuid=None, torname=None):
+    """
+    Resolves the media info and computes the link plan of a torrent without
+    creating anything in the library. Returns {'media_info', 'dirs', 'links'}.
+    """
+    config = load_config()
+    translated_tor_path = translate_path_to_agent_path(tor_path, config.get('path_mapping', {}))
+    media_info = resolve_media_info(config, torhash, dl_uuid, translated_tor_path, torname)
+    fs = FsOps()
+    planner = LinkPlanner(fs)
+    _dispatch(config, media_info, _resolve_tor_full_path(media_info, translated_tor_path, fs), planner)
+    return {'media_info': media_info, 'dirs': planner.dirs, 'links': planner.links}
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import errno
+import logging
+import os
+import shutil
+import stat
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+_MISSING = object()
+
+# Ways to place a download file into the library, in the order they are usually tried
+LINK_STRATEGIES = ('hardlink', 'reflink', 'copy', 'symlink')
+# Strategies that duplicate data and may take long for large files
+COPY_STRATEGIES = ('copy',)
+
+# FICLONE from linux/fs.h: share the extents of another file (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# errno values meaning "this strategy cannot work for this pair of paths, try the next one"
+FALLBACK_ERRNOS = frozenset(
+    e for e in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', None),
+                errno.ENOTTY, errno.EINVAL, errno.ENOSYS)
+    if e is not None
+)
+
+COPY_CHUNK = 64 * 1024 * 1024
+
+
+def is_fallback_error(error):
+    return isinstance(error, OSError) and error.errno in FALLBACK_ERRNOS
+
+
+def parse_strategies(spec):
+    """Parses a comma separated strategy chain, e.g. 'hardlink,reflink,copy'."""
+    chain = tuple(s.strip().lower() for s in spec.split(',') if s.strip())
+    unknown = [s for s in chain if s not in LINK_STRATEGIES]
+    if unknown:
+        raise ValueError(f"Unknown link strategies {unknown}, expected some of {LINK_STRATEGIES}")
+    return chain or ('hardlink',)
+
+
+class FsOps:
+    """
+    The filesystem calls of one job, with per-job caches.
+
+    Stat results (including "does not exist") are cached by path and directories
+    created through makedirs are remembered, so repeated checks on the same
+    paths cost one syscall per job. Every syscall actually issued is counted in
+    `counts` (by call name) so the savings can be checked on large packs.
+    Thread-safe: the link engine calls link() from its pool threads.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._stats = {}
+        self._dirs = set()
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def remember(self, path, st):
+        """Seeds the stat cache, e.g. with the stat os.scandir already produced."""
+        if st is not None:
+            self._stats[path] = st
+
+    def stat(self, path):
+        """os.stat through the cache; returns None if path does not exist."""
+        st = self._stats.get(path, _MISSING)
+        if st is _MISSING:
+            self._count('stat')
+            try:
+                st = os.stat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                st = None
+            self._stats[path] = st
+        return st
+
+    def isdir(self, path):
+        st = self.stat(path)
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+    def isfile(self, path):
+        st = self.stat(path)
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    def makedirs(self, path):
+        """os.makedirs(path, exist_ok=True), issued at most once per directory per job."""
+        with self._lock:
+            if path in self._dirs:
+                return
+        self._count('makedirs')
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._dirs.add(path)
+
+    def link(self, src, dst):
+        """
+        Hard links src to dst. Returns True if the link was created, False if dst
+        already is a link to src (same device and inode). Raises FileExistsError
+        if dst exists but is a different file.
+        """
+        return self.place(src, dst, ('hardlink',))[1]
+
+    def place(self, src, dst, strategies=('hardlink',), progress=None):
+        """
+        Puts src at dst with the first strategy of the chain that works here.
+        A strategy failing with one of FALLBACK_ERRNOS (e.g. EXDEV for a hard link
+        across filesystems) moves on to the next one; other errors are raised.
+        Returns (strategy, created); created is False if dst already held src,
+        in which case strategy tells how it was placed back then. Raises
+        FileExistsError if dst is a different file, or the last fallback error
+        if no strategy worked. progress(copied, total) is called during copies.
+        """
+        last_error = None
+        for strategy in strategies:
+            try:
+                getattr(self, f'_place_{strategy}')(src, dst, progress)
+            except FileExistsError:
+                placed = self._already_placed(src, dst)
+                if placed is not None:
+                    return placed, False
+                raise
+            except OSError as e:
+                if not is_fallback_error(e):
+                    raise
+                logging.debug(f"{strategy} 不可用: {dst}: {e}")
+                last_error = e
+                continue
+            self._stats.pop(dst, None)
+            return strategy, True
+        if last_error is None:
+            raise ValueError("No link strategy given")
+        raise last_error
+
+    def _already_placed(self, src, dst):
+        """
+        Tells whether dst already is src: the same inode ('hardlink'), a symlink
+        to it ('symlink') or a copy with the same size and mtime ('copy').
+        Returns that strategy, or None if dst is a different file.
+        """
+        self._count('lstat')
+        dst_st = os.lstat(dst)
+        if stat.S_ISLNK(dst_st.st_mode):
+            return 'symlink' if os.readlink(dst) == src else None
+        # Same check as os.path.samefile, reusing the cached stat of src
+        src_st = self.stat(src)
+        if src_st is None:
+            return None
+        if (src_st.st_dev, src_st.st_ino) == (dst_st.st_dev, dst_st.st_ino):
+            return 'hardlink'
+        if (stat.S_ISREG(dst_st.st_mode) and dst_st.st_size == src_st.st_size
+                and dst_st.st_mtime_ns == src_st.st_mtime_ns):
+            return 'copy'
+        return None
+
+    def _place_hardlink(self, src, dst, progress):
+        self._count('link')
+        os.link(src, dst)
+
+    def _place_symlink(self, src, dst, progress):
+        self._count('symlink')
+        os.symlink(src, dst)
+
+    def _place_reflink(self, src, dst, progress):
+        if fcntl is None:
+            raise OSError(errno.EOPNOTSUPP, "reflink is not supported on this platform", dst)
+        self._count('reflink')
+        self._write_via_tmp(src, dst, lambda src_fd, dst_fd, size: fcntl.ioctl(dst_fd, FICLONE, src_fd))
+
+    def _place_copy(self, src, dst, progress):
+        self._count('copy')
+        self._write_via_tmp(src, dst, lambda src_fd, dst_fd, size: _copy_in_kernel(src_fd, dst_fd, size, progress))
+
+    def _write_via_tmp(self, src, dst, fill):
+        """
+        Fills a temporary file next to dst and links it into place, so dst never
+        appears half written and an existing dst is reported as FileExistsError.
+        """
+        self._count('lstat')
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        tmp = os.path.join(os.path.dirname(dst), f'.rcp-tmp-{uuid.uuid4().hex}')
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'xb') as fdst:
+                fill(fsrc.fileno(), fdst.fileno(), os.fstat(fsrc.fileno()).st_size)
+            # Keep the source mtime so the copy is recognised as already placed next time
+            shutil.copystat(src, tmp)
+            try:
+                os.link(tmp, dst)
+            except OSError as e:
+                if not is_fallback_error(e):
+                    raise
+                # Filesystem without hard links: rename, after the existence check above
+                os.rename(tmp, dst)
+        finally:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+
+    def to_dict(self):
+        with self._lock:
+            counts = dict(self.counts)
+        counts['total'] = sum(counts.values())
+        return counts
+
+
+def _copy_in_kernel(src_fd, dst_fd, size, progress=None):
+    """
+    Copies size bytes without passing them through user space: copy_file_range
+    where the kernel supports it for this pair of files, otherwise sendfile.
+    """
+    copied = 0
+    use_copy_file_range = hasattr(os, 'copy_file_range')
+    while copied < size:
+        count = min(COPY_CHUNK, size - copied)
+        if use_copy_file_range:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, count, copied, copied)
+            except OSError as e:
+                if not is_fallback_error(e):
+                    raise
+                use_copy_file_range = False
+                continue
+        else:
+            os.lseek(dst_fd, copied, os.SEEK_SET)
+            n = os.sendfile(dst_fd, src_fd, copied, count)
+        if n == 0:
+            break
+        copied += n
+        if progress is not None:
+            progress(copied, size)
+    if copied != size:
+        raise OSError(errno.EIO, f"Short copy: {copied} of {size} bytes")
+    return copied
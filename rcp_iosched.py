@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+
+PRIORITY_SMALL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LARGE = 2
+
+
+class DeviceScheduler:
+    """
+    Bounds how many jobs touch each filesystem (st_dev) at once.
+    A job holds one slot on every device it reads from or writes to; it may only
+    start when all of those devices have a free slot. Not thread-safe on its own:
+    callers serialize access (JobQueue does so under its lock).
+    """
+
+    def __init__(self, default_limit=2, limits=None):
+        self.default_limit = max(1, int(default_limit))
+        self.limits = dict(limits or {})
+        self._active = {}
+
+    def limit_for(self, dev):
+        return self.limits.get(dev, self.default_limit)
+
+    def try_acquire(self, devices):
+        if any(self._active.get(dev, 0) >= self.limit_for(dev) for dev in devices):
+            return False
+        for dev in devices:
+            self._active[dev] = self._active.get(dev, 0) + 1
+        return True
+
+    def release(self, devices):
+        for dev in devices:
+            remaining = self._active.get(dev, 0) - 1
+            if remaining > 0:
+                self._active[dev] = remaining
+            else:
+                self._active.pop(dev, None)
+
+    def active(self):
+        return dict(self._active)
+
+
+def device_of(path):
+    """st_dev of path, or of its nearest existing ancestor; None if nothing can be stat'ed."""
+    while path:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+    return None
+
+
+def parse_device_limits(spec):
+    """Parses 'path:limit, path:limit' into {st_dev: limit}."""
+    limits = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        path, sep, limit = item.rpartition(':')
+        if not sep or not path:
+            logging.warning(f"Ignoring malformed device limit: {item}")
+            continue
+        dev = device_of(path.strip())
+        if dev is None:
+            logging.warning(f"Ignoring device limit for unknown path: {path}")
+            continue
+        try:
+            limit = int(limit)
+        except ValueError:
+            logging.warning(f"Ignoring device limit that is not a number: {item}")
+            continue
+        if limit < 1:
+            # A limit below 1 would never admit a job on the device
+            logging.warning(f"Device limit for {path} raised to 1: {item}")
+            limit = 1
+        limits[dev] = limit
+    return limits
+
+
+def job_devices(*paths):
+    """The set of devices the given source/target paths live on."""
+    return frozenset(dev for dev in (device_of(p) for p in paths if p) if dev is not None)
+
+
+def estimate_priority(tor_path, policy='small_first'):
+    """
+    Cheap size class for a download: single files first, plain directories next,
+    BDMV discs last. With policy 'fifo' every job has the same priority.
+    """
+    if policy != 'small_first':
+        return PRIORITY_NORMAL
+    if os.path.isfile(tor_path):
+        return PRIORITY_SMALL
+    if os.path.isdir(os.path.join(tor_path, 'BDMV')):
+        return PRIORITY_LARGE
+    return PRIORITY_NORMAL
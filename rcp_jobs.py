@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Job states reported by GET /rcp/jobs/<id>
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+_current = threading.local()
+
+
+def current_job():
+    """The Job being run by this worker thread, or None."""
+    return getattr(_current, 'job', None)
+
+
+class Job:
+    """
+    A unit of work submitted to the agent's job queue.
+    While it runs, the work can emit() progress events; they are kept in
+    `events` so streaming clients (also ones that attached late) get all of them.
+    """
+
+    def __init__(self, kind, payload, func, key=None, priority=0, devices=()):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.payload = payload
+        self.func = func
+        self.key = key
+        self.priority = priority
+        self.devices = frozenset(devices)
+        self.coalesced = 0
+        self.status = JOB_QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.events = []
+        self._events_changed = threading.Condition()
+        self._done = threading.Event()
+        self._callbacks = []
+
+    def emit(self, event, **fields):
+        """Appends a progress event. Safe to call from any thread."""
+        event = dict({'event': event, 'elapsed': round(time.time() - self.created_at, 3)}, **fields)
+        with self._events_changed:
+            self.events.append(event)
+            self._events_changed.notify_all()
+
+    def events_after(self, index, timeout=None):
+        """
+        Returns the events after the first index ones, waiting up to timeout
+        seconds for one if there are none yet and the job is still going.
+        """
+        with self._events_changed:
+            if len(self.events) <= index and not self.done:
+                self._events_changed.wait(timeout)
+            return self.events[index:]
+
+    def run(self):
+        self.status = JOB_RUNNING
+        self.started_at = time.time()
+        logging.info(f"Job {self.id} ({self.kind}) started.")
+        self.emit('started', queued_seconds=round(self.started_at - self.created_at, 3))
+        _current.job = self
+        try:
+            self.result = self.func()
+            self.status = JOB_SUCCEEDED
+            logging.info(f"Job {self.id} ({self.kind}) finished successfully.")
+        except Exception as e:
+            self.error = str(e)
+            self.status = JOB_FAILED
+            logging.error(f"Job {self.id} ({self.kind}) failed: {e}", exc_info=True)
+        finally:
+            _current.job = None
+            self.finished_at = time.time()
+            with self._events_changed:
+                self._done.set()
+                self._events_changed.notify_all()
+                callbacks, self._callbacks = self._callbacks, []
+            for callback in callbacks:
+                self._call(callback)
+
+    def add_done_callback(self, callback):
+        """
+        Calls callback(job) once the job has finished, from the worker thread,
+        or right away if it already has. Also works for a job that was returned
+        to a coalesced request.
+        """
+        with self._events_changed:
+            if not self.done:
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            logging.error(f"Done callback of job {self.id} failed: {e}", exc_info=True)
+
+    def wait(self, timeout=None):
+        """Blocks until the job has finished. Returns True if it did within timeout."""
+        return self._done.wait(timeout)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def to_dict(self):
+        queued_seconds = None
+        run_seconds = None
+        if self.started_at is not None:
+            queued_seconds = round(self.started_at - self.created_at, 3)
+        if self.started_at is not None and self.finished_at is not None:
+            run_seconds = round(self.finished_at - self.started_at, 3)
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'queued_seconds': queued_seconds,
+            'run_seconds': run_seconds,
+            'result': self.result,
+            'error': self.error,
+            'coalesced_requests': self.coalesced,
+            'priority': self.priority,
+        }
+
+
+class JobQueue:
+    """
+    A job queue served by a fixed pool of worker threads.
+    Finished jobs are kept in memory (up to `history` entries) so their
+    status can still be queried after completion.
+
+    Jobs submitted with a key are single-flight: while a job with the same key
+    is queued or running, submitting again returns that job instead of a new one.
+
+    Waiting jobs are taken in (priority, arrival) order. With a DeviceScheduler,
+    a job only starts once every device it touches has a free slot; jobs for idle
+    devices may overtake it meanwhile. A job that has waited longer than `aging`
+    seconds is promoted to the top priority so large jobs are not starved.
+    """
+
+    def __init__(self, workers=4, history=1000, scheduler=None, aging=300):
+        self.workers = max(1, int(workers))
+        self.history = max(1, int(history))
+        self.scheduler = scheduler
+        self.aging = aging
+        self._pending = []
+        self._seq = itertools.count()
+        self._jobs = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._stopping = False
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"rcp-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logging.info(f"Job queue started with {self.workers} worker(s).")
+
+    def submit(self, kind, payload, func, key=None, priority=0, devices=()):
+        """
+        Queues a job and returns (job, created). If key is given and a job with the
+        same key is still in flight, that job is returned with created=False.
+        priority orders waiting jobs (lower runs first); devices are the st_dev
+        values the job reads or writes, used for per-device concurrency limits.
+        """
+        with self._lock:
+            if key is not None:
+                running = self._inflight.get(key)
+                if running is not None:
+                    running.coalesced += 1
+                    logging.info(f"Request for {key} attached to in-flight job {running.id}")
+                    return running, False
+            job = Job(kind, payload, func, key, priority, devices)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._inflight[key] = job
+            self._trim()
+            heapq.heappush(self._pending, (priority, next(self._seq), job))
+            depth = len(self._pending)
+            self._ready.notify()
+        logging.info(f"Job {job.id} ({kind}) queued, queue depth: {depth}")
+        return job, True
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self):
+        return len(self._pending)
+
+    def shutdown(self):
+        """Stops the workers after their current job; waiting jobs are not run."""
+        with self._lock:
+            self._stopping = True
+            self._ready.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _trim(self):
+        # Only drop finished jobs; queued/running jobs are always kept.
+        if len(self._jobs) <= self.history:
+            return
+        for job_id in list(self._jobs.keys()):
+            if len(self._jobs) <= self.history:
+                break
+            if self._jobs[job_id].done:
+                del self._jobs[job_id]
+
+    def _take_runnable(self):
+        """Removes and returns the first waiting job that may start now. Caller holds the lock."""
+        if not self._pending:
+            return None
+        if self.scheduler is None and not self.aging:
+            return heapq.heappop(self._pending)[2]
+        now = time.time()
+        order = sorted(
+            self._pending,
+            key=lambda e: (0 if self.aging and now - e[2].created_at > self.aging else e[0], e[1]),
+        )
+        for entry in order:
+            job = entry[2]
+            if self.scheduler is None or self.scheduler.try_acquire(job.devices):
+                self._pending.remove(entry)
+                heapq.heapify(self._pending)
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                job = None
+                while not self._stopping:
+                    job = self._take_runnable()
+                    if job is not None:
+                        break
+                    # Re-check periodically so aging promotions take effect
+                    self._ready.wait(timeout=self.aging or None)
+                if job is None:
+                    return
+            job.run()
+            with self._lock:
+                if self.scheduler is not None:
+                    self.scheduler.release(job.devices)
+                if job.key is not None and self._inflight.get(job.key) is job:
+                    del self._inflight[job.key]
+                # Freed device slots may unblock jobs other workers skipped
+                self._ready.notify_all()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Crash-safe journal of link plans.
+
+Before a job links anything, its full plan (target directories and
+(src, dst) pairs) is written to journal/<key>.json. While the plan runs,
+the number of leading links that are done is appended to journal/<key>.ckpt
+every checkpoint_every links. Both files are removed when the plan
+finishes, so whatever is left in the journal belongs to an interrupted job
+and can be resumed from its last checkpoint. The process working on a plan
+holds an flock on journal/<key>.lock, so a plan that is still being carried
+out by another process (e.g. `rcp.py --local`) is never resumed twice.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+def _fsync_dir(path):
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def _lock(path, blocking=True):
+    """
+    Opens and flocks path; returns the fd, or None if another process holds
+    the lock and blocking is False. A lock file unlinked by its previous
+    holder (see PlanEntry.finish) is recreated. Without fcntl the file is
+    only opened, and plans are not protected against a second process.
+    """
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is None:
+            return fd
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def journal_key(torhash, tor_path):
+    """File name stem of a job's journal entry: its torhash, or a digest of the path."""
+    if torhash:
+        return ''.join(c for c in str(torhash) if c.isalnum())[:64] or 'unknown'
+    return 'path-' + hashlib.sha1(tor_path.encode('utf-8')).hexdigest()
+
+
+class PlanEntry:
+    """One journaled plan. `done` is the number of leading links already placed."""
+
+    def __init__(self, journal, key, plan, done=0, lock_fd=None):
+        self.journal = journal
+        self.key = key
+        self.plan = plan
+        self.done = done
+        self._lock = threading.Lock()
+        self._lock_fd = lock_fd
+
+    @property
+    def links(self):
+        return self.plan['links']
+
+    @property
+    def dirs(self):
+        return self.plan['dirs']
+
+    def checkpoint(self, done):
+        """Durably records that links[:done] are in place."""
+        with self._lock:
+            if done <= self.done:
+                return
+            with open(self.journal._path(self.key, '.ckpt'), 'a', encoding='utf-8') as f:
+                f.write(f"{done}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.done = done
+
+    def finish(self):
+        """Removes the entry; the plan is complete."""
+        for suffix in ('.ckpt', '.json', '.lock'):
+            try:
+                os.unlink(self.journal._path(self.key, suffix))
+            except FileNotFoundError:
+                pass
+        self.release()
+
+    def release(self):
+        """Gives up the entry's lock, e.g. when the job failed, so it can be resumed later."""
+        with self._lock:
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+
+class PlanJournal:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.path, key + suffix)
+
+    def begin(self, key, plan):
+        """
+        Journals plan (a dict with 'dirs' and 'links', plus any metadata) under key.
+        If an interrupted entry with the same links exists, it is continued from its
+        checkpoint; otherwise it is replaced. Waits while another process works on
+        key. Returns the PlanEntry, which holds the key's lock until it is finished
+        or released.
+        """
+        lock_fd = _lock(self._path(key, '.lock'))
+        try:
+            previous = self.load(key, lock_fd)
+        except BaseException:
+            os.close(lock_fd)
+            raise
+        if previous is not None and previous.links == plan['links'] and previous.dirs == plan['dirs']:
+            if previous.done:
+                logging.info(f"Resuming journaled plan {key} at {previous.done}/{len(previous.links)}")
+            return previous
+
+        plan = dict(plan, created_at=time.time())
+        tmp_path = self._path(key, '.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(plan, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.unlink(self._path(key, '.ckpt'))
+        except FileNotFoundError:
+            pass
+        os.rename(tmp_path, self._path(key, '.json'))
+        _fsync_dir(self.path)
+        return PlanEntry(self, key, plan, lock_fd=lock_fd)
+
+    def load(self, key, lock_fd=None):
+        """The journaled entry for key, or None. The entry takes over lock_fd."""
+        try:
+            with open(self._path(key, '.json'), encoding='utf-8') as f:
+                plan = json.load(f)
+        except FileNotFoundError:
+            plan = None
+        except (OSError, ValueError) as e:
+            logging.error(f"Unreadable plan journal {key}: {e}")
+            plan = None
+        if plan is None:
+            # The caller keeps its lock for the plan it is about to journal
+            return None
+        plan['links'] = [tuple(link) for link in plan.get('links', [])]
+        plan.setdefault('dirs', [])
+        return PlanEntry(self, key, plan, self._read_checkpoint(key, len(plan['links'])), lock_fd)
+
+    def _read_checkpoint(self, key, total):
+        done = 0
+        try:
+            with open(self._path(key, '.ckpt'), encoding='utf-8') as f:
+                for line in f:
+                    # A torn last line from a crash is ignored
+                    if line.endswith('\n') and line.strip().isdigit():
+                        done = max(done, int(line))
+        except FileNotFoundError:
+            pass
+        return min(done, total)
+
+    def pending(self):
+        """
+        Entries of interrupted plans, oldest first, each locked for the caller.
+        Plans another live process is still working on are skipped.
+        """
+        entries = []
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            lock_fd = _lock(self._path(key, '.lock'), blocking=False)
+            if lock_fd is None:
+                logging.info(f"Journaled plan {key} is in progress in another process, not resuming it")
+                continue
+            entry = self.load(key, lock_fd)
+            if entry is not None:
+                entries.append(entry)
+            else:
+                os.close(lock_fd)
+        entries.sort(key=lambda e: e.plan.get('created_at', 0))
+        return entries
+
+
+class PlanProgress:
+    """
+    Tracks which links of a plan finished (in any order) and checkpoints the
+    entry whenever the finished prefix has grown by `every` links. before_checkpoint
+    runs first, e.g. to record the finished links in the link manifest.
+    """
+
+    def __init__(self, entry, every=200, before_checkpoint=None):
+        self.entry = entry
+        self.every = max(1, int(every))
+        self.before_checkpoint = before_checkpoint
+        self._finished = set()
+        self._prefix = entry.done
+        self._lock = threading.Lock()
+
+    def mark(self, index):
+        with self._lock:
+            self._finished.add(index)
+            while self._prefix in self._finished:
+                self._finished.discard(self._prefix)
+                self._prefix += 1
+            if self._prefix - self.entry.done < self.every:
+                return
+            done = self._prefix
+            if self.before_checkpoint is not None:
+                self.before_checkpoint()
+            self.entry.checkpoint(done)
+
+
+def get_plan_journal(config):
+    """Returns the PlanJournal configured in config, or None if [journal] is disabled."""
+    if not config.get('journal_enabled', True) or not config.get('journal_path'):
+        return None
+    return PlanJournal(config['journal_path'])
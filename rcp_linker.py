@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+import errno
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from rcp_fsops import COPY_STRATEGIES, FsOps, is_fallback_error
+from rcp_metrics import FILES_LINKED, BYTES_LINKED, BYTES_COPIED, LINKS_BY_STRATEGY, LINK_FAILURES
+
+LINK_CREATED = 'created'
+LINK_EXISTING = 'existing'
+LINK_SKIPPED = 'skipped'
+LINK_FAILED = 'failed'
+
+# Copies at least this large log their progress
+COPY_PROGRESS_MIN = 256 * 1024 * 1024
+# A 'links' progress event is sent every this many finished files
+PROGRESS_BATCH = 50
+
+
+class LinkStats:
+    """
+    Counts of links created, already in place (destination is the same file),
+    skipped (destination is a different file) and failed, plus the number of
+    files created with each link strategy.
+    """
+
+    def __init__(self):
+        self.created = 0
+        self.existing = 0
+        self.skipped = 0
+        self.failed = 0
+        self.strategies = {}
+        self._lock = threading.Lock()
+
+    def add(self, outcome, strategy=None):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if strategy is not None:
+                self.strategies[strategy] = self.strategies.get(strategy, 0) + 1
+
+    def to_dict(self):
+        return {'created': self.created, 'existing': self.existing, 'skipped': self.skipped, 'failed': self.failed,
+                'strategies': dict(self.strategies)}
+
+    def __str__(self):
+        text = f"created={self.created}, existing={self.existing}, skipped={self.skipped}, failed={self.failed}"
+        if set(self.strategies) - {'hardlink'}:
+            text += f", strategies={self.strategies}"
+        return text
+
+
+def scan_tree(src_dir, dst_dir, stats=None):
+    """
+    Maps the tree under src_dir onto dst_dir using os.scandir.
+    Returns (target directories, [(src file, dst file)]).
+    """
+    dirs = [dst_dir]
+    files = []
+    stack = [(src_dir, dst_dir)]
+    while stack:
+        src, dst = stack.pop()
+        try:
+            with os.scandir(src) as it:
+                for entry in it:
+                    target = os.path.join(dst, entry.name)
+                    if entry.is_dir():
+                        dirs.append(target)
+                        stack.append((entry.path, target))
+                    else:
+                        files.append((entry.path, target))
+        except OSError as e:
+            logging.error(f"读取目录失败: {src}: {e}")
+            if stats is not None:
+                stats.add(LINK_FAILED)
+    return dirs, files
+
+
+class LinkPlanner:
+    """
+    Drop-in replacement for LinkEngine that only records the planned
+    (src, dst) pairs in `links` and the target directories in `dirs`
+    without touching the filesystem. progress gets the same 'discovered'
+    events as LinkEngine's.
+    """
+
+    def __init__(self, fs=None, progress=None):
+        self.fs = fs or FsOps()
+        self.stats = LinkStats()
+        self.links = []
+        self.progress = progress
+        self._dirs = {}
+
+    @property
+    def dirs(self):
+        return list(self._dirs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def ensure_dir(self, path):
+        self._dirs.setdefault(path, None)
+
+    def link(self, src, dst, st=None):
+        self.fs.remember(src, st)
+        self.links.append((src, dst))
+
+    def link_tree(self, src_dir, dst_dir):
+        dirs, files = scan_tree(src_dir, dst_dir, self.stats)
+        if self.progress is not None:
+            self.progress('discovered', files=len(files), tree=dst_dir)
+        # Kept so that empty folders of the tree (e.g. in BDMV) are recreated too
+        for d in dirs:
+            self.ensure_dir(d)
+        self.links.extend(files)
+
+    def wait(self):
+        return self.stats
+
+
+class LinkEngine:
+    """
+    Issues os.link calls from a bounded thread pool.
+    Target directories are created once and remembered, so callers can submit
+    links in any order without repeating makedirs for every file.
+
+    Use as a context manager; leaving the block waits for all submitted links.
+    With track=True, every link that is in place afterwards (created, or found
+    already linked) is kept in `created` as (src, dst, stat, strategy) so it can
+    be recorded in the link manifest. stat is the destination's inode: src's
+    for hard links, the new file's for copies and symlinks.
+
+    strategies is the chain tried for each file (see FsOps.place), e.g.
+    ('hardlink', 'reflink', 'copy') to fall back to a reflink and then to an
+    in-kernel copy when the library is on another filesystem. Strategies from
+    'copy' on run in a separate pool of copy_workers threads, so a few large
+    copies cannot hold up the hard links of other files.
+
+    All filesystem calls go through `fs` (a per-job FsOps), which caches stats
+    and created directories and counts the syscalls issued.
+
+    progress(event, **fields), if given, receives a 'links' event with the
+    running counts every PROGRESS_BATCH finished files and once at the end.
+    It is called from the pool threads.
+    """
+
+    def __init__(self, workers=8, track=False, fs=None, strategies=('hardlink',), copy_workers=2, progress=None):
+        self.workers = max(1, int(workers))
+        self.track = track
+        self.fs = fs or FsOps()
+        self.stats = LinkStats()
+        self.created = []
+        self._created_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='rcp-link')
+        self._futures = []
+        self._futures_lock = threading.Lock()
+        self.progress = progress
+        self._queued = 0
+        self._finished = 0
+        self._reported = 0
+
+        strategies = tuple(strategies) or ('hardlink',)
+        split = next((i for i, s in enumerate(strategies) if s in COPY_STRATEGIES), len(strategies))
+        self._fast, self._slow = strategies[:split], strategies[split:]
+        self._copy_executor = None
+        if self._slow:
+            self._copy_executor = ThreadPoolExecutor(max_workers=max(1, int(copy_workers)),
+                                                     thread_name_prefix='rcp-copy')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.wait()
+
+    def ensure_dir(self, path):
+        self.fs.makedirs(path)
+
+    def link(self, src, dst, st=None, done=None):
+        """
+        Queues a hard link from src to dst, creating dst's directory first.
+        st is src's stat if the caller already has it (e.g. from os.scandir).
+        done() is called from the pool once the file is handled, whatever the outcome.
+        """
+        self.fs.remember(src, st)
+        self.ensure_dir(os.path.dirname(dst))
+        self._submit(src, dst, done)
+
+    def link_tree(self, src_dir, dst_dir):
+        """
+        Links every file under src_dir into dst_dir, recreating the directory structure.
+        The tree is scanned with os.scandir first so all target directories can be
+        created up front; the links are then issued from the pool.
+        """
+        dirs, files = scan_tree(src_dir, dst_dir, self.stats)
+        if self.progress is not None:
+            self.progress('discovered', files=len(files), tree=dst_dir)
+        for d in dirs:
+            self.ensure_dir(d)
+        for src, dst in files:
+            self._submit(src, dst)
+
+    def _submit(self, src, dst, done=None):
+        if self._fast:
+            future = self._executor.submit(self._link_one, src, dst, self._fast, done)
+        else:
+            future = self._copy_executor.submit(self._link_one, src, dst, self._slow, done)
+        with self._futures_lock:
+            self._futures.append(future)
+            self._queued += 1
+
+    def _report(self, final=False):
+        """Sends a 'links' progress event every PROGRESS_BATCH finished files (and a final one)."""
+        if self.progress is None:
+            return
+        with self._futures_lock:
+            if not final:
+                self._finished += 1
+                if self._finished - self._reported < PROGRESS_BATCH:
+                    return
+            elif self._finished == self._reported:
+                return
+            self._reported = self._finished
+            fields = dict(self.stats.to_dict(), finished=self._finished, queued=self._queued)
+        self.progress('links', **fields)
+
+    def take_created(self):
+        """Returns the tracked links collected so far and starts a new list."""
+        with self._created_lock:
+            created, self.created = self.created, []
+        return created
+
+    def wait(self):
+        """Waits for every queued link and shuts the pools down. Returns the stats."""
+        while True:
+            # Links falling back to a copy queue more futures while we wait
+            with self._futures_lock:
+                futures, self._futures = self._futures, []
+            if not futures:
+                break
+            for future in futures:
+                future.result()
+        self._executor.shutdown(wait=True)
+        if self._copy_executor is not None:
+            self._copy_executor.shutdown(wait=True)
+        self._report(final=True)
+        return self.stats
+
+    def _copy_progress(self, dst):
+        """Returns a progress callback for FsOps.place that counts copied bytes and logs large copies."""
+        state = {'copied': 0, 'logged': 0}
+
+        def progress(copied, total):
+            BYTES_COPIED.inc(copied - state['copied'])
+            state['copied'] = copied
+            if total >= COPY_PROGRESS_MIN:
+                percent = copied * 100 // total
+                if percent >= state['logged'] + 10 or copied == total:
+                    state['logged'] = percent
+                    logging.info(f"复制进度 {percent}% ({copied >> 20}/{total >> 20} MiB): {dst}")
+        return progress
+
+    def _link_one(self, src, dst, strategies, done=None):
+        if self._place_one(src, dst, strategies, done):
+            self._report()
+            if done is not None:
+                done()
+
+    def _place_one(self, src, dst, strategies, done=None):
+        """Places one file and counts the outcome. Returns False if it was handed to the copy pool."""
+        try:
+            try:
+                strategy, created = self.fs.place(src, dst, strategies, progress=self._copy_progress(dst))
+            except OSError as e:
+                if strategies is not self._fast or not self._slow or not is_fallback_error(e):
+                    raise
+                # Hand the file over to the copy pool
+                with self._futures_lock:
+                    self._futures.append(self._copy_executor.submit(self._link_one, src, dst, self._slow, done))
+                return False
+            st = self.fs.stat(src)
+            if created:
+                logging.info(f"成功链接 ({strategy}): {src} -> {dst}")
+                self.stats.add(LINK_CREATED, strategy)
+                FILES_LINKED.inc()
+                BYTES_LINKED.inc(st.st_size if st is not None else 0)
+                LINKS_BY_STRATEGY.inc(strategy=strategy)
+            else:
+                logging.info(f"已链接，跳过: {dst}")
+                self.stats.add(LINK_EXISTING)
+            if self.track and st is not None:
+                if strategy != 'hardlink':
+                    # The library file is an inode of its own
+                    st = os.lstat(dst)
+                with self._created_lock:
+                    self.created.append((src, dst, st, strategy))
+        except FileExistsError:
+            logging.warning(f"目标文件已存在，跳过链接: {dst}")
+            self.stats.add(LINK_SKIPPED)
+        except OSError as e:
+            logging.error(f"创建链接失败: {e}")
+            self.stats.add(LINK_FAILED)
+            LINK_FAILURES.inc(errno=errno.errorcode.get(e.errno, str(e.errno)))
+        except Exception as e:
+            logging.error(f"发生未知错误: {e}")
+            self.stats.add(LINK_FAILED)
+            LINK_FAILURES.inc(errno='unknown')
+        return True
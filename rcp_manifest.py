@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import threading
+import time
+
+
+class LinkManifest:
+    """
+    Persistent ledger (SQLite) of every link rcp created in the library:
+    torhash, source path, inode/device of the library file, destination path
+    and the link strategy used (hardlink, reflink, copy or symlink; for hard
+    links the inode is the source's).
+    Destinations are unique; recording the same destination again replaces the row.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS links ("
+                " dst TEXT PRIMARY KEY,"
+                " torhash TEXT,"
+                " src TEXT NOT NULL,"
+                " dev INTEGER,"
+                " ino INTEGER,"
+                " created_at REAL NOT NULL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(links)")}
+            if 'strategy' not in columns:
+                conn.execute("ALTER TABLE links ADD COLUMN strategy TEXT NOT NULL DEFAULT 'hardlink'")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_links_torhash ON links (torhash)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_links_src ON links (src)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, torhash, links):
+        """Records links, an iterable of (src, dst, stat_result_or_None[, strategy])."""
+        now = time.time()
+        rows = []
+        for link in links:
+            src, dst, st = link[:3]
+            strategy = link[3] if len(link) > 3 else 'hardlink'
+            rows.append((dst, torhash, src, st.st_dev if st else None, st.st_ino if st else None, now, strategy))
+        if not rows:
+            return 0
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO links (dst, torhash, src, dev, ino, created_at, strategy)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def links_for_torhash(self, torhash):
+        with self._lock, self._connect() as conn:
+            return conn.execute(
+                "SELECT torhash, src, dev, ino, dst FROM links WHERE torhash = ? ORDER BY dst",
+                (torhash,),
+            ).fetchall()
+
+    def all_links(self):
+        with self._lock, self._connect() as conn:
+            return conn.execute("SELECT torhash, src, dev, ino, dst FROM links ORDER BY dst").fetchall()
+
+    def links_for_dsts(self, dsts):
+        return self._links_where('dst', dsts)
+
+    def links_for_srcs(self, srcs):
+        return self._links_where('src', srcs)
+
+    def strategies_for_dsts(self, dsts):
+        """{dst: strategy} for the recorded destinations among dsts."""
+        return dict(self._links_where('dst', dsts, fields='dst, strategy'))
+
+    def _links_where(self, column, values, chunk=500, fields='torhash, src, dev, ino, dst'):
+        """Records whose column is one of values, queried in chunks to stay under SQLite's parameter limit."""
+        values = list(values)
+        rows = []
+        with self._lock, self._connect() as conn:
+            for i in range(0, len(values), chunk):
+                part = values[i:i + chunk]
+                rows.extend(conn.execute(
+                    f"SELECT {fields} FROM links WHERE {column} IN ({','.join('?' * len(part))})",
+                    part,
+                ).fetchall())
+        return rows
+
+    def links_under(self, path):
+        """Returns the records whose destination is path itself or lies below it."""
+        path = os.path.normpath(path)
+        prefix = path + os.sep
+        # '0' sorts right after '/', so [prefix, path + '0') is exactly the subtree
+        upper = path + chr(ord(os.sep) + 1)
+        with self._lock, self._connect() as conn:
+            return conn.execute(
+                "SELECT torhash, src, dev, ino, dst FROM links"
+                " WHERE dst = ? OR (dst >= ? AND dst < ?) ORDER BY dst",
+                (path, prefix, upper),
+            ).fetchall()
+
+    def forget(self, dsts):
+        """Removes the records for the given destination paths."""
+        rows = [(dst,) for dst in dsts]
+        if not rows:
+            return 0
+        with self._lock, self._connect() as conn:
+            conn.executemany("DELETE FROM links WHERE dst = ?", rows)
+        return len(rows)
+
+    def forget_under(self, path):
+        path = os.path.normpath(path)
+        with self._lock, self._connect() as conn:
+            cur = conn.execute(
+                "DELETE FROM links WHERE dst = ? OR (dst >= ? AND dst < ?)",
+                (path, path + os.sep, path + chr(ord(os.sep) + 1)),
+            )
+            return cur.rowcount
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import threading
+
+# Prometheus default buckets, extended for long linking jobs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """A gauge whose value is either set directly or read from a callback at scrape time."""
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self._value = 0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def _samples(self):
+        value = self._function() if self._function is not None else self._value
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {bucket_count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    'rcp_requests_total', 'Agent HTTP requests by endpoint and status code.', ('endpoint', 'status')))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'rcp_stage_seconds', 'Time spent in each processing stage.', ('stage',)))
+MEDIA_INFO_CACHE = REGISTRY.register(Counter(
+    'rcp_media_info_cache_total', 'Media info cache lookups by result.', ('result',)))
+FILES_LINKED = REGISTRY.register(Counter(
+    'rcp_files_linked_total', 'Library links created.'))
+BYTES_LINKED = REGISTRY.register(Counter(
+    'rcp_bytes_linked_total', 'Size of the files linked into the library.'))
+LINKS_BY_STRATEGY = REGISTRY.register(Counter(
+    'rcp_links_by_strategy_total', 'Library files placed, by link strategy.', ('strategy',)))
+BYTES_COPIED = REGISTRY.register(Counter(
+    'rcp_bytes_copied_total', 'Bytes copied into the library by the copy strategy.'))
+LINK_FAILURES = REGISTRY.register(Counter(
+    'rcp_link_failures_total', 'Failed link operations by errno.', ('errno',)))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'rcp_queue_depth', 'Jobs waiting in the agent queue.'))
+SPOOL_PENDING = REGISTRY.register(Gauge(
+    'rcp_spool_pending', 'Jobs waiting in the spool directory.'))
+TRASH_FILES = REGISTRY.register(Gauge(
+    'rcp_trash_files', 'Files waiting in the trash folders to be removed.'))
+TRASH_BYTES = REGISTRY.register(Gauge(
+    'rcp_trash_bytes', 'Apparent size of the files waiting in the trash folders.'))
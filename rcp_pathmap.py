@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Path mapping between the main application's and rcp_agent's view of the
+download paths.
+
+The rules of [path_mapping] are compiled into prefix tries keyed by path
+component, one per direction. A lookup walks the components of the path once
+and uses the deepest rule on the way, so its cost depends on the depth of the
+path rather than on the number of rules, and a prefix only ever matches whole
+components: /downloads matches /downloads/x but not /downloads2/x.
+"""
+import os
+
+_RULE = object()
+
+
+def _components(path):
+    """The components of a normalized path; an absolute path starts with os.sep."""
+    path = os.path.normpath(path)
+    if path.startswith(os.sep):
+        return [os.sep] + [c for c in path.split(os.sep) if c]
+    return [c for c in path.split(os.sep) if c and c != os.curdir]
+
+
+class _Trie:
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, prefix, target):
+        node = self.root
+        for component in _components(prefix):
+            node = node.setdefault(component, {})
+        # The first rule for a prefix wins
+        node.setdefault(_RULE, target)
+
+    def translate(self, path):
+        components = _components(path)
+        node = self.root
+        match = None
+        for depth, component in enumerate(components):
+            node = node.get(component)
+            if node is None:
+                break
+            target = node.get(_RULE)
+            if target is not None:
+                match = (depth + 1, target)
+        if match is None:
+            return path
+        depth, target = match
+        return os.path.join(target, *components[depth:])
+
+
+class PathMapping(dict):
+    """
+    The application -> agent prefix rules of [path_mapping], as a dict, plus
+    compiled tries for translating in both directions.
+    """
+
+    def __init__(self, rules=()):
+        super().__init__(rules)
+        self._to_agent = _Trie()
+        self._to_app = _Trie()
+        for app_prefix, agent_prefix in self.items():
+            self._to_agent.insert(app_prefix, agent_prefix)
+        # Where several application prefixes share an agent prefix, the longest one wins
+        for app_prefix, agent_prefix in sorted(self.items(), key=lambda rule: len(rule[0]), reverse=True):
+            self._to_app.insert(agent_prefix, app_prefix)
+
+    def to_agent(self, path):
+        """path as the agent sees it; unchanged when no rule matches."""
+        return self._to_agent.translate(path)
+
+    def to_app(self, path):
+        """The inverse of to_agent."""
+        return self._to_app.translate(path)
+
+    def translate_many(self, paths):
+        """to_agent for every path, in order."""
+        translate = self._to_agent.translate
+        return [translate(path) for path in paths]
+
+
+def compile_mapping(path_mapping):
+    """path_mapping as a PathMapping, compiling it only if it is a plain dict."""
+    if isinstance(path_mapping, PathMapping):
+        return path_mapping
+    return PathMapping(path_mapping or {})
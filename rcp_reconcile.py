@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import sqlite3
+import stat
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from rcp_core import (
+    DEFAULT_PRUNE_DIRS,
+    VIDEO_EXTS,
+    execute_hardlinking,
+    get_link_manifest,
+    get_media_cache,
+    link_engine_options,
+    stage_timer,
+    _prune_empty_dirs,
+)
+from rcp_linker import LinkEngine
+from rcp_trash import get_trash
+
+# How many items the summary lists per category; the counts are always complete
+REPORT_LIMIT = 100
+
+IndexedFile = namedtuple('IndexedFile', ['path', 'dev', 'ino', 'nlink'])
+ScanResult = namedtuple('ScanResult', ['root', 'first', 'added', 'removed', 'dirs', 'rescanned'])
+
+
+class TreeIndex:
+    """
+    SQLite index of directory trees: every directory with its mtime and inode,
+    and every entry directly inside it.
+
+    scan() only lists directories whose (mtime, inode) changed since the last
+    scan; unchanged directories are only stat'ed to find their subdirectories
+    in the index. A directory's mtime changes whenever an entry is added,
+    removed or renamed in it, so this finds every added or removed file
+    without walking the files of unchanged directories.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS dirs ("
+                " path TEXT PRIMARY KEY,"
+                " root TEXT NOT NULL,"
+                " mtime_ns INTEGER NOT NULL,"
+                " ino INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " path TEXT PRIMARY KEY,"
+                " dir TEXT NOT NULL,"
+                " root TEXT NOT NULL,"
+                " is_dir INTEGER NOT NULL,"
+                " dev INTEGER,"
+                " ino INTEGER,"
+                " nlink INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_dir ON entries (dir)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_inode ON entries (dev, ino)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_dirs_root ON dirs (root)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def scan(self, root, skip=(), commit=True):
+        """
+        Brings the index of root up to date. Returns a ScanResult with the files
+        added and removed since the previous scan (all files on the first scan).
+        Directories named in skip are not indexed. With commit=False the index
+        is left as it was, so the same changes are reported again next time.
+        """
+        root = os.path.normpath(root)
+        skip = frozenset(skip)
+        with self._lock, self._connect() as conn:
+            known = {p: (m, i) for p, m, i in conn.execute(
+                "SELECT path, mtime_ns, ino FROM dirs WHERE root = ?", (root,))}
+            subdirs = {}
+            for path, parent in conn.execute(
+                    "SELECT path, dir FROM entries WHERE root = ? AND is_dir = 1", (root,)):
+                subdirs.setdefault(parent, []).append(path)
+
+            first = not known
+            added, removed = [], []
+            seen = set()
+            rescanned = 0
+            stack = [root]
+            while stack:
+                current = stack.pop()
+                try:
+                    st = os.stat(current)
+                except OSError as e:
+                    logging.warning(f"读取目录失败: {current}: {e}")
+                    continue
+                seen.add(current)
+                if known.get(current) == (st.st_mtime_ns, st.st_ino):
+                    stack.extend(subdirs.get(current, ()))
+                    continue
+
+                rescanned += 1
+                old = {p: (is_dir, dev, ino) for p, is_dir, dev, ino in conn.execute(
+                    "SELECT path, is_dir, dev, ino FROM entries WHERE dir = ?", (current,))}
+                new = {}
+                try:
+                    with os.scandir(current) as it:
+                        for entry in it:
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.name not in skip:
+                                    new[entry.path] = (1, None, None, None)
+                            elif entry.is_file(follow_symlinks=False):
+                                est = entry.stat(follow_symlinks=False)
+                                new[entry.path] = (0, est.st_dev, est.st_ino, est.st_nlink)
+                except OSError as e:
+                    logging.warning(f"读取目录失败: {current}: {e}")
+                    continue
+
+                for path, (is_dir, dev, ino) in old.items():
+                    current_entry = new.get(path)
+                    if current_entry is not None and current_entry[:3] == (is_dir, dev, ino):
+                        continue
+                    if is_dir:
+                        removed.extend(self._drop_subtree(conn, path))
+                    else:
+                        removed.append(path)
+                        conn.execute("DELETE FROM entries WHERE path = ?", (path,))
+                for path, (is_dir, dev, ino, nlink) in new.items():
+                    previous = old.get(path)
+                    if previous is None or previous != (is_dir, dev, ino):
+                        conn.execute(
+                            "INSERT OR REPLACE INTO entries (path, dir, root, is_dir, dev, ino, nlink)"
+                            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (path, current, root, is_dir, dev, ino, nlink),
+                        )
+                        if not is_dir:
+                            added.append(IndexedFile(path, dev, ino, nlink))
+                    if is_dir:
+                        stack.append(path)
+                conn.execute(
+                    "INSERT OR REPLACE INTO dirs (path, root, mtime_ns, ino) VALUES (?, ?, ?, ?)",
+                    (current, root, st.st_mtime_ns, st.st_ino),
+                )
+
+            # Directories that could not be reached this time (e.g. root itself is gone)
+            for path in set(known) - seen:
+                if not os.path.isdir(path):
+                    removed.extend(self._drop_subtree(conn, path))
+            if not commit:
+                conn.rollback()
+        return ScanResult(root, first, added, removed, len(seen), rescanned)
+
+    def _drop_subtree(self, conn, path):
+        """Forgets a directory and everything below it. Returns the file paths dropped."""
+        upper = path + chr(ord(os.sep) + 1)
+        files = [p for (p,) in conn.execute(
+            "SELECT path FROM entries WHERE is_dir = 0 AND path >= ? AND path < ?", (path + os.sep, upper))]
+        conn.execute("DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)", (path, path + os.sep, upper))
+        conn.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", (path, path + os.sep, upper))
+        return files
+
+    def forget_root(self, root):
+        """Drops everything indexed under root; its next scan is a full one."""
+        root = os.path.normpath(root)
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM entries WHERE root = ?", (root,))
+            conn.execute("DELETE FROM dirs WHERE root = ?", (root,))
+
+    def paths_for_inodes(self, inodes, roots):
+        """Maps (dev, ino) pairs to a path with that inode indexed under one of roots."""
+        found = {}
+        placeholders = ','.join('?' * len(roots))
+        with self._lock, self._connect() as conn:
+            for dev, ino in inodes:
+                row = conn.execute(
+                    f"SELECT path FROM entries WHERE dev = ? AND ino = ? AND root IN ({placeholders}) LIMIT 1",
+                    (dev, ino, *roots)).fetchone()
+                if row is not None:
+                    found[(dev, ino)] = row[0]
+        return found
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_tree_index(config):
+    path = config['reconcile_index_path']
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None:
+            index = _indexes[path] = TreeIndex(path)
+        return index
+
+
+def _lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def _download_roots(config):
+    """Existing configured download folders, without folders nested in another one."""
+    paths = sorted({os.path.normpath(p) for p in config.get('reconcile_download_paths', [])})
+    return [p for p in paths
+            if os.path.isdir(p) and not any(p.startswith(q + os.sep) for q in paths)]
+
+
+def _source_side_available(src, download_roots):
+    """
+    True when the filesystem holding src is evidently there: its download root
+    is a non-empty directory, or (outside the configured roots) the folder
+    containing the torrent still exists.
+    """
+    for root in download_roots:
+        if src.startswith(root + os.sep):
+            try:
+                with os.scandir(root) as it:
+                    return next(it, None) is not None
+            except OSError:
+                return False
+    return os.path.isdir(os.path.dirname(os.path.dirname(src)))
+
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def reconcile(config, dry_run=False):
+    """
+    Checks the library against the link manifest and the download folders and
+    repairs what drifted:
+
+    - missing: a recorded link is gone but its source still exists -> relinked
+    - stale:   the source of a recorded symlink is gone, so the library entry
+               dangles -> removed (only with [reconcile] remove_stale). Hard
+               links, reflinks and copies hold the data themselves; once their
+               source is deleted they are the only copy and are kept ('detached').
+    - orphan records: both ends are gone -> record forgotten
+    - orphans: library files rcp has no record of. Those sharing an inode with a
+               download are adopted into the manifest; other media files are
+               only reported.
+    - unlinked: new downloads whose files are not linked anywhere; redone from
+               the media info cache when it knows the torrent, otherwise reported.
+
+    Only directories that changed since the previous run are listed (see
+    TreeIndex). With dry_run nothing is changed. Returns a summary dict.
+    """
+    with stage_timer('reconcile'):
+        return _reconcile(config, dry_run)
+
+
+def _reconcile(config, dry_run):
+    try:
+        return _reconcile_scanned(config, dry_run)
+    except Exception:
+        # The index already moved past the changes that were not repaired;
+        # forget it so the next run checks everything again.
+        if not dry_run:
+            index = get_tree_index(config)
+            for root in [config['root_path']] + _download_roots(config):
+                index.forget_root(root)
+        raise
+
+
+def _reconcile_scanned(config, dry_run):
+    manifest = get_link_manifest(config)
+    if manifest is None:
+        raise ValueError("reconcile requires the link manifest ([manifest] enabled = true)")
+    root_path = os.path.normpath(config['root_path'])
+    index = get_tree_index(config)
+
+    # Entries waiting in the trash are no longer part of the library
+    library = index.scan(root_path, skip=(config.get('trash_dir_name', '.rcp-trash'),), commit=not dry_run)
+    downloads = [index.scan(p, commit=not dry_run) for p in _download_roots(config)]
+    logging.info(
+        f"Reconcile scan: library {library.rescanned}/{library.dirs} dirs rescanned, "
+        f"downloads {sum(d.rescanned for d in downloads)}/{sum(d.dirs for d in downloads)} dirs rescanned")
+
+    summary = {
+        'dry_run': dry_run,
+        'dirs_scanned': library.dirs + sum(d.dirs for d in downloads),
+        'dirs_rescanned': library.rescanned + sum(d.rescanned for d in downloads),
+        'checked': 0, 'ok': 0, 'missing': 0, 'relinked': 0, 'stale': 0, 'removed': 0, 'detached': 0,
+        'conflicts': 0, 'orphan_records': 0, 'adopted': 0, 'orphans': [], 'unlinked': [],
+        'reprocessed': 0, 'unverified': 0, 'failed': 0,
+    }
+    download_roots = [d.root for d in downloads]
+
+    # 1. Records whose ends may have changed
+    if library.first or any(d.first for d in downloads):
+        records = manifest.all_links()
+    else:
+        removed_sources = [p for d in downloads for p in d.removed]
+        by_dst = {r[4]: r for r in manifest.links_for_dsts(library.removed)}
+        by_dst.update((r[4], r) for r in manifest.links_for_srcs(removed_sources))
+        records = list(by_dst.values())
+    summary['checked'] = len(records)
+
+    missing, stale, forget = [], [], []
+    for torhash, src, dev, ino, dst in records:
+        src_st = _lstat(src)
+        dst_st = _lstat(dst)
+        if src_st is not None and dst_st is not None:
+            # Copies and symlinks are recorded with the library file's own inode
+            if (src_st.st_dev, src_st.st_ino) == (dst_st.st_dev, dst_st.st_ino) \
+                    or (dev, ino) == (dst_st.st_dev, dst_st.st_ino):
+                summary['ok'] += 1
+            else:
+                summary['conflicts'] += 1
+                logging.warning(f"Library file is not a link to its recorded source: {dst}")
+        elif src_st is not None:
+            missing.append((torhash, src, dst))
+        elif not _source_side_available(src, download_roots):
+            # An unmounted or emptied download disk must not look like deleted sources
+            summary['unverified'] += 1
+        elif dst_st is not None:
+            if stat.S_ISLNK(dst_st.st_mode) and not os.path.exists(dst):
+                stale.append(dst)
+            else:
+                # The library file is now the only copy of the data
+                summary['detached'] += 1
+        else:
+            forget.append(dst)
+    summary['missing'] = len(missing)
+    summary['stale'] = len(stale)
+    summary['orphan_records'] = len(forget)
+
+    batch_size = max(1, config.get('reconcile_batch_size', 500))
+    workers = config.get('link_workers', 8)
+
+    # 2. Orphans: library files added since the last run that have no record
+    recorded = {r[4] for r in manifest.links_for_dsts([f.path for f in library.added])}
+    unrecorded = [f for f in library.added if f.path not in recorded]
+    sources = {}
+    if download_roots:
+        sources = index.paths_for_inodes([(f.dev, f.ino) for f in unrecorded if f.nlink > 1], download_roots)
+    adopt = []
+    for f in unrecorded:
+        src = sources.get((f.dev, f.ino))
+        if src is not None:
+            adopt.append((src, f.path, _lstat(f.path)))
+        elif os.path.splitext(f.path)[1].lower() in VIDEO_EXTS:
+            summary['orphans'].append(f.path)
+    summary['adopted'] = len(adopt)
+
+    # 3. Downloads with files that are linked nowhere
+    pruned = frozenset(d.lower() for d in config.get('prune_dirs', DEFAULT_PRUNE_DIRS))
+    candidates = {}
+    for scan in downloads:
+        for f in scan.added:
+            if f.nlink != 1 or os.path.splitext(f.path)[1].lower() not in VIDEO_EXTS:
+                continue
+            parts = os.path.relpath(f.path, scan.root).split(os.sep)
+            # Files in Sample/Extras folders are never linked
+            if any(part.lower() in pruned for part in parts[:-1]):
+                continue
+            candidates[f.path] = os.path.join(scan.root, parts[0])
+    # Files placed by copy, reflink or symlink keep a link count of 1
+    for r in manifest.links_for_srcs(list(candidates)):
+        candidates.pop(r[1], None)
+    unlinked_torrents = set(candidates.values())
+
+    if not dry_run:
+        _relink_missing(config, manifest, missing, batch_size, summary)
+        if config.get('reconcile_remove_stale', False):
+            trash = get_trash(config)
+            _remove_stale(manifest, stale, workers, batch_size, summary, trash)
+            _prune_empty_dirs([os.path.dirname(d) for d in stale], root_path)
+            if trash is not None and stale:
+                trash.reap_unattended()
+        manifest.forget(forget)
+        for part in _batches(adopt, batch_size):
+            manifest.record(None, part)
+
+    cache = get_media_cache(config)
+    for tor_path in sorted(unlinked_torrents):
+        cached = cache.find_by_path(tor_path) if cache is not None else None
+        if cached is None or dry_run:
+            summary['unlinked'].append(tor_path)
+            continue
+        torhash, media_info = cached
+        try:
+            execute_hardlinking(config, media_info, tor_path, torhash)
+            summary['reprocessed'] += 1
+        except Exception as e:
+            logging.error(f"Reconcile failed to redo {tor_path}: {e}")
+            summary['failed'] += 1
+            summary['unlinked'].append(tor_path)
+
+    summary['orphan_count'] = len(summary['orphans'])
+    summary['unlinked_count'] = len(summary['unlinked'])
+    summary['orphans'] = summary['orphans'][:REPORT_LIMIT]
+    summary['unlinked'] = summary['unlinked'][:REPORT_LIMIT]
+    logging.info(f"Reconcile finished: { {k: v for k, v in summary.items() if not isinstance(v, list)} }")
+    return summary
+
+
+def _relink_missing(config, manifest, missing, batch_size, summary):
+    """Recreates missing links in batches, recording each batch in the manifest."""
+    for part in _batches(missing, batch_size):
+        torhash_of = {dst: torhash for torhash, _, dst in part}
+        with LinkEngine(track=True, **link_engine_options(config)) as engine:
+            for _, src, dst in part:
+                engine.link(src, dst)
+        summary['relinked'] += engine.stats.created + engine.stats.existing
+        summary['failed'] += engine.stats.failed + engine.stats.skipped
+        by_torhash = {}
+        for link in engine.created:
+            by_torhash.setdefault(torhash_of.get(link[1]), []).append(link)
+        for torhash, links in by_torhash.items():
+            manifest.record(torhash, links)
+
+
+def _remove_stale(manifest, stale, workers, batch_size, summary, trash=None):
+    """
+    Removes dangling library symlinks, in parallel batches: moved to the trash
+    when it is enabled, unlinked otherwise.
+    """
+    def unlink(dst):
+        try:
+            if trash is not None and trash.move(dst) is not None:
+                return True
+            os.unlink(dst)
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            logging.error(f"Failed to remove stale link {dst}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for part in _batches(stale, batch_size):
+            done = [dst for dst, ok in zip(part, executor.map(unlink, part)) if ok]
+            summary['removed'] += len(done)
+            summary['failed'] += len(part) - len(done)
+            manifest.forget(done)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+from collections import defaultdict
+
+from rcp_core import (
+    execute_hardlinking,
+    get_link_manifest,
+    link_engine_options,
+    plan_hardlinking,
+    report_progress,
+    stage_timer,
+    _prune_empty_dirs,
+)
+from rcp_fsops import FsOps
+from rcp_linker import LinkEngine, PROGRESS_BATCH
+from rcp_trash import get_trash, only_contains
+
+
+def _old_links(manifest, old_full_path):
+    """
+    Returns the links currently under old_full_path, keyed by the source they
+    were placed from: {src: [dst, ...]} from the manifest records, or, when the
+    manifest has no records for the old tree, {(dev, ino): [dst, ...]} from a
+    scan of it plus the files there that are not links to any download.
+    """
+    by_src = defaultdict(list)
+    by_inode = defaultdict(list)
+    extras = []
+    records = manifest.links_under(old_full_path) if manifest is not None else []
+    if records:
+        # Copies, reflinks and symlinks never share the source's inode, so pair by the recorded source
+        for torhash, src, dev, ino, dst in records:
+            if os.path.lexists(dst):
+                by_src[os.path.normpath(src)].append(dst)
+        return by_src, by_inode, extras
+    if os.path.isfile(old_full_path):
+        paths = [old_full_path]
+    else:
+        paths = _walk_files(old_full_path)
+
+    for path in paths:
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        if st.st_nlink < 2:
+            extras.append(path)
+        else:
+            by_inode[(st.st_dev, st.st_ino)].append(path)
+    return by_src, by_inode, extras
+
+def _walk_files(top):
+    stack = [top]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry.path
+        except OSError as e:
+            logging.error(f"读取目录失败: {current}: {e}")
+
+
+def _is_subtree_move(old_root, new_root, matches, unmatched_old):
+    """True when every old link maps onto the same relative path under new_root."""
+    if unmatched_old or not matches or old_root == new_root:
+        return False
+    if not os.path.isdir(old_root) or os.path.lexists(new_root):
+        return False
+    for old_dst, new_dst in matches:
+        if os.path.relpath(old_dst, old_root) != os.path.relpath(new_dst, new_root):
+            return False
+    return True
+
+
+def relink_incremental(config, old_rel_path, new_media_info, tor_path, torhash=None):
+    """
+    Moves an existing library entry to the layout described by new_media_info
+    with the fewest filesystem operations.
+
+    The new link plan is diffed against the links under old_rel_path (matched by
+    the source recorded in the manifest, or by inode without records): links that are already in place are kept, moved links are renamed,
+    missing links are created and leftovers are unlinked. When the whole subtree
+    only moves, the directory is renamed in one operation.
+    Returns a summary of the applied operations.
+    """
+    with stage_timer('relink'):
+        return _relink_incremental(config, old_rel_path, new_media_info, tor_path, torhash)
+
+
+def _relink_incremental(config, old_rel_path, new_media_info, tor_path, torhash=None):
+    """Performs the relink; see relink_incremental."""
+    root_path = config['root_path']
+    report_progress('media_info', tmdb_cat=new_media_info.get('tmdb_cat'), tmdb_title=new_media_info.get('tmdb_title'),
+                    tmdb_year=new_media_info.get('tmdb_year'), emby_dir=new_media_info.get('emby_dir'))
+    old_full_path = os.path.join(root_path, old_rel_path) if old_rel_path else None
+    if not old_full_path or not os.path.lexists(old_full_path):
+        if old_rel_path:
+            logging.info(f"Old path does not exist, doing a full link: {old_full_path}")
+        stats = execute_hardlinking(config, new_media_info, tor_path, torhash)
+        return {'mode': 'full', 'links': stats}
+
+    manifest = get_link_manifest(config)
+    new_plan = plan_hardlinking(config, new_media_info, tor_path)
+    old_by_src, old_by_inode, extras = _old_links(manifest, old_full_path)
+
+    summary = {'mode': 'incremental', 'dir_renamed': False, 'kept': 0, 'renamed': 0,
+               'linked': 0, 'unlinked': 0, 'failed': 0}
+
+    # Pair every planned link with an existing link placed from the same source
+    pairs = []
+    matches = []
+    for src, new_dst in new_plan:
+        old_dst = None
+        st = None
+        try:
+            st = os.stat(src)
+            candidates = old_by_src.get(os.path.normpath(src)) or old_by_inode.get((st.st_dev, st.st_ino))
+            if candidates:
+                old_dst = new_dst if new_dst in candidates else candidates[0]
+                candidates.remove(old_dst)
+        except OSError as e:
+            logging.error(f"读取源文件失败: {src}: {e}")
+        pairs.append((src, st, old_dst, new_dst))
+        if old_dst is not None:
+            matches.append((old_dst, new_dst))
+    unmatched_old = [dst for old in (old_by_src, old_by_inode) for dsts in old.values() for dst in dsts]
+
+    new_root = os.path.join(root_path, new_media_info['emby_dir'])
+    if _is_subtree_move(old_full_path, new_root, matches, unmatched_old):
+        os.makedirs(os.path.dirname(new_root), exist_ok=True)
+        os.rename(old_full_path, new_root)
+        logging.info(f"Renamed directory: {old_full_path} -> {new_root}")
+        summary['dir_renamed'] = True
+        # Matched links now already sit at their new path
+        pairs = [(src, st, new_dst if old_dst else None, new_dst) for src, st, old_dst, new_dst in pairs]
+    else:
+        # Without manifest records the old entry is replaced wholesale, as delete_links would
+        unmatched_old.extend(extras)
+
+    # Kept and renamed links keep the strategy they were placed with
+    old_strategies = {}
+    if manifest is not None:
+        old_strategies = manifest.strategies_for_dsts([old for old, _ in matches])
+
+    def moved(src, st, old_dst, new_dst):
+        strategy = old_strategies.get(old_dst, 'hardlink')
+        return src, new_dst, st if strategy == 'hardlink' else os.lstat(new_dst), strategy
+
+    placed = []
+    fs = FsOps()
+    with LinkEngine(track=True, fs=fs, **link_engine_options(config)) as engine:
+        for i, (src, st, old_dst, new_dst) in enumerate(pairs):
+            if i and i % PROGRESS_BATCH == 0:
+                report_progress('links', finished=i, queued=len(pairs),
+                                **{k: v for k, v in summary.items() if k != 'dir_renamed'})
+            engine.ensure_dir(os.path.dirname(new_dst))
+            if old_dst == new_dst:
+                summary['kept'] += 1
+                placed.append(moved(src, st, old_dst, new_dst))
+                continue
+            if old_dst is not None and not os.path.lexists(new_dst):
+                try:
+                    os.rename(old_dst, new_dst)
+                    summary['renamed'] += 1
+                    placed.append(moved(src, st, old_dst, new_dst))
+                    continue
+                except OSError as e:
+                    logging.warning(f"重命名失败，改为重新链接: {old_dst} -> {new_dst}: {e}")
+                    unmatched_old.append(old_dst)
+            elif old_dst is not None:
+                unmatched_old.append(old_dst)
+            engine.link(src, new_dst, st)
+    # Links the engine found already in place count as kept
+    summary['linked'] += engine.stats.created
+    summary['kept'] += engine.stats.existing
+    summary['failed'] += engine.stats.failed
+    placed.extend(engine.created)
+
+    removed = []
+    trash = get_trash(config)
+    if (trash is not None and unmatched_old and os.path.isdir(old_full_path)
+            and only_contains(old_full_path, unmatched_old) and trash.move(old_full_path) is not None):
+        # The old folder holds only leftovers: drop it from the library in one rename
+        summary['unlinked'] += len(unmatched_old)
+        removed, unmatched_old = unmatched_old, []
+        trash.reap_unattended()
+    for dst in unmatched_old:
+        try:
+            os.unlink(dst)
+            summary['unlinked'] += 1
+            removed.append(dst)
+        except FileNotFoundError:
+            removed.append(dst)
+        except OSError as e:
+            logging.error(f"Failed to remove link {dst}: {e}")
+            summary['failed'] += 1
+
+    if manifest is not None:
+        manifest.forget(removed + [old for old, new in matches if old != new])
+        manifest.record(torhash, placed)
+    _prune_empty_dirs(
+        [os.path.dirname(d) for d in removed] + [os.path.dirname(old) for old, _ in matches]
+        + [old_full_path],
+        root_path,
+        old_full_path,
+    )
+    logging.info(f"Incremental relink finished: {summary}")
+    return summary
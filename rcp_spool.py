@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Durable on-disk job spool.
+
+    spool/tmp/    files being written
+    spool/new/    pending jobs, named <due time ns>-<pid>-<random>.json
+    spool/work/   jobs claimed by a drainer (suffixed with the drainer's pid)
+    spool/dead/   jobs that kept failing
+
+A job becomes visible in new/ only after it has been fsync'ed and renamed, so a
+crash never leaves half-written jobs behind. Claiming is a rename into work/,
+so any number of drainers (the agent, `rcp.py drain`) can run side by side.
+This module only uses the standard library so that rcp.py can spool a job
+without loading rcp_core.
+"""
+import json
+import logging
+import os
+import random
+import time
+import uuid
+
+SPOOL_KINDS = ('process', 'prefetch')
+
+
+def _due_ns(name):
+    """The due time encoded in a job file name, or None if the name is not a spool name."""
+    try:
+        return int(name.split('-', 1)[0])
+    except ValueError:
+        return None
+
+
+class Spool:
+    def __init__(self, path, max_attempts=8, retry_base=30.0, retry_max=3600.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        for sub in ('tmp', 'new', 'work', 'dead'):
+            os.makedirs(os.path.join(path, sub), exist_ok=True)
+
+    def _dir(self, sub):
+        return os.path.join(self.path, sub)
+
+    def _write(self, sub, name, job):
+        """Writes job to sub/name atomically: tmp file, fsync, rename, fsync of the directory."""
+        tmp_path = os.path.join(self._dir('tmp'), name)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        final_path = os.path.join(self._dir(sub), name)
+        os.rename(tmp_path, final_path)
+        dir_fd = os.open(self._dir(sub), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return final_path
+
+    @staticmethod
+    def _name(due):
+        return f"{int(due * 1e9):020d}-{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+
+    def append(self, kind, payload):
+        """Durably queues a job. Returns its file name."""
+        if kind not in SPOOL_KINDS:
+            raise ValueError(f"Unsupported spool job kind: {kind}")
+        now = time.time()
+        name = self._name(now)
+        self._write('new', name, {
+            'kind': kind, 'payload': payload, 'attempts': 0, 'created_at': now, 'last_error': None,
+        })
+        return name
+
+    def pending(self):
+        try:
+            return sum(1 for name in os.listdir(self._dir('new')) if name.endswith('.json'))
+        except OSError:
+            return 0
+
+    def has_due(self):
+        """True if at least one pending job is due now."""
+        try:
+            names = [n for n in os.listdir(self._dir('new')) if n.endswith('.json')]
+        except OSError:
+            return False
+        due = [d for d in map(_due_ns, names) if d is not None]
+        return bool(due) and min(due) <= time.time() * 1e9
+
+    def dead(self):
+        try:
+            return sorted(os.listdir(self._dir('dead')))
+        except OSError:
+            return []
+
+    def claim(self, limit):
+        """
+        Claims up to limit jobs that are due, oldest first.
+        Returns [(claim path, job)]; each must be passed to complete() or fail().
+        """
+        now_ns = int(time.time() * 1e9)
+        claimed = []
+        for name in sorted(os.listdir(self._dir('new'))):
+            if len(claimed) >= limit:
+                break
+            if not name.endswith('.json'):
+                continue
+            due_ns = _due_ns(name)
+            if due_ns is None:
+                logging.error(f"Spool job {name} has no due time in its name, moving it to dead letters")
+                try:
+                    os.rename(os.path.join(self._dir('new'), name), os.path.join(self._dir('dead'), name))
+                except FileNotFoundError:
+                    pass
+                continue
+            if due_ns > now_ns:
+                # Names sort by due time, so nothing after this one is due either
+                break
+            work_path = os.path.join(self._dir('work'), f"{name}.{os.getpid()}")
+            try:
+                os.rename(os.path.join(self._dir('new'), name), work_path)
+            except FileNotFoundError:
+                continue  # claimed by another drainer
+            try:
+                with open(work_path, encoding='utf-8') as f:
+                    job = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f"Unreadable spool job {name}: {e}")
+                os.rename(work_path, os.path.join(self._dir('dead'), name))
+                continue
+            claimed.append((work_path, job))
+        return claimed
+
+    def complete(self, work_path):
+        os.unlink(work_path)
+
+    def fail(self, work_path, job, error):
+        """Requeues a failed job with backoff, or moves it to dead/ after max_attempts."""
+        job['attempts'] = job.get('attempts', 0) + 1
+        job['last_error'] = str(error)
+        job['failed_at'] = time.time()
+        name = os.path.basename(work_path).rsplit('.', 1)[0]
+        if job['attempts'] >= self.max_attempts:
+            self.bury(work_path, job, error)
+            return
+        delay = min(self.retry_max, self.retry_base * (2 ** (job['attempts'] - 1)))
+        delay = random.uniform(delay / 2, delay)
+        self._write('new', self._name(time.time() + delay), job)
+        os.unlink(work_path)
+        logging.warning(f"Spool job {name} failed ({error}); retrying in {delay:.0f}s "
+                        f"(attempt {job['attempts']}/{self.max_attempts})")
+
+    def bury(self, work_path, job, error):
+        """Moves a claimed job to the dead-letter folder."""
+        name = os.path.basename(work_path).rsplit('.', 1)[0]
+        job['last_error'] = str(error)
+        self._write('dead', name, job)
+        os.unlink(work_path)
+        logging.error(f"Spool job {name} moved to dead letters after {job.get('attempts', 0)} attempt(s): {error}")
+
+    def recover(self):
+        """Returns jobs claimed by drainers that are no longer running to new/. Returns the count."""
+        recovered = 0
+        for name in os.listdir(self._dir('work')):
+            base, _, pid = name.rpartition('.')
+            if pid.isdigit() and _pid_alive(int(pid)):
+                continue
+            try:
+                os.rename(os.path.join(self._dir('work'), name), os.path.join(self._dir('new'), base or name))
+                recovered += 1
+            except FileNotFoundError:
+                continue
+        if recovered:
+            logging.info(f"Recovered {recovered} interrupted spool job(s).")
+        return recovered
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_spool(config):
+    """Returns the Spool configured in config (a dict from load_config)."""
+    return Spool(
+        config['spool_path'],
+        max_attempts=config.get('spool_max_attempts', 8),
+        retry_base=config.get('spool_retry_base', 30.0),
+        retry_max=config.get('spool_retry_max', 3600.0),
+    )
+
+
+def drain(config, limit=None):
+    """
+    Runs due spooled jobs in batches of [spool] batch_size until none are due
+    (or limit jobs were handled). 'process' jobs of a batch go through
+    run_rcp_batch together. Returns {'succeeded', 'failed'}.
+    """
+    from rcp_core import run_rcp_batch, run_rcp_prefetch
+
+    spool = get_spool(config)
+    spool.recover()
+    batch_size = max(1, config.get('spool_batch_size', 20))
+    summary = {'succeeded': 0, 'failed': 0}
+    while limit is None or summary['succeeded'] + summary['failed'] < limit:
+        remaining = batch_size if limit is None else min(batch_size, limit - summary['succeeded'] - summary['failed'])
+        claimed = spool.claim(remaining)
+        if not claimed:
+            break
+
+        processes = [(path, job) for path, job in claimed if job.get('kind') == 'process']
+        if processes:
+            try:
+                results = run_rcp_batch([job['payload'] for _, job in processes])
+            except Exception as e:
+                results = [{'status': 'error', 'message': str(e)}] * len(processes)
+            for (path, job), result in zip(processes, results):
+                if result['status'] == 'success':
+                    spool.complete(path)
+                    summary['succeeded'] += 1
+                else:
+                    spool.fail(path, job, result.get('message'))
+                    summary['failed'] += 1
+
+        for path, job in claimed:
+            kind = job.get('kind')
+            if kind == 'process':
+                continue
+            if kind != 'prefetch':
+                spool.bury(path, job, f"Unsupported spool job kind: {kind}")
+                summary['failed'] += 1
+                continue
+            try:
+                run_rcp_prefetch(**job['payload'])
+                spool.complete(path)
+                summary['succeeded'] += 1
+            except Exception as e:
+                spool.fail(path, job, e)
+                summary['failed'] += 1
+    if summary['succeeded'] or summary['failed']:
+        logging.info(f"Spool drained: {summary}, {spool.pending()} job(s) still pending")
+    return summary
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import http.client
+import json
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised without contacting torll while the circuit breaker is open."""
+
+
+class TorllHTTPError(ConnectionError):
+    """torll answered with a non-2xx status."""
+
+    def __init__(self, status, body):
+        super().__init__(f"请求torll API失败，状态码: {status}, 内容: {body}")
+        self.status = status
+        self.body = body
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and rejects calls for `reset_timeout`
+    seconds. After that a single trial call is let through (half-open); its outcome
+    closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return 'half_open'
+            return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logging.warning(f"torll circuit breaker opened after {self.failures} consecutive failure(s).")
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class TorllClient:
+    """
+    Keep-alive HTTP/1.1 client for the torll API.
+    Connections are pooled and reused across calls; transient failures (connection
+    errors, timeouts and 5xx answers) are retried with bounded exponential backoff
+    and jitter, and a circuit breaker stops calls while torll is down.
+    """
+
+    RETRYABLE_ERRORS = (OSError, http.client.HTTPException)
+    # How a pooled connection the server already closed while idle fails on reuse
+    STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+    def __init__(self, url, api_key, pool_size=4, connect_timeout=5.0, read_timeout=120.0,
+                 max_retries=3, backoff_base=0.5, backoff_max=10.0,
+                 breaker_threshold=5, breaker_reset=60.0):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported torll URL scheme: {url}")
+        self.url = url
+        self.api_key = api_key
+        self._https = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = parts.path or '/'
+        if parts.query:
+            self._path += '?' + parts.query
+        self.pool_size = max(1, pool_size)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self._pool = queue.LifoQueue()
+
+    def post_json(self, payload, path=None):
+        """POSTs payload as JSON and returns the decoded JSON answer."""
+        body = json.dumps(payload).encode('utf-8')
+        headers = {
+            'X-API-Key': self.api_key,
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive',
+        }
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"torll circuit breaker is open, skipping request to {self.url}")
+            try:
+                status, data = self._request(path or self._path, body, headers)
+            except self.RETRYABLE_ERRORS as e:
+                self.breaker.record_failure()
+                error = ConnectionError(f"请求torll API时发生连接错误: {e}")
+                error.__cause__ = e
+            else:
+                if 200 <= status < 300:
+                    self.breaker.record_success()
+                    return json.loads(data.decode('utf-8'))
+                text = data.decode('utf-8', 'ignore')
+                if status < 500:
+                    # The server is alive and answered; the request itself is wrong
+                    self.breaker.record_success()
+                    raise TorllHTTPError(status, text)
+                self.breaker.record_failure()
+                error = TorllHTTPError(status, text)
+
+            if attempt >= self.max_retries:
+                raise error
+            delay = self._backoff(attempt)
+            attempt += 1
+            logging.warning(f"{error}; retrying in {delay:.2f}s (attempt {attempt}/{self.max_retries})")
+            time.sleep(delay)
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    def _new_connection(self):
+        cls = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+        return cls(self._host, self._port, timeout=self.connect_timeout)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._new_connection()
+
+    def _release(self, conn):
+        if self._pool.qsize() >= self.pool_size:
+            conn.close()
+        else:
+            self._pool.put(conn)
+
+    def _request(self, path, body, headers):
+        conn = self._acquire()
+        reused = conn.sock is not None
+        try:
+            return self._send(conn, path, body, headers)
+        except self.STALE_CONNECTION_ERRORS:
+            if not reused:
+                raise
+        # The idle keep-alive connection was closed by torll: not a failure of torll, so
+        # retry at once on a fresh connection before the breaker or backoff get involved
+        logging.debug("Pooled torll connection was closed by the server, reconnecting")
+        return self._send(self._new_connection(), path, body, headers)
+
+    def _send(self, conn, path, body, headers):
+        try:
+            if conn.sock is None:
+                conn.connect()
+                conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.sock.settimeout(self.read_timeout)
+            conn.request('POST', path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException, socket.timeout):
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return response.status, data
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_torll_client(config, url=None):
+    """Returns the shared TorllClient for the torll settings in config (for url instead of [torll] url if given)."""
+    url = url or config['url']
+    options = dict(
+        pool_size=config.get('torll_pool_size', 4),
+        connect_timeout=config.get('torll_connect_timeout', 5.0),
+        read_timeout=config.get('torll_read_timeout', 120.0),
+        max_retries=config.get('torll_max_retries', 3),
+        backoff_base=config.get('torll_backoff_base', 0.5),
+        backoff_max=config.get('torll_backoff_max', 10.0),
+        breaker_threshold=config.get('torll_breaker_threshold', 5),
+        breaker_reset=config.get('torll_breaker_reset', 60.0),
+    )
+    # A reloaded config with other settings gets a new client
+    key = (url, config['api_key'], tuple(sorted(options.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = TorllClient(url, config['api_key'], **options)
+            _clients[key] = client
+        return client
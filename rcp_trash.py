@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Deferred deletion for the media library.
+
+Removing a library entry renames it into a trash folder on the same
+filesystem (`<root_path>/.rcp-trash`, or `<mount point>/.rcp-trash` for
+filesystems mounted below root_path), so it leaves the library in a single
+atomic rename. A background reaper empties the trash later, unlinking files
+from a small thread pool at a bounded rate.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from rcp_metrics import TRASH_FILES, TRASH_BYTES
+
+DEFAULT_TRASH_DIR = '.rcp-trash'
+
+
+def only_contains(top, files):
+    """True if every file below the directory top is one of files (and there is at least one)."""
+    files = set(files)
+    found = 0
+    stack = [top]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.path in files:
+                        found += 1
+                    else:
+                        return False
+        except OSError:
+            return False
+    return found > 0
+
+
+def _walk_trash_entry(path):
+    """Returns (files [(path, size)], directories deepest first) of one trash entry."""
+    files, dirs = [], []
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return files, dirs
+    if not os.path.isdir(path) or os.path.islink(path):
+        return [(path, st.st_size)], dirs
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        dirs.append(current)
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        files.append((entry.path, entry.stat(follow_symlinks=False).st_size))
+        except OSError as e:
+            logging.warning(f"读取回收目录失败: {current}: {e}")
+    dirs.sort(key=len, reverse=True)
+    return files, dirs
+
+
+class Trash:
+    """
+    Per-filesystem trash folders below root_path and the reaper that empties them.
+
+    move() is safe to call from any thread. start() runs the reaper in a daemon
+    thread; reap() empties the trash once in the calling thread.
+    """
+
+    def __init__(self, root_path, dir_name=DEFAULT_TRASH_DIR, workers=4, rate=200, interval=30.0):
+        self.root_path = os.path.normpath(root_path)
+        self.dir_name = dir_name
+        self.workers = max(1, int(workers))
+        self.rate = max(0, int(rate))
+        self.interval = interval
+        self._dirs = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def trash_dir_for(self, path):
+        """
+        The trash folder on path's filesystem: directly below the highest
+        directory under root_path that is on that filesystem. None if path
+        cannot be renamed into one (e.g. it is a mount point itself).
+        """
+        dev = os.lstat(path).st_dev
+        with self._lock:
+            known = self._dirs.get(dev)
+        if known is not None:
+            return known
+        top = None
+        current = os.path.dirname(path)
+        while True:
+            try:
+                if os.lstat(current).st_dev != dev:
+                    break
+            except OSError:
+                break
+            top = current
+            if current == self.root_path or not current.startswith(self.root_path + os.sep):
+                break
+            current = os.path.dirname(current)
+        if top is None:
+            return None
+        trash_dir = os.path.join(top, self.dir_name)
+        with self._lock:
+            self._dirs[dev] = trash_dir
+        return trash_dir
+
+    def move(self, path):
+        """
+        Renames path (a file or folder below root_path) into the trash.
+        Returns the path in the trash, or None if it could not be moved, in
+        which case the caller should delete it directly.
+        """
+        path = os.path.normpath(path)
+        if not path.startswith(self.root_path + os.sep) or self.dir_name in path.split(os.sep):
+            return None
+        try:
+            trash_dir = self.trash_dir_for(path)
+            if trash_dir is None:
+                return None
+            os.makedirs(trash_dir, exist_ok=True)
+            target = os.path.join(trash_dir, f"{time.time_ns()}-{uuid.uuid4().hex[:8]}-{os.path.basename(path)}")
+            os.rename(path, target)
+        except OSError as e:
+            logging.warning(f"无法移入回收目录，改为直接删除: {path}: {e}")
+            return None
+        logging.info(f"已移入回收目录: {path} -> {target}")
+        self._wake.set()
+        return target
+
+    def trash_dirs(self):
+        """Known trash folders: root_path's, those next to its direct subfolders, and any used since start."""
+        candidates = {os.path.join(self.root_path, self.dir_name)}
+        try:
+            with os.scandir(self.root_path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False) and entry.name != self.dir_name:
+                        candidates.add(os.path.join(entry.path, self.dir_name))
+        except OSError:
+            pass
+        with self._lock:
+            candidates.update(self._dirs.values())
+        return sorted(d for d in candidates if os.path.isdir(d))
+
+    def reap(self):
+        """Empties every trash folder. Returns the number of files removed."""
+        entries = []
+        for trash_dir in self.trash_dirs():
+            try:
+                entries.extend(os.path.join(trash_dir, name) for name in sorted(os.listdir(trash_dir)))
+            except OSError as e:
+                logging.warning(f"读取回收目录失败: {trash_dir}: {e}")
+        walked = [_walk_trash_entry(entry) for entry in entries]
+        pending_files = sum(len(files) for files, _ in walked)
+        pending_bytes = sum(size for files, _ in walked for _, size in files)
+        TRASH_FILES.set(pending_files)
+        TRASH_BYTES.set(pending_bytes)
+        if not pending_files and not any(dirs for _, dirs in walked):
+            return 0
+
+        files = [f for entry_files, _ in walked for f in entry_files]
+        removed = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='rcp-reap') as executor:
+            slice_size = self.rate or len(files) or 1
+            start = time.monotonic()
+            for i in range(0, len(files), slice_size):
+                if i and self.rate:
+                    # At most `rate` unlinks per second
+                    time.sleep(max(0.0, 1.0 - (time.monotonic() - start)))
+                start = time.monotonic()
+                part = files[i:i + slice_size]
+                removed += sum(executor.map(_unlink, (p for p, _ in part)))
+                pending_files -= len(part)
+                pending_bytes -= sum(size for _, size in part)
+                TRASH_FILES.set(pending_files)
+                TRASH_BYTES.set(pending_bytes)
+        for _, dirs in walked:
+            for d in dirs:
+                try:
+                    os.rmdir(d)
+                except OSError as e:
+                    logging.warning(f"删除回收目录失败: {d}: {e}")
+        logging.info(f"回收目录已清理 {removed} 个文件")
+        return removed
+
+    def reap_unattended(self):
+        """
+        Called after moving things to the trash. Wakes the reaper if this process
+        runs one (rcp_agent); otherwise (rcp.py, in-process jobs) empties the trash
+        right away, so nothing is left behind in the library once the process exits.
+        """
+        if self._thread is not None:
+            self._wake.set()
+            return 0
+        return self.reap()
+
+    def start(self):
+        """Runs the reaper in a daemon thread: after every move and every `interval` seconds."""
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.reap()
+                except Exception as e:
+                    logging.error(f"Trash reaper failed: {e}", exc_info=True)
+                self._wake.wait(self.interval)
+                self._wake.clear()
+
+        self._thread = threading.Thread(target=loop, name='rcp-trash-reaper', daemon=True)
+        self._thread.start()
+        logging.info(f"Trash reaper started for {self.root_path} ({self.rate or 'unlimited'} files/s)")
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+        return 1
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        logging.error(f"删除回收文件失败: {path}: {e}")
+        return 0
+
+
+_trashes = {}
+_trashes_lock = threading.Lock()
+
+def get_trash(config):
+    """Returns the shared Trash for config's root_path, or None when [trash] is disabled."""
+    if not config.get('trash_enabled', True):
+        return None
+    root_path = os.path.normpath(config['root_path'])
+    with _trashes_lock:
+        trash = _trashes.get(root_path)
+        if trash is None:
+            trash = _trashes[root_path] = Trash(
+                root_path,
+                dir_name=config.get('trash_dir_name', DEFAULT_TRASH_DIR),
+                workers=config.get('trash_workers', 4),
+                rate=config.get('trash_rate', 200),
+                interval=config.get('trash_interval', 30.0),
+            )
+        return trash
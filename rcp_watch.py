@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+Watch mode: finds finished downloads without qBittorrent's "run external
+program" hook.
+
+Every entry directly inside a watched download root is one torrent. An entry
+that changes becomes pending; it is ready once nothing inside it has changed
+for `quiet` seconds and it holds no incomplete files (e.g. qBittorrent's
+`.!qB`), or as soon as its completion marker shows up. Changes are seen
+through inotify (via ctypes) where the kernel offers it, otherwise by polling
+the pending entries. A small SQLite index remembers each entry's mtime and
+state, so a restart only looks at entries that changed while it was down.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import sqlite3
+import struct
+import threading
+import time
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+_EVENT_HEADER = struct.Struct('iIII')
+
+DEFAULT_INCOMPLETE_SUFFIXES = ('.!qB', '.part', '.crdownload')
+
+# Entry states in the index
+BASELINE = 'baseline'
+PENDING = 'pending'
+QUEUED = 'queued'
+PROCESSED = 'processed'
+FAILED = 'failed'
+
+
+class Inotify:
+    """Minimal inotify binding over libc. Raises OSError where inotify is unavailable."""
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError) as e:
+            raise OSError(f"inotify is not available: {e}")
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        fd = init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1: {os.strerror(errno)}")
+        self.fd = fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read(self, timeout):
+        """Waits up to timeout seconds and returns the pending events as (wd, mask, name)."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WatchIndex:
+    """SQLite index of the entries of the watched roots: mtime, signature and state."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " path TEXT PRIMARY KEY,"
+                " root TEXT NOT NULL,"
+                " mtime_ns INTEGER NOT NULL,"
+                " signature TEXT,"
+                " state TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_root ON entries (root)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def entries(self, root):
+        """{path: (mtime_ns, state)} of root's indexed entries."""
+        with self._lock, self._connect() as conn:
+            return {p: (m, s) for p, m, s in conn.execute(
+                "SELECT path, mtime_ns, state FROM entries WHERE root = ?", (root,))}
+
+    def set(self, path, root, mtime_ns, state, signature=None):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (path, root, mtime_ns, signature, state, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (path, root, mtime_ns, signature, state, time.time()))
+
+    def remove(self, paths):
+        with self._lock, self._connect() as conn:
+            conn.executemany("DELETE FROM entries WHERE path = ?", ((p,) for p in paths))
+
+
+def scan_entry(path, incomplete_suffixes=DEFAULT_INCOMPLETE_SUFFIXES):
+    """
+    Returns (signature, incomplete) of a download: the signature changes with
+    any added, removed, grown or rewritten file; incomplete is True while a
+    file still carries one of incomplete_suffixes.
+    """
+    if not os.path.isdir(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None, False
+        return f"1:{st.st_size}:{st.st_mtime_ns}", path.endswith(incomplete_suffixes)
+    files = size = newest = 0
+    incomplete = False
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            files += 1
+            size += st.st_size
+            newest = max(newest, st.st_mtime_ns)
+            if entry.name.endswith(incomplete_suffixes):
+                incomplete = True
+    return f"{files}:{size}:{newest}", incomplete
+
+
+class Watcher:
+    """
+    Watches download roots and calls on_ready(path, torhash, torname) for every
+    finished download; torhash is None unless the completion marker names it.
+    The caller reports the outcome with finished(path, ok); a failed download
+    is retried once it changes again.
+
+    mode is 'inotify', 'poll' or 'auto' (inotify, falling back to polling).
+    On the very first run, downloads that already look complete are only
+    indexed unless process_existing is set.
+    """
+
+    def __init__(self, roots, on_ready, index_path, quiet=60.0, marker='',
+                 incomplete_suffixes=DEFAULT_INCOMPLETE_SUFFIXES, poll_interval=30.0,
+                 mode='auto', process_existing=False, skip=()):
+        self.roots = [os.path.normpath(r) for r in roots]
+        self.on_ready = on_ready
+        self.index = WatchIndex(index_path)
+        self.quiet = quiet
+        self.marker = marker
+        self.incomplete_suffixes = tuple(incomplete_suffixes)
+        self.poll_interval = poll_interval
+        self.mode = mode
+        self.process_existing = process_existing
+        self.skip = frozenset(skip)
+        self._inotify = None
+        self._watches = {}
+        # path -> {'root', 'activity', 'signature', 'polled'}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Runs the watcher in a daemon thread."""
+        if self._thread is not None:
+            return
+        if self.mode in ('auto', 'inotify'):
+            try:
+                self._inotify = Inotify()
+            except OSError as e:
+                if self.mode == 'inotify':
+                    raise
+                logging.warning(f"inotify 不可用，改为轮询: {e}")
+        for root in self.roots:
+            if self._inotify is not None and not self._add_watch(root):
+                logging.warning(f"无法监视 {root}，改为轮询该目录")
+        self._sync_roots(first_run=True)
+        self._thread = threading.Thread(target=self._loop, name='rcp-watch', daemon=True)
+        self._thread.start()
+        how = 'inotify' if self._inotify is not None else f'polling every {self.poll_interval}s'
+        logging.info(f"Watching {', '.join(self.roots)} ({how}, quiet {self.quiet}s)")
+
+    def finished(self, path, ok):
+        """Records the outcome of processing path."""
+        root = self._root_of(path)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            self.index.remove([path])
+            return
+        self.index.set(path, root, mtime_ns, PROCESSED if ok else FAILED)
+
+    def _loop(self):
+        last_sync = time.monotonic()
+        while True:
+            try:
+                if self._inotify is not None:
+                    self._handle_events(self._inotify.read(timeout=1.0))
+                else:
+                    time.sleep(self.poll_interval)
+                # Catches what inotify misses (unwatchable directories, overflows) and
+                # is the only source of changes when polling
+                if self._inotify is None or time.monotonic() - last_sync >= self.poll_interval:
+                    self._sync_roots()
+                    last_sync = time.monotonic()
+                self._check_pending()
+            except Exception as e:
+                logging.error(f"Watcher error: {e}", exc_info=True)
+                time.sleep(1.0)
+
+    def _root_of(self, path):
+        for root in self.roots:
+            if path == root or path.startswith(root + os.sep):
+                return root
+        return os.path.dirname(path)
+
+    def _is_skipped(self, name):
+        return name.startswith('.') or name in self.skip or (self.marker and name.endswith(self.marker))
+
+    def _add_watch(self, path):
+        try:
+            self._watches[self._inotify.add_watch(path)] = path
+            return True
+        except OSError as e:
+            logging.debug(f"inotify_add_watch failed for {path}: {e}")
+            return False
+
+    def _add_watches(self, top):
+        """Watches top and every directory below it. Returns False if any watch failed."""
+        ok = True
+        stack = [top]
+        while stack:
+            current = stack.pop()
+            ok = self._add_watch(current) and ok
+            try:
+                with os.scandir(current) as it:
+                    stack.extend(e.path for e in it if e.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+        return ok
+
+    def _mark_pending(self, path, root, now=None):
+        with self._lock:
+            entry = self._pending.get(path)
+            if entry is None:
+                entry = self._pending[path] = {'root': root, 'signature': None, 'polled': self._inotify is None}
+                if self._inotify is not None and os.path.isdir(path) and not self._add_watches(path):
+                    entry['polled'] = True
+                logging.info(f"发现新的下载: {path}")
+            entry['activity'] = now or time.monotonic()
+
+    def _sync_roots(self, first_run=False):
+        """Compares each root's entries with the index and marks new or changed entries pending."""
+        for root in self.roots:
+            known = self.index.entries(root)
+            baseline = first_run and not known and not self.process_existing
+            seen = set()
+            try:
+                with os.scandir(root) as it:
+                    entries = [e for e in it if not self._is_skipped(e.name)]
+            except OSError as e:
+                logging.warning(f"无法读取下载目录 {root}: {e}")
+                continue
+            indexed = 0
+            for entry in entries:
+                seen.add(entry.path)
+                if entry.path in self._pending:
+                    continue
+                try:
+                    mtime_ns = entry.stat(follow_symlinks=False).st_mtime_ns
+                except OSError:
+                    continue
+                previous = known.get(entry.path)
+                if previous is not None and previous[1] == QUEUED and not first_run:
+                    continue
+                if previous is not None and previous[1] in (BASELINE, PROCESSED, FAILED) and previous[0] == mtime_ns:
+                    continue
+                if baseline:
+                    signature, incomplete = scan_entry(entry.path, self.incomplete_suffixes)
+                    if not incomplete:
+                        self.index.set(entry.path, root, mtime_ns, BASELINE, signature)
+                        indexed += 1
+                        continue
+                self.index.set(entry.path, root, mtime_ns, PENDING)
+                self._mark_pending(entry.path, root)
+            gone = [p for p in known if p not in seen]
+            if gone:
+                self.index.remove(gone)
+            if baseline:
+                logging.info(f"首次监视 {root}：已有的 {indexed} 个下载只记录不处理")
+
+    def _handle_events(self, events):
+        now = time.monotonic()
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify 事件队列溢出，重新扫描下载目录")
+                self._sync_roots()
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            root = self._root_of(path)
+            relative = os.path.relpath(path, root)
+            if relative == os.curdir:
+                continue
+            top_name = relative.split(os.sep, 1)[0]
+            if self.marker and top_name.endswith(self.marker):
+                # The marker next to a single-file download
+                top_name = top_name[:-len(self.marker)]
+            elif self._is_skipped(top_name):
+                continue
+            top = os.path.join(root, top_name)
+            if directory != root and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_watches(path)
+            if not os.path.lexists(top):
+                continue
+            self._mark_pending(top, root, now)
+
+    def _read_marker(self, path):
+        """(present, torhash) of path's completion marker; the marker may hold the torhash."""
+        if not self.marker:
+            return False, None
+        for candidate in (os.path.join(path, self.marker), path + self.marker):
+            try:
+                with open(candidate, encoding='utf-8') as f:
+                    content = f.read(256).split()
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            except OSError:
+                return True, None
+            torhash = content[0] if content and all(c in '0123456789abcdefABCDEF' for c in content[0]) else None
+            return True, torhash
+        return False, None
+
+    def _check_pending(self):
+        now = time.monotonic()
+        with self._lock:
+            pending = list(self._pending.items())
+        for path, entry in pending:
+            if not os.path.lexists(path):
+                with self._lock:
+                    self._pending.pop(path, None)
+                self.index.remove([path])
+                continue
+            has_marker, torhash = self._read_marker(path)
+            if not has_marker:
+                if entry['polled']:
+                    signature, incomplete = scan_entry(path, self.incomplete_suffixes)
+                    if signature != entry['signature']:
+                        entry['signature'] = signature
+                        entry['activity'] = now
+                        continue
+                if now - entry['activity'] < self.quiet:
+                    continue
+                signature, incomplete = scan_entry(path, self.incomplete_suffixes)
+                if incomplete:
+                    entry['activity'] = now
+                    continue
+            else:
+                signature, _ = scan_entry(path, self.incomplete_suffixes)
+            with self._lock:
+                self._pending.pop(path, None)
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            self.index.set(path, entry['root'], mtime_ns, QUEUED, signature)
+            torname = os.path.basename(path)
+            logging.info(f"下载已完成: {path}" + (" (marker)" if has_marker else ""))
+            try:
+                self.on_ready(path, torhash, torname)
+            except Exception as e:
+                logging.error(f"Could not queue {path}: {e}", exc_info=True)
+                self.index.set(path, entry['root'], mtime_ns, FAILED, signature)
+
+
+def get_watcher(config, on_ready):
+    """Builds the Watcher for config's [watch] section."""
+    roots = config.get('watch_paths') or config.get('reconcile_download_paths', [])
+    if not roots:
+        raise ValueError("[watch] paths 未配置，且 path_mapping 为空")
+    return Watcher(
+        roots,
+        on_ready,
+        config['watch_index_path'],
+        quiet=config.get('watch_quiet', 60.0),
+        marker=config.get('watch_marker', ''),
+        incomplete_suffixes=config.get('watch_incomplete_suffixes', DEFAULT_INCOMPLETE_SUFFIXES),
+        poll_interval=config.get('watch_poll_interval', 30.0),
+        mode=config.get('watch_mode', 'auto'),
+        process_existing=config.get('watch_process_existing', False),
+        skip=(config.get('trash_dir_name', '.rcp-trash'),),
+    )